@@ -0,0 +1,359 @@
+"""
+ASGI entry point: the same endpoints as main.py, served by an event loop so
+that one process handles many voice memos at the same time.
+
+Run it with:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import logging
+import time
+import zipfile
+
+from quart import Quart, Request, g, request, jsonify
+from werkzeug.utils import secure_filename
+
+from lib.batch import (
+    ARCHIVE_EXTENSIONS,
+    ARCHIVE_MIMETYPES,
+    BATCH_MAX_FILES,
+    aprocess_batch,
+    enqueue_batch,
+    extension_of,
+    extract_archive,
+    manifest,
+)
+from lib.gpt import cache_stats, openai_stats
+from lib.notion import aclose_client, notion_stats
+from lib.outbox import outbox_stats
+from lib.upload import (
+    MAX_UPLOAD_BYTES,
+    RAW_MIMETYPES,
+    areceive_stream,
+    file_stream_factory,
+)
+from lib.jobs import enqueue, finish_job, get_job, update_stage
+from lib.log import bind, log_context, new_request_id
+from lib.metrics import observe_stage, render, tracing
+from main import (
+    ALLOWED_EXTENSIONS,
+    PREWARM,
+    UPLOAD_FOLDER,
+    allowed_file,
+    aprewarm,
+    aprocess_file,
+    ensure_flusher,
+    readiness,
+    warm_up,
+)
+
+
+class UploadRequest(Request):
+    """
+    A request writing its uploaded files straight to the uploads folder,
+    hashed on the fly
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.uploads = []
+
+    def make_form_data_parser(self):
+        parser = super().make_form_data_parser()
+        parser.stream_factory = file_stream_factory(
+            app.config["UPLOAD_FOLDER"], self.uploads
+        )
+        return parser
+
+    def discard_uploads(self):
+        """
+        This function removes the files which were not accepted
+        """
+        for upload in self.uploads:
+            upload.discard()
+
+
+app = Quart(__name__)
+app.request_class = UploadRequest
+app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+
+@app.before_serving
+async def startup():
+    """
+    This function loads the config and the clients, opens their connections
+    with PREWARM, and sends the pages left in the outbox by a previous run
+    """
+    warm_up()
+    if PREWARM:
+        await aprewarm()
+    ensure_flusher()
+
+
+@app.after_serving
+async def shutdown():
+    """
+    This function closes the connections of the client of Notion opened in
+    the event loop of the app
+    """
+    await aclose_client()
+
+
+@app.before_request
+async def start_timer():
+    """
+    This function records when the request started, to measure the upload
+    """
+    g.started = time.monotonic()
+
+
+@app.before_request
+async def start_request_log():
+    """
+    This function adds the id of the request, given in its X-Request-Id
+    header or new, to its logs. Each request is a task with its own context,
+    the id does not outlive it
+    """
+    g.request_id = request.headers.get("X-Request-Id") or new_request_id()
+    bind(request_id=g.request_id)
+
+
+@app.after_request
+async def add_request_id(response):
+    """
+    This function gives the id of the request in its response
+    """
+    response.headers["X-Request-Id"] = g.request_id
+    return response
+
+
+@app.route("/", methods=["POST"])
+async def generate():
+    """
+    This function generates the content for the Notion database
+    """
+    # The audio can also be sent as the raw body of the request
+    if request.mimetype in RAW_MIMETYPES:
+        filepath, audio_hash = await areceive_stream(
+            request.body, app.config["UPLOAD_FOLDER"], "m4a"
+        )
+        logging.debug("The file path is: %s", filepath)
+        return await accept_upload(filepath, audio_hash)
+
+    files = await request.files
+
+    # check if the post request has the file part
+    if "file" not in files:
+        logging.error("No file in the POST request", exc_info=True)
+        return jsonify({"message": "File missing"}), 400
+
+    file = files["file"]
+    logging.debug("The file is: %s", file)
+
+    if file is not None and allowed_file(file.filename):
+        if file.filename is not None:
+            # The file is already written, it only gets its final name
+            # A name such as ".m4a" loses its dot once made safe
+            extension = extension_of(secure_filename(file.filename)) or "m4a"
+            filepath, audio_hash = file.stream.commit(extension)
+            logging.debug("The file path is: %s", filepath)
+        else:
+            logging.error("The file name is invalid", exc_info=True)
+            return jsonify({"message": "Invalid file name"}), 400
+    else:
+        logging.error("The file is invalid", exc_info=True)
+        return jsonify({"message": "Invalid file"}), 400
+
+    return await accept_upload(filepath, audio_hash)
+
+
+async def accept_upload(filepath: str, audio_hash: str):
+    """
+    This function processes a received audio file. An upload already
+    received, with the same Idempotency-Key header or the same audio, is
+    answered with the result of the first one
+    """
+    observe_stage("upload", g.started)
+    job_id, created = await asyncio.to_thread(
+        enqueue, filepath, audio_hash, request.headers.get("Idempotency-Key"), "running"
+    )
+    if not created:
+        job = await asyncio.to_thread(get_job, job_id)
+        headers = {"Idempotent-Replayed": "true"}
+        if job["result"] is None:
+            return jsonify({"message": "Accepted", "job_id": job_id}), 202, headers
+        body = {**job["result"]["body"], "page_id": job["page_id"]}
+        return jsonify(body), job["result"]["status_code"], headers
+
+    # With ?trace=1, the response gives the spans of the pipeline
+    with tracing(bool(request.args.get("trace")), g.started) as trace:
+        try:
+            with log_context(job_id=job_id):
+                body, status = await aprocess_file(
+                    filepath, job_progress(job_id), audio_hash, job_id
+                )
+        except Exception:
+            # There is no worker to try again, the next upload will
+            await asyncio.to_thread(finish_job, job_id, {"message": "Error"}, 500)
+            raise
+    await asyncio.to_thread(finish_job, job_id, body, status)
+    if trace is not None:
+        body = {**body, "trace": trace}
+    return jsonify(body), status
+
+
+@app.route("/batch", methods=["POST"])
+async def batch():
+    """
+    This function processes many voice memos at once, sent as "file" parts or
+    zip archives of memos, or as a zip archive in the body, BATCH_WORKERS at a
+    time, and returns the manifest of their results
+    """
+    folder = app.config["UPLOAD_FOLDER"]
+    uploads, rejected = [], []
+    try:
+        if request.mimetype in ARCHIVE_MIMETYPES:
+            archive, _ = await areceive_stream(request.body, folder, "zip")
+            uploads = await asyncio.to_thread(
+                extract_archive, archive, folder, ALLOWED_EXTENSIONS
+            )
+        files = await request.files
+        for file in files.getlist("file"):
+            name = secure_filename(file.filename or "")
+            if extension_of(name) in ARCHIVE_EXTENSIONS:
+                archive, _ = file.stream.commit("zip")
+                uploads += await asyncio.to_thread(
+                    extract_archive, archive, folder, ALLOWED_EXTENSIONS
+                )
+            elif allowed_file(name):
+                uploads.append((file.filename, *file.stream.commit(extension_of(name))))
+            else:
+                rejected.append((file.filename, "Invalid file"))
+    except (ValueError, zipfile.BadZipFile) as e:
+        logging.error("The batch is invalid", exc_info=True)
+        return jsonify({"message": f"Invalid archive: {e}"}), 400
+    if not uploads:
+        logging.error("No file in the batch")
+        return (
+            jsonify({"message": "File missing", "files": manifest([], rejected)}),
+            400,
+        )
+    if len(uploads) > BATCH_MAX_FILES:
+        return jsonify({"message": f"More than {BATCH_MAX_FILES} files"}), 400
+
+    observe_stage("upload", g.started)
+    jobs = await asyncio.to_thread(
+        enqueue_batch, uploads, request.headers.get("Idempotency-Key")
+    )
+    await aprocess_batch([job for _, job, created in jobs if created], process_memo)
+    files = await asyncio.to_thread(manifest, jobs, rejected)
+    return jsonify({"message": "Success", "files": files}), 200
+
+
+def job_progress(job_id: str):
+    """
+    This function returns the progress coroutine function of a job, which
+    records its stages and renews its lease
+    """
+
+    async def progress(stage: str, status: str):
+        await asyncio.to_thread(update_stage, job_id, stage, status)
+
+    return progress
+
+
+async def process_memo(job: dict):
+    """
+    This function processes a memo of a batch and stores its response
+    """
+    try:
+        with log_context(job_id=job["id"]):
+            body, status = await aprocess_file(
+                job["filepath"], job_progress(job["id"]), job["audio_hash"], job["id"]
+            )
+    except Exception:
+        logging.error("Error while processing job %s", job["id"], exc_info=True)
+        body, status = {"message": "Error"}, 500
+    await asyncio.to_thread(finish_job, job["id"], body, status)
+
+
+@app.teardown_request
+async def discard_uploads(exception):
+    """
+    This function removes the uploaded files which were not accepted
+    """
+    request.discard_uploads()
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def job_status(job_id):
+    """
+    This function returns the progress of a queued upload
+    """
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    return (
+        jsonify(
+            {
+                "job_id": job["id"],
+                "status": job["status"],
+                "stage": job["stage"],
+                "stages": job["stages"],
+                "attempts": job["attempts"],
+                "result": job["result"],
+                "error": job["error"],
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/hello", methods=["GET"])
+async def hello():
+    """
+    This function is used to check if the app is running
+    """
+    return jsonify({"message": "Success"}), 200
+
+
+@app.route("/ready", methods=["GET"])
+async def ready():
+    """
+    This function is used to check if the app can process memos, unlike
+    /hello which only checks that it is running
+    """
+    body = await asyncio.to_thread(readiness)
+    return jsonify(body), 200 if body["ready"] else 503
+
+
+@app.route("/stats", methods=["GET"])
+async def stats():
+    """
+    This function returns the counters of the caches and of the calls to
+    OpenAI and Notion, for monitoring
+    """
+    # The caches and the outbox are read from SQLite, off the event loop
+    caches = await asyncio.to_thread(cache_stats)
+    outbox = await asyncio.to_thread(outbox_stats)
+    return (
+        jsonify(
+            {
+                **caches,
+                "openai": openai_stats(),
+                "notion": notion_stats(),
+                "outbox": outbox,
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    """
+    This function returns the metrics of the pipeline, in the Prometheus text
+    format
+    """
+    return render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
@@ -0,0 +1,221 @@
+"""
+Generate again some fields of the memos already sent to Notion, after a field
+was added to a destination or a prompt was fixed.
+
+The transcripts kept next to the uploads are routed again, without calling
+Whisper, the fields are generated again and the Notion pages of the memos
+are updated. The memos done are written to a checkpoint file, so that an
+interrupted backfill starts again where it stopped:
+    python backfill.py --fields Name,Mood --destination Journal --workers 8
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lib.fields import generate_fields, get_field, split_streamed
+from lib.jobs import find_page_id
+from lib.notion import query_database, update_notion_row
+from lib.usage import labelled
+from main import (
+    SCRIPT_DIR,
+    UPLOAD_FOLDER,
+    build_payload,
+    load_config,
+    model_routes,
+)
+
+# The name of the uploads named after their SHA-256
+HASH_NAME = re.compile(r"[0-9a-f]{64}")
+# The length of the start of the idea the pages are looked up by, in Notion
+INPUT_PREFIX = 100
+
+
+def retried(entry: dict) -> bool:
+    """
+    This function returns whether a memo is handled again by the next run:
+    when it failed, or when its page was not found (not delivered yet...)
+    """
+    return entry.get("status") == "failed" or entry.get("reason") == "no page"
+
+
+def read_checkpoint(path: str, key: str) -> set:
+    """
+    This function returns the transcripts a previous run with the same key,
+    the fields and destinations backfilled, already handled, from its
+    checkpoint file
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line of an interrupted run can be cut
+                continue
+            if entry.get("key") == key and not retried(entry):
+                done.add(entry["transcript"])
+    return done
+
+
+def find_page(destination: dict, idea: str, transcript_path: str, audio_path: str):
+    """
+    This function returns the id of the Notion page of a memo: the page
+    delivered for its upload, or for the memos processed before the jobs kept
+    it, the only page of the destination whose Input starts like the idea.
+    """
+    stem = os.path.splitext(os.path.basename(transcript_path))[0]
+    page_id = find_page_id(audio_path, stem if HASH_NAME.fullmatch(stem) else None)
+    if page_id is not None or "Input" not in destination["fields"]:
+        return page_id
+    pages = query_database(
+        destination["db_id"],
+        {"property": "Input", "rich_text": {"starts_with": idea[:INPUT_PREFIX]}},
+        page_size=2,
+    )
+    if not pages:
+        return None
+    if len(pages) > 1:
+        logging.warning("Several pages start like %s", transcript_path)
+        return None
+    return pages[0]["id"]
+
+
+def wanted_field(name: str, fields: list) -> bool:
+    """
+    This function returns whether a field of a destination is generated
+    again: one of the fields asked for or, without them, a GPT field. The
+    local fields (Date, Input...) would lose the values of the first run
+    """
+    if fields:
+        return name in fields
+    return get_field(name).prompt is not None
+
+
+def backfill_memo(transcript_path: str, fields: list, destinations: list):
+    """
+    This function generates again the fields of a memo and updates its
+    Notion page. It returns the status of the memo with its details
+    """
+    with open(transcript_path, encoding="utf-8") as f:
+        transcript = f.read()
+    destination, idea = load_config(transcript)
+    if destinations and destination["name"] not in destinations:
+        return "skipped", {"reason": "other destination"}
+    if idea is None:
+        return "skipped", {"reason": "no idea"}
+
+    # The streamed fields are in the body of the page, not in its properties
+    streamed, _ = split_streamed(destination["fields"], destination.get("stream") or [])
+    wanted = [
+        name
+        for name in destination["fields"]
+        if name not in streamed and wanted_field(name, fields)
+    ]
+    if not wanted:
+        return "skipped", {"reason": "no field"}
+
+    audio_path = os.path.splitext(transcript_path)[0] + ".m4a"
+    page_id = find_page(destination, idea, transcript_path, audio_path)
+    if page_id is None:
+        return "skipped", {"reason": "no page"}
+
+    with labelled(destination=destination["name"]):
+        values = generate_fields(
+            idea,
+            wanted,
+            destination["language"],
+            combined=destination.get("combined"),
+            routes=model_routes(destination),
+            digest=destination.get("digest"),
+            # The fields are generated again, not read from the cache
+            use_cache=False,
+        )
+    if update_notion_row(destination["db_id"], page_id, build_payload(wanted, values)):
+        return "done", {"page_id": page_id, "updated": wanted}
+    return "failed", {"page_id": page_id, "reason": "Notion refused the update"}
+
+
+def main():
+    """
+    This function backfills the memos of the uploads folder, workers at a time
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--fields",
+        default="",
+        help="fields generated again, all the GPT fields by default",
+    )
+    parser.add_argument(
+        "--destination",
+        default="",
+        help="destinations backfilled, separated by commas, all of them by default",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("BACKFILL_WORKERS", "4")),
+        help="number of memos processed at the same time",
+    )
+    parser.add_argument("--uploads", default=UPLOAD_FOLDER, help="uploads folder")
+    parser.add_argument(
+        "--checkpoint",
+        default=SCRIPT_DIR + "/backfill.checkpoint",
+        help="file of the memos already backfilled",
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the checkpoint file"
+    )
+    args = parser.parse_args()
+
+    fields = [name for name in args.fields.split(",") if name]
+    destinations = [name for name in args.destination.split(",") if name]
+    # A checkpoint only counts for a backfill of the same fields and destinations
+    key = "/".join(",".join(sorted(names)) or "*" for names in (fields, destinations))
+    done = set() if args.restart else read_checkpoint(args.checkpoint, key)
+    transcripts = [
+        path
+        for path in sorted(glob.glob(os.path.join(args.uploads, "*.txt")))
+        if path not in done
+    ]
+    print(f"{len(transcripts)} memos to backfill, {len(done)} already done")
+
+    counts = {}
+    with open(args.checkpoint, "a", encoding="utf-8") as checkpoint:
+        executor = ThreadPoolExecutor(
+            max(1, args.workers), thread_name_prefix="backfill"
+        )
+        futures = {
+            executor.submit(backfill_memo, path, fields, destinations): path
+            for path in transcripts
+        }
+        try:
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    status, details = future.result()
+                except Exception as e:
+                    logging.error("Error while backfilling %s", path, exc_info=True)
+                    status, details = "failed", {"reason": repr(e)}
+                counts[status] = counts.get(status, 0) + 1
+                entry = {"transcript": path, "key": key, "status": status}
+                # A memo without page is looked up again by the next run
+                if details.get("reason") != "no page":
+                    checkpoint.write(json.dumps({**entry, **details}) + "\n")
+                    checkpoint.flush()
+                print(f"{status}: {path} {details.get('reason', '')}".rstrip())
+        except KeyboardInterrupt:
+            print("Interrupted, the next run starts again from the checkpoint")
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown()
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+Offline benchmark of the whole pipeline.
+
+The app is driven with a synthetic corpus of voice memos, spread over a few
+destinations, against local stand-ins of OpenAI and Notion (see stubs.py), so
+that a change can be measured without spending tokens. It reports the
+latency percentiles of the uploads, the throughput, the time left to deliver
+the outbox and the number of calls made to each API.
+
+Run it from the root of the repository:
+    python -m bench.run --files 40 --concurrency 8 --compare
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.stubs import TRANSCRIPT_MARKER, WORDS, Behaviour, StubServer
+
+# The destinations of the synthetic corpus, with the keyword starting a memo
+DESTINATIONS = [
+    {
+        "name": "Default",
+        "language": "english",
+        "db_id": "bench-default",
+        "keywords": [],
+        "fields": ["Date", "Name", "Input"],
+    },
+    {
+        "name": "Idea",
+        "language": "english",
+        "db_id": "bench-idea",
+        "keywords": ["idea"],
+        "fields": ["Name", "Concept", "Goals", "Results", "Improvements", "Keywords"],
+    },
+    {
+        "name": "Journal",
+        "language": "english",
+        "db_id": "bench-journal",
+        "keywords": ["journal"],
+        "fields": ["Date", "Name", "Mood", "Events", "Recommendations", "Input"],
+    },
+    {
+        "name": "Article",
+        "language": "english",
+        "db_id": "bench-article",
+        "keywords": ["article"],
+        "fields": ["Title", "Target", "Keywords", "Excerpt", "Draft"],
+        "stream": ["Draft"],
+        "digest": {"Excerpt": "summary", "Draft": "clean"},
+    },
+]
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    This function reads the settings of the benchmark from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=40, help="Number of uploads")
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Number of uploads at a time"
+    )
+    parser.add_argument(
+        "--audio-kb", type=int, default=64, help="Size of each synthetic memo"
+    )
+    parser.add_argument(
+        "--words", type=int, default=80, help="Number of words of each memo"
+    )
+    parser.add_argument(
+        "--field-workers", type=int, default=6, help="FIELD_WORKERS of the app"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Run with FIELD_WORKERS=1 (serial) and --field-workers, and compare",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus")
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=300,
+        help="Number of seconds to wait for the outbox to be delivered",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the raw results")
+    add_behaviour(parser, "transcriptions", latency=2.0)
+    add_behaviour(parser, "completions", latency=1.5)
+    add_behaviour(parser, "notion", latency=0.3)
+    return parser.parse_args(argv)
+
+
+def add_behaviour(parser: argparse.ArgumentParser, endpoint: str, latency: float):
+    """
+    This function adds the options of the behaviour of a stubbed endpoint.
+    """
+    group = parser.add_argument_group(endpoint)
+    group.add_argument(
+        f"--{endpoint}-latency",
+        type=float,
+        default=latency,
+        help="Median latency, in seconds",
+    )
+    group.add_argument(
+        f"--{endpoint}-jitter",
+        type=float,
+        default=0.5,
+        help="Spread of the log-normal latency, 0 for a constant one",
+    )
+    group.add_argument(
+        f"--{endpoint}-error-rate", type=float, default=0.0, help="Share of 500"
+    )
+    group.add_argument(
+        f"--{endpoint}-throttle-rate", type=float, default=0.0, help="Share of 429"
+    )
+    group.add_argument(
+        f"--{endpoint}-retry-after",
+        type=float,
+        default=1.0,
+        help="Retry-After of the 429, in seconds",
+    )
+
+
+def behaviours(args: argparse.Namespace) -> dict:
+    """
+    This function returns the behaviour of each stubbed endpoint.
+    """
+    return {
+        endpoint: Behaviour(
+            latency=getattr(args, f"{endpoint}_latency"),
+            jitter=getattr(args, f"{endpoint}_jitter"),
+            error_rate=getattr(args, f"{endpoint}_error_rate"),
+            throttle_rate=getattr(args, f"{endpoint}_throttle_rate"),
+            retry_after=getattr(args, f"{endpoint}_retry_after"),
+        )
+        for endpoint in ("transcriptions", "completions", "notion")
+    }
+
+
+def make_corpus(directory: str, args: argparse.Namespace) -> list:
+    """
+    This function writes the synthetic memos and returns their paths. Each
+    one holds the transcript the stub answers, starting with the keyword of
+    its destination, padded to the size of a real memo.
+    """
+    rng = random.Random(args.seed)
+    keywords = [d["keywords"][0] for d in DESTINATIONS if d["keywords"]] + ["note"]
+    paths = []
+    for i in range(args.files):
+        words = " ".join(rng.choices(WORDS, k=args.words))
+        transcript = f"{keywords[i % len(keywords)]}. Memo {i}: {words}."
+        path = os.path.join(directory, f"memo-{i}.m4a")
+        with open(path, "wb") as f:
+            f.write(b"\x00\x00\x00\x20ftypM4A \x00")
+            f.write(TRANSCRIPT_MARKER + transcript.encode("utf-8") + b"\x00")
+            padding = rng.getrandbits(8 * args.audio_kb * 1024).to_bytes(
+                args.audio_kb * 1024, "little"
+            )
+            f.write(padding.replace(b"\x00", b"\x01"))
+        paths.append(path)
+    return paths
+
+
+def configure(workdir: str, server: StubServer, field_workers: int):
+    """
+    This function points the app to the stubs and to a scratch directory. It
+    must be called before the app is imported.
+    """
+    os.environ.update(
+        {
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": server.url + "/v1",
+            "NOTION_API_KEY": "bench",
+            "NOTION_API_URL": server.url + "/v1",
+            "FIELD_WORKERS": str(field_workers),
+            "JOB_WORKERS": "0",
+            "TRANSCRIPT_CACHE": "false",
+            "COMPLETION_CACHE": "off",
+            "JOBS_DB": os.path.join(workdir, "jobs.sqlite3"),
+            "OUTBOX_DB": os.path.join(workdir, "outbox.sqlite3"),
+            "USAGE_DB": os.path.join(workdir, "usage.sqlite3"),
+            "OUTBOX_POLL_INTERVAL": "0.2",
+            "LOG_PATH": os.path.join(workdir, "bench.log"),
+        }
+    )
+
+
+def percentile(values: list, rank: float) -> float:
+    """
+    This function returns the nearest-rank percentile of values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(rank / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def wait_outbox(outbox_stats, timeout: float) -> float:
+    """
+    This function waits for the outbox to be delivered and returns the time
+    it took.
+    """
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        stats = outbox_stats() or {}
+        if not stats.get("pending") and not stats.get("sending"):
+            break
+        time.sleep(0.1)
+    return time.monotonic() - start
+
+
+def run(args: argparse.Namespace) -> dict:
+    """
+    This function runs the benchmark once and returns its results.
+    """
+    random.seed(args.seed)
+    server = StubServer(behaviours(args)).start()
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        configure(workdir, server, args.field_workers)
+        import main
+        from lib.outbox import outbox_stats
+
+        config_file = os.path.join(workdir, "config.json")
+        with open(config_file, "w", encoding="utf-8") as f:
+            json.dump({"destinations": DESTINATIONS}, f)
+        main.CONFIG_FILE = config_file
+        main.app.config["UPLOAD_FOLDER"] = os.path.join(workdir, "uploads")
+        os.makedirs(main.app.config["UPLOAD_FOLDER"])
+        corpus = make_corpus(workdir, args)
+
+        def upload(path: str):
+            with open(path, "rb") as f:
+                audio = f.read()
+            start = time.monotonic()
+            response = main.app.test_client().post(
+                "/?wait=1", data=audio, content_type="audio/mp4"
+            )
+            return time.monotonic() - start, response.status_code
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(upload, corpus))
+        elapsed = time.monotonic() - start
+        drain = wait_outbox(outbox_stats, args.drain_timeout)
+
+    latencies = [latency for latency, _ in results]
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    server.shutdown()
+    return {
+        "field_workers": args.field_workers,
+        "files": len(results),
+        "concurrency": args.concurrency,
+        "statuses": statuses,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "seconds": elapsed,
+        "throughput": len(results) / elapsed,
+        "outbox_drain_seconds": drain,
+        "calls": dict(sorted(server.calls.items())),
+        "models": dict(server.models),
+    }
+
+
+def compare(args: argparse.Namespace, argv: list) -> list:
+    """
+    This function runs the benchmark with serial and with parallel field
+    generation, each in its own process since the settings are read when the
+    app is imported, and returns both results.
+    """
+    results = []
+    for field_workers in (1, args.field_workers):
+        command = [sys.executable, "-m", "bench.run", *argv, "--json"]
+        command = [arg for arg in command if arg != "--compare"]
+        command += ["--field-workers", str(field_workers)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True)
+        results.append(json.loads(output.stdout))
+    return results
+
+
+def report(results: list):
+    """
+    This function prints the results side by side.
+    """
+    rows = [
+        ("FIELD_WORKERS", "field_workers", "{}"),
+        ("uploads", "files", "{}"),
+        ("p50 (s)", "p50", "{:.2f}"),
+        ("p95 (s)", "p95", "{:.2f}"),
+        ("p99 (s)", "p99", "{:.2f}"),
+        ("throughput (memos/s)", "throughput", "{:.2f}"),
+        ("outbox drain (s)", "outbox_drain_seconds", "{:.2f}"),
+    ]
+    for label, key, template in rows:
+        values = [
+            template.format(r[key]) if r[key] is not None else "-" for r in results
+        ]
+        print(f"{label:<24}" + "".join(f"{v:>14}" for v in values))
+    for label, key in (("status", "statuses"), ("calls", "calls"), ("model", "models")):
+        names = sorted({name for r in results for name in r[key]})
+        for name in names:
+            values = [str(r[key].get(name, 0)) for r in results]
+            print(f"{label + ' ' + name:<24}" + "".join(f"{v:>14}" for v in values))
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    results = compare(args, argv) if args.compare else [run(args)]
+    if args.json:
+        print(json.dumps(results[0] if len(results) == 1 else results, indent=2))
+    else:
+        report(results)
@@ -0,0 +1,219 @@
+"""
+Offline benchmark of the cold start of the app.
+
+The app is started as a server, in its own process, against local stand-ins
+of OpenAI and Notion (see stubs.py) making each new connection wait like a
+TLS handshake. It reports the time to import the app, the time until /ready
+answers, and the latency of the first memo and of the next ones, without and
+with PREWARM.
+
+Run it from the root of the repository:
+    python -m bench.startup --runs 3 --connect-latency 0.15
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from bench.run import DESTINATIONS, behaviours, configure, make_corpus
+from bench.run import parse_args as parse_run_args
+from bench.stubs import StubServer
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    This function reads the settings of the benchmark from the command line.
+    The options of the stubbed endpoints are the ones of bench.run.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="Number of starts")
+    parser.add_argument(
+        "--memos", type=int, default=4, help="Number of memos sent after a start"
+    )
+    parser.add_argument(
+        "--connect-latency",
+        type=float,
+        default=0.15,
+        help="Time a new connection to the stubs waits, in seconds",
+    )
+    parser.add_argument(
+        "--server",
+        choices=("flask", "gunicorn"),
+        default="flask",
+        help="Start the app with python main.py or with gunicorn (one worker)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Seconds to wait for /ready"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the raw results")
+    args, rest = parser.parse_known_args(argv)
+    # The latencies of the stubs are short by default, the start is measured
+    args.stubs = parse_run_args(
+        [
+            "--transcriptions-latency=0.2",
+            "--completions-latency=0.2",
+            "--notion-latency=0.05",
+            "--transcriptions-jitter=0",
+            "--completions-jitter=0",
+            "--notion-jitter=0",
+            *rest,
+        ]
+    )
+    return args
+
+
+def free_port() -> int:
+    """
+    This function returns a free TCP port.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def import_seconds(env: dict) -> float:
+    """
+    This function returns the time a new process takes to import the app.
+    """
+    code = "import time; t = time.perf_counter(); import main; "
+    code += "print(time.perf_counter() - t)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], env=env, check=True, capture_output=True
+    )
+    return float(output.stdout.decode().split()[-1])
+
+
+def wait_ready(url: str, timeout: float) -> bool:
+    """
+    This function waits for /ready to answer 200.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + "/ready", timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.02)
+    return False
+
+
+def send_memo(url: str, path: str) -> float:
+    """
+    This function sends a memo through the whole pipeline and returns its
+    latency.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    request = urllib.request.Request(
+        url + "/?wait=1", data=data, headers={"Content-Type": "audio/mp4"}
+    )
+    started = time.monotonic()
+    with urllib.request.urlopen(request, timeout=120) as response:
+        response.read()
+    return time.monotonic() - started
+
+
+def start(args: argparse.Namespace, env: dict, paths: list) -> dict:
+    """
+    This function starts the app, sends it the memos and returns the times
+    measured.
+    """
+    port = free_port()
+    env = {**env, "PORT": str(port), "GUNICORN_WORKERS": "1"}
+    if args.server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"]
+    else:
+        command = [sys.executable, "main.py"]
+    url = f"http://127.0.0.1:{port}"
+    started = time.monotonic()
+    process = subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        if not wait_ready(url, args.timeout):
+            raise RuntimeError(f"The app was not ready after {args.timeout}s")
+        ready = time.monotonic() - started
+        latencies = [send_memo(url, path) for path in paths]
+    finally:
+        process.terminate()
+        process.wait(30)
+    return {
+        "ready": ready,
+        "first_memo": latencies[0],
+        "next_memos": statistics.median(latencies[1:]) if latencies[1:] else None,
+    }
+
+
+def run(args: argparse.Namespace, prewarm: bool) -> dict:
+    """
+    This function starts the app args.runs times, each time in a new
+    scratch directory, and returns the median of each time.
+    """
+    server = StubServer(
+        behaviours(args.stubs), connect_latency=args.connect_latency
+    ).start()
+    samples = []
+    for i in range(args.runs):
+        workdir = tempfile.mkdtemp(prefix="bench-startup-")
+        configure(workdir, server, args.stubs.field_workers)
+        config = os.path.join(workdir, "config.json")
+        with open(config, "w", encoding="utf-8") as f:
+            json.dump({"destinations": DESTINATIONS}, f)
+        os.makedirs(os.path.join(workdir, "uploads"))
+        env = {
+            **os.environ,
+            "CONFIG_FILE": config,
+            "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+            "PREWARM": "true" if prewarm else "false",
+        }
+        # A new corpus each time, the memos would be deduplicated
+        args.stubs.files, args.stubs.seed = args.memos, i
+        paths = make_corpus(workdir, args.stubs)
+        samples.append({"import": import_seconds(env), **start(args, env, paths)})
+    connections, server_calls = server.connections, dict(server.calls)
+    server.shutdown()
+    result = {"prewarm": prewarm, "runs": args.runs, "server": args.server}
+    for key in ("import", "ready", "first_memo", "next_memos"):
+        values = [sample[key] for sample in samples if sample[key] is not None]
+        result[key] = statistics.median(values) if values else None
+    result["connections"] = connections
+    result["calls"] = server_calls
+    return result
+
+
+def report(results: list):
+    """
+    This function prints the results side by side.
+    """
+    rows = [
+        ("PREWARM", "prewarm", "{}"),
+        ("import (s)", "import", "{:.3f}"),
+        ("ready (s)", "ready", "{:.3f}"),
+        ("first memo (s)", "first_memo", "{:.3f}"),
+        ("next memos (s)", "next_memos", "{:.3f}"),
+        ("connections", "connections", "{}"),
+    ]
+    for label, key, template in rows:
+        values = [
+            template.format(r[key]) if r[key] is not None else "-" for r in results
+        ]
+        print(f"{label:<24}" + "".join(f"{v:>14}" for v in values))
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    results = [run(args, prewarm) for prewarm in (False, True)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
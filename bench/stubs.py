@@ -0,0 +1,283 @@
+"""
+Local stand-ins of the OpenAI and Notion APIs, for the benchmarks.
+
+Each endpoint answers after a random latency (log-normal around a median),
+and fails with a configurable rate of server errors and of throttling (429
+with a Retry-After header). The transcription endpoint answers the text
+written in the uploaded file after TRANSCRIPT_MARKER, so that a synthetic
+corpus can be routed to its destinations.
+"""
+
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRANSCRIPT_MARKER = b"TRANSCRIPT:"
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+@dataclass
+class Behaviour:
+    """
+    The behaviour of an endpoint.
+
+    Args:
+        latency (float): The median latency, in seconds.
+        jitter (float): The spread of the latency (sigma of the log-normal
+            distribution), 0 for a constant latency.
+        error_rate (float): The share of requests answered with a 500.
+        throttle_rate (float): The share of requests answered with a 429.
+        retry_after (float): The delay asked with a 429, in seconds.
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: float = 1.0
+
+    def delay(self) -> float:
+        """
+        This function draws the latency of a request.
+        """
+        if self.latency <= 0:
+            return 0.0
+        return self.latency * math.exp(random.gauss(0, self.jitter))
+
+    def failure(self):
+        """
+        This function draws the failure of a request: 500, 429 or None.
+        """
+        draw = random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    An HTTP server answering like OpenAI and Notion, counting the requests of
+    each endpoint by status.
+
+    Args:
+        behaviours (dict): The behaviour of each endpoint: "transcriptions",
+            "completions" and "notion".
+        completion_words (int): The number of words of each completion.
+        connect_latency (float): The time a new connection waits before its
+            first request is read, like a TLS handshake, in seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, behaviours: dict, completion_words: int = 60, connect_latency: float = 0
+    ):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.behaviours = behaviours
+        self.completion_words = completion_words
+        self.connect_latency = connect_latency
+        self.connections = 0
+        self.calls = Counter()
+        self.models = Counter()
+        self._lock = threading.Lock()
+
+    def finish_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        time.sleep(self.connect_latency)
+        super().finish_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # An app stopped by the benchmark drops its connections mid-request
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        """
+        The base URL of the server.
+        """
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, endpoint: str, status: int, model: str = None):
+        """
+        This function counts a request.
+        """
+        with self._lock:
+            self.calls[f"{endpoint} {status}"] += 1
+            if model is not None:
+                self.models[model] += 1
+
+    def start(self) -> "StubServer":
+        """
+        This function serves the requests in a background thread.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    The handler of the requests of a StubServer.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict, headers: dict = None):
+        """
+        This function sends a JSON response.
+        """
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, endpoint: str, model: str = None) -> bool:
+        """
+        This function waits for the latency of an endpoint and sends its
+        failure, if it fails. It returns True when the request failed.
+        """
+        behaviour = self.server.behaviours[endpoint]
+        time.sleep(behaviour.delay())
+        status = behaviour.failure()
+        if status is None:
+            return False
+        self.server.count(endpoint, status, model)
+        headers = {}
+        if status == 429:
+            headers["Retry-After"] = str(behaviour.retry_after)
+        self.send_json(status, {"error": {"message": "stub failure"}}, headers)
+        return True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.endswith("/audio/transcriptions"):
+            self.transcription(body)
+        elif self.path.endswith("/chat/completions"):
+            self.completion(json.loads(body))
+        elif self.path.endswith("/pages"):
+            if not self.answer("notion"):
+                self.server.count("notion", 200)
+                self.send_json(200, {"object": "page", "id": str(uuid.uuid4())})
+        elif self.path.endswith("/query"):
+            # The pages sent again are looked up first; none was kept
+            if not self.answer("notion"):
+                self.server.count("notion", 200)
+                self.send_json(200, {"object": "list", "results": []})
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def do_GET(self):
+        # The requests opening the connections of the clients (PREWARM)
+        if self.path.endswith("/models"):
+            self.server.count("models", 200)
+            self.send_json(200, {"object": "list", "data": []})
+        elif self.path.endswith("/users/me"):
+            if not self.answer("notion"):
+                self.server.count("notion", 200)
+                self.send_json(200, {"object": "user", "id": str(uuid.uuid4())})
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def do_PATCH(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not self.answer("notion"):
+            self.server.count("notion", 200)
+            self.send_json(200, {"object": "list", "results": []})
+
+    def transcription(self, body: bytes):
+        """
+        This function answers the text written in the uploaded file.
+        """
+        if self.answer("transcriptions"):
+            return
+        match = re.search(re.escape(TRANSCRIPT_MARKER) + rb"([^\x00]*)\x00", body)
+        text = match.group(1).decode("utf-8") if match else " ".join(WORDS)
+        self.server.count("transcriptions", 200)
+        self.send_json(200, {"text": text})
+
+    def completion(self, request: dict):
+        """
+        This function answers a chat completion, streamed when asked.
+        """
+        model = request.get("model")
+        if self.answer("completions", model):
+            return
+        self.server.count("completions", 200, model)
+        if request.get("response_format", {}).get("type") == "json_object":
+            content = "{}"
+            # The digest of the transcript, the only JSON answer expected whole
+            if "condense" in request["messages"][0]["content"]:
+                text = request["messages"][-1]["content"]
+                content = json.dumps(
+                    {"clean": text, "summary": text[:200], "entities": WORDS[:3]}
+                )
+        else:
+            words = random.choices(WORDS, k=self.server.completion_words)
+            content = " ".join(words)
+        # About four characters per token
+        prompt_tokens = sum(len(m["content"]) for m in request["messages"]) // 4
+        if not request.get("stream"):
+            self.send_json(
+                200,
+                {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(content) // 4,
+                        "total_tokens": prompt_tokens + len(content) // 4,
+                    },
+                },
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for word in content.split():
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word + " "},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
@@ -0,0 +1,89 @@
+"""
+Configuration of gunicorn, the production server of the app:
+    gunicorn -c gunicorn.conf.py
+
+The app is loaded once, with its config and its clients, then forked into
+GUNICORN_WORKERS processes of GUNICORN_THREADS threads each. The threads of
+the app (job workers, outbox flusher) are only started in the workers, after
+the fork. On SIGTERM, the workers stop accepting uploads and taking jobs
+from the queue, and finish the memos in progress for at most GRACEFUL_TIMEOUT
+seconds. The limits of the APIs are shared among the workers.
+"""
+import os
+import signal
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# The app served, main:app (Flask) or asgi:app with the uvicorn worker class
+wsgi_app = os.environ.get("GUNICORN_APP", "main:app")
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+# Number of processes serving the app
+workers = int(
+    os.environ.get("GUNICORN_WORKERS", os.environ.get("WEB_CONCURRENCY", "2"))
+)
+# Number of uploads each process handles at the same time
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# Number of seconds the memos in progress have to finish on a restart
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "120"))
+# Number of seconds a silent worker is given before being killed
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+preload_app = True
+accesslog = "-"
+
+
+def when_ready(server):
+    """
+    This function loads the config and the clients once, before the workers
+    are forked
+    """
+    from main import warm_up
+
+    warm_up()
+
+
+def post_worker_init(worker):
+    """
+    This function gives each worker its share of the limits of the APIs,
+    opens its connections with PREWARM, and starts its threads. The pages
+    left in the outbox by a previous run are sent right away
+    """
+    from lib.gpt import share_budgets
+    from lib.notion import share_rate
+    from main import PREWARM, ensure_flusher, ensure_workers, prewarm, stop_workers
+
+    # The limits are enforced per process, the number of workers is the one
+    # of the server (-w, WEB_CONCURRENCY or GUNICORN_WORKERS)
+    share_rate(worker.cfg.workers)
+    share_budgets(worker.cfg.workers)
+    # The ASGI app opens the connections of its asynchronous clients itself
+    if PREWARM and wsgi_app == "main:app":
+        prewarm()
+    ensure_flusher()
+    ensure_workers()
+
+    # On SIGTERM, the threads of the queue take no new job while the uploads
+    # in progress finish
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def begin_shutdown(sig, frame):
+        worker.stopping_since = time.monotonic()
+        stop_workers()
+        if callable(handle_exit):
+            handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, begin_shutdown)
+
+
+def worker_exit(server, worker):
+    """
+    This function lets the jobs of the queue in progress finish before the
+    worker exits, for the time left before the master kills it
+    """
+    from main import stop_background
+
+    stopping_since = getattr(worker, "stopping_since", time.monotonic())
+    stop_background(max(0, graceful_timeout - (time.monotonic() - stopping_since)))
@@ -0,0 +1,209 @@
+"""
+Library to split long recordings for their transcription.
+
+A long recording is cut into segments of about the same length, at the
+silences when there are some, each segment starting a little before the end
+of the previous one. The segments are transcribed separately and their texts
+stitched back together, without the words heard twice in the overlaps.
+
+Splitting needs ffmpeg and ffprobe; without them the recordings are sent
+whole.
+"""
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from dotenv import load_dotenv
+
+from lib.routing import normalize_word
+
+load_dotenv()
+
+# A recording longer than this, in seconds, or bigger than this, in bytes,
+# is split (Whisper refuses files over 25 MB)
+LONG_AUDIO_SECONDS = float(os.environ.get("LONG_AUDIO_SECONDS", "600"))
+LONG_AUDIO_BYTES = int(os.environ.get("LONG_AUDIO_MB", "20")) * 1024 * 1024
+# The target length of a segment and the overlap between two segments
+SEGMENT_SECONDS = float(os.environ.get("SEGMENT_SECONDS", "300"))
+SEGMENT_OVERLAP = float(os.environ.get("SEGMENT_OVERLAP", "2"))
+# How far from the target length a silence can be to cut there
+SILENCE_WINDOW = float(os.environ.get("SILENCE_WINDOW", "30"))
+SILENCE_NOISE = os.environ.get("SILENCE_NOISE", "-30dB")
+SILENCE_MIN_SECONDS = float(os.environ.get("SILENCE_MIN_SECONDS", "0.5"))
+# The number of words compared to find the overlap of two texts
+MAX_OVERLAP_WORDS = 40
+
+
+def can_split() -> bool:
+    """
+    This function checks if ffmpeg and ffprobe are installed.
+    """
+    return shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+
+def probe_duration(path: str) -> float:
+    """
+    This function returns the duration of a recording, in seconds.
+    """
+    output = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=duration",
+            "-of",
+            "default=noprint_wrappers=1:nokey=1",
+            path,
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return float(output.strip())
+
+
+def is_long(path: str) -> bool:
+    """
+    This function checks if a recording must be split to be transcribed.
+    """
+    if not can_split():
+        if os.path.getsize(path) > LONG_AUDIO_BYTES:
+            logging.warning("ffmpeg is not installed, %s is sent whole", path)
+        return False
+    if os.path.getsize(path) > LONG_AUDIO_BYTES:
+        return True
+    try:
+        return probe_duration(path) > LONG_AUDIO_SECONDS
+    except (subprocess.CalledProcessError, ValueError):
+        logging.warning("The duration of %s is unknown", path, exc_info=True)
+        return False
+
+
+def detect_silences(path: str) -> list:
+    """
+    This function returns the silences of a recording, as (start, end) in
+    seconds.
+    """
+    output = subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-i",
+            path,
+            "-af",
+            f"silencedetect=noise={SILENCE_NOISE}:d={SILENCE_MIN_SECONDS}",
+            "-f",
+            "null",
+            "-",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    starts = [float(x) for x in re.findall(r"silence_start: ([\d.]+)", output)]
+    ends = [float(x) for x in re.findall(r"silence_end: ([\d.]+)", output)]
+    return list(zip(starts, ends))
+
+
+def plan_segments(duration: float, silences: list) -> list:
+    """
+    This function returns the segments to cut, as (start, end) in seconds.
+    Each cut is made in the middle of the silence closest to the target
+    length, or at the target length when there is no silence around, and each
+    segment but the first starts SEGMENT_OVERLAP seconds before the cut.
+    """
+    cuts = []
+    position = 0.0
+    while duration - position > SEGMENT_SECONDS + SILENCE_WINDOW:
+        target = position + SEGMENT_SECONDS
+        middles = [
+            (start + end) / 2
+            for start, end in silences
+            if abs((start + end) / 2 - target) <= SILENCE_WINDOW
+        ]
+        cut = min(middles, key=lambda m: abs(m - target)) if middles else target
+        cuts.append(cut)
+        position = cut
+    bounds = [0.0] + cuts + [duration]
+    return [
+        (max(0.0, bounds[i] - (SEGMENT_OVERLAP if i else 0)), bounds[i + 1])
+        for i in range(len(bounds) - 1)
+    ]
+
+
+def split_audio(path: str, segments: list, directory: str) -> list:
+    """
+    This function writes each segment of a recording to its own file in a
+    directory and returns their paths.
+    """
+    paths = []
+    for i, (start, end) in enumerate(segments):
+        segment_path = os.path.join(directory, f"segment-{i:03d}.m4a")
+        # The AAC frames are copied as is, no need to encode them again
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-y",
+                "-ss",
+                f"{start:.3f}",
+                "-t",
+                f"{end - start:.3f}",
+                "-i",
+                path,
+                "-vn",
+                "-c:a",
+                "copy",
+                segment_path,
+            ],
+            check=True,
+        )
+        paths.append(segment_path)
+    return paths
+
+
+def split_recording(path: str, directory: str) -> list:
+    """
+    This function cuts a long recording at its silences into segment files
+    written in a directory, and returns their paths in order.
+    """
+    duration = probe_duration(path)
+    segments = plan_segments(duration, detect_silences(path))
+    logging.debug("Splitting %s (%.0fs) into %s", path, duration, segments)
+    return split_audio(path, segments, directory)
+
+
+def segments_directory() -> tempfile.TemporaryDirectory:
+    """
+    This function returns a temporary directory for the segments.
+    """
+    return tempfile.TemporaryDirectory(prefix="whisper-segments-")
+
+
+def merge_transcripts(texts: list) -> str:
+    """
+    This function joins the transcripts of consecutive segments, removing
+    from each one the words already at the end of the previous one.
+    """
+    merged = []
+    for text in texts:
+        words = text.split()
+        if merged:
+            tail = [normalize_word(word) for word in merged[-MAX_OVERLAP_WORDS:]]
+            head = [normalize_word(word) for word in words[:MAX_OVERLAP_WORDS]]
+            overlap = 0
+            for size in range(min(len(tail), len(head)), 0, -1):
+                if tail[-size:] == head[:size]:
+                    overlap = size
+                    break
+            words = words[overlap:]
+        merged.extend(words)
+    return " ".join(merged)
@@ -0,0 +1,198 @@
+"""
+Library to receive many voice memos at once.
+
+A batch is sent as many "file" parts of one form, or as zip archives of the
+memos. Each memo becomes a job of the queue, so that a memo already received
+is not processed again and a failed memo does not fail the others. The memos
+of a batch are processed at the same time, up to BATCH_WORKERS of them, while
+the calls to OpenAI stay bounded by its governor, and their pages all go
+through the outbox, which sends them to Notion at the pace of its rate limit.
+The memos wait in the queue until their turn comes, so that the workers of
+the queue can take them without processing them twice.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from lib.jobs import (
+    JOB_POLL_INTERVAL,
+    enqueue,
+    get_job,
+    process_job,
+    start_job,
+    wait_job,
+)
+from lib.upload import receive_stream
+
+load_dotenv()
+
+# Number of memos of a batch processed at the same time
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "4"))
+# Maximum number of memos in a batch
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "100"))
+# The extensions and content types of the archives of memos
+ARCHIVE_EXTENSIONS = {"zip"}
+ARCHIVE_MIMETYPES = {"application/zip", "application/x-zip-compressed"}
+
+
+def extension_of(filename: str) -> str:
+    """
+    This function returns the extension of a file name, in lower case.
+    """
+    return filename.rsplit(".", 1)[1].lower() if "." in filename else ""
+
+
+def extract_archive(filepath: str, directory: str, extensions: set) -> list:
+    """
+    This function writes the memos of a zip archive, the members with one of
+    the extensions, to the uploads folder, and removes the archive. It
+    returns the (name, path, hash) of each memo. The memos are extracted to a
+    scratch folder first, and moved to the uploads folder once they all are:
+    an archive failing half way leaves no memo behind.
+
+    Raises:
+        zipfile.BadZipFile: if the file is not a zip archive.
+        ValueError: if the archive holds more than BATCH_MAX_FILES memos.
+        RequestEntityTooLarge: if a memo is larger than MAX_UPLOAD_MB.
+    """
+    try:
+        with zipfile.ZipFile(filepath) as archive:
+            members = [
+                info
+                for info in archive.infolist()
+                if not info.is_dir()
+                # The resource forks added by macOS are not memos
+                and not info.filename.startswith("__MACOSX/")
+                and not os.path.basename(info.filename).startswith(".")
+                and extension_of(info.filename) in extensions
+            ]
+            if len(members) > BATCH_MAX_FILES:
+                raise ValueError(f"More than {BATCH_MAX_FILES} files")
+            uploads = []
+            scratch = tempfile.mkdtemp(prefix=".archive-", dir=directory)
+            try:
+                for info in members:
+                    with archive.open(info) as member:
+                        path, audio_hash = receive_stream(
+                            member.read, scratch, extension_of(info.filename)
+                        )
+                    uploads.append((info.filename, path, audio_hash))
+                for i, (name, path, audio_hash) in enumerate(uploads):
+                    moved = os.path.join(directory, os.path.basename(path))
+                    # The same memo twice in the archive is one file
+                    if os.path.exists(path):
+                        os.replace(path, moved)
+                    uploads[i] = (name, moved, audio_hash)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+    finally:
+        os.remove(filepath)
+    logging.debug("Extracted %s memos from %s", len(uploads), filepath)
+    return uploads
+
+
+def enqueue_batch(uploads: list, idem_key: str = None):
+    """
+    This function adds the (name, path, hash) of each memo of a batch to the
+    queue and returns the (name, job, created) of each one. With an
+    idempotency key, each memo gets the key followed by its name.
+    """
+    jobs = []
+    for name, filepath, audio_hash in uploads:
+        job_id, created = enqueue(
+            filepath,
+            audio_hash,
+            f"{idem_key}:{name}" if idem_key is not None else None,
+        )
+        jobs.append((name, get_job(job_id), created))
+    return jobs
+
+
+def process_batch(jobs: list, handler, workers: int = BATCH_WORKERS):
+    """
+    This function processes the queued jobs of a batch with the handler of
+    the queue (see lib.jobs.process_job), workers at a time. Each job is
+    taken from the queue when its turn comes, a job taken by a worker of the
+    queue in the meantime is waited for. A job failing is put back in the
+    queue without stopping the others.
+    """
+
+    def process(job):
+        started = start_job(job["id"])
+        if started is None:
+            wait_job(job["id"])
+            return
+        try:
+            process_job(handler, started)
+        except Exception:
+            logging.error("Error while processing job %s", job["id"], exc_info=True)
+
+    with ThreadPoolExecutor(max(1, workers), thread_name_prefix="batch") as executor:
+        # Each memo is measured in the trace of the request
+        futures = [
+            executor.submit(contextvars.copy_context().run, process, job)
+            for job in jobs
+        ]
+        for future in futures:
+            future.result()
+
+
+async def aprocess_batch(jobs: list, handler, workers: int = BATCH_WORKERS):
+    """
+    This function is the asynchronous version of process_batch, for a
+    handler coroutine taking a job.
+    """
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def process(job):
+        async with semaphore:
+            started = await asyncio.to_thread(start_job, job["id"])
+            if started is not None:
+                await handler(started)
+        if started is None:
+            await await_job(job["id"])
+
+    await asyncio.gather(*(process(job) for job in jobs))
+
+
+async def await_job(job_id: str) -> dict:
+    """
+    This function is the asynchronous version of lib.jobs.wait_job.
+    """
+    while True:
+        job = await asyncio.to_thread(get_job, job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+def manifest(jobs: list, rejected: list = ()) -> list:
+    """
+    This function returns the result of each memo of a batch, from the
+    (name, job, created) of its jobs, read again, and the (name, message) of
+    the files it refused.
+    """
+    entries = []
+    for name, job, created in jobs:
+        job = get_job(job["id"])
+        entries.append(
+            {
+                "file": name,
+                "job_id": job["id"],
+                "status": job["status"],
+                "duplicate": not created,
+                "result": job["result"],
+                "page_id": job["page_id"],
+            }
+        )
+    for name, message in rejected:
+        entries.append({"file": name, "status": "rejected", "error": message})
+    return entries
@@ -0,0 +1,302 @@
+"""
+Library to cache the results of the API calls.
+
+The entries are kept in memory, or stored in a SQLite file so that they
+survive a restart. Both stores are bounded: the expired entries and the least
+recently used ones are evicted when they grow over their limits.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Optional
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    This function returns the SHA-256 of the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_key(*parts) -> str:
+    """
+    This function returns a key made of the SHA-256 of JSON serializable parts.
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class MemoryCache:
+    """
+    A bounded key/value store of strings kept in memory.
+
+    Args:
+        max_entries (int): The maximum number of entries.
+        max_bytes (int): The maximum total size of the values.
+        ttl (float, optional): The number of seconds an entry is kept, None
+            to keep the entries until they are evicted.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        max_bytes: int = 50 * 1024 * 1024,
+        ttl: Optional[float] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        This function returns the value of a key, or None if it is not cached
+        or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (
+                self.ttl is None or entry[1] >= time.time() - self.ttl
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str):
+        """
+        This function stores the value of a key, then evicts the entries over
+        the limits of the store.
+        """
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[2]
+            self._entries[key] = (value, time.time(), size)
+            self.size += size
+            self.evict()
+
+    def delete(self, key: str):
+        """
+        This function removes a key from the store.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[2]
+
+    def evict(self):
+        """
+        This function removes the expired entries, then the least recently
+        used ones until the store is within its limits.
+        """
+        if self.ttl is not None:
+            limit = time.time() - self.ttl
+            for key in [k for k, entry in self._entries.items() if entry[1] < limit]:
+                self.size -= self._entries.pop(key)[2]
+                self.evictions += 1
+        while self._entries and (
+            len(self._entries) > self.max_entries or self.size > self.max_bytes
+        ):
+            self.size -= self._entries.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        This function returns the counters of the store, for monitoring.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size,
+            }
+
+
+class SQLiteCache:
+    """
+    A bounded key/value store of strings kept in a SQLite file.
+
+    Args:
+        path (str): The path of the SQLite file.
+        max_entries (int): The maximum number of entries.
+        max_bytes (int): The maximum total size of the values.
+        ttl (float, optional): The number of seconds an entry is kept, None
+            to keep the entries until they are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 1000,
+        max_bytes: int = 50 * 1024 * 1024,
+        ttl: Optional[float] = None,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        This function opens a connection to the store, creating its schema on
+        first use.
+        """
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        with self._lock:
+            if not self._ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS entries (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        created REAL NOT NULL,
+                        accessed REAL NOT NULL
+                    )
+                    """
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+                )
+                self._ready = True
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        This function returns the value of a key, or None if it is not cached
+        or expired.
+        """
+        now = time.time()
+        try:
+            with closing(self.connect()) as conn:
+                row = conn.execute(
+                    "SELECT value, created FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and (self.ttl is None or row[1] >= now - self.ttl):
+                    conn.execute(
+                        "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+                    )
+                else:
+                    row = None
+        except sqlite3.Error:
+            logging.warning(
+                "Error while reading the cache %s", self.path, exc_info=True
+            )
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row[0] if row is not None else None
+
+    def set(self, key: str, value: str):
+        """
+        This function stores the value of a key, then evicts the entries over
+        the limits of the store.
+        """
+        now = time.time()
+        try:
+            with closing(self.connect()) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, accessed)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value.encode("utf-8")), now, now),
+                )
+                self.evict(conn, now)
+        except sqlite3.Error:
+            logging.warning(
+                "Error while writing the cache %s", self.path, exc_info=True
+            )
+
+    def delete(self, key: str):
+        """
+        This function removes a key from the store.
+        """
+        with closing(self.connect()) as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def evict(self, conn: sqlite3.Connection, now: float):
+        """
+        This function removes the expired entries, then the least recently
+        used ones until the store is within its limits.
+        """
+        evicted = 0
+        if self.ttl is not None:
+            evicted += conn.execute(
+                "DELETE FROM entries WHERE created < ?", (now - self.ttl,)
+            ).rowcount
+        evicted += conn.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries"
+            " ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        evicted += conn.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM (SELECT key,"
+            " SUM(size) OVER (ORDER BY accessed DESC, key) AS total FROM entries)"
+            " WHERE total > ?)",
+            (self.max_bytes,),
+        ).rowcount
+        if evicted:
+            logging.debug("Evicted %s entries from %s", evicted, self.path)
+            with self._lock:
+                self.evictions += evicted
+
+    def stats(self) -> dict:
+        """
+        This function returns the counters of the store, for monitoring.
+        """
+        try:
+            with closing(self.connect()) as conn:
+                entries, size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+                ).fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size,
+            }
+
+
+def create_cache(backend: str, path: str, **limits):
+    """
+    This function creates a store from its name: "memory", "sqlite", or
+    "off" to disable the cache (None is returned).
+    """
+    if backend == "memory":
+        return MemoryCache(**limits)
+    if backend == "sqlite":
+        return SQLiteCache(path, **limits)
+    if backend != "off":
+        logging.warning("Unknown cache backend %s, the cache is disabled", backend)
+    return None
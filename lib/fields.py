@@ -0,0 +1,653 @@
+"""
+Library to generate the fields of a destination.
+
+Each field declares the other fields it is built from, so the fields of a
+destination form a small dependency graph. Independent fields are generated
+at the same time on a bounded pool of workers (or as concurrent tasks with
+the asynchronous version), and a field only starts once the fields it
+requires are done.
+"""
+
+import asyncio
+import contextvars
+import datetime
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pytz
+
+from lib.gpt import (
+    COMBINED_MODEL,
+    COMBINED_TEXT_REF,
+    acombined_completion,
+    adigest_completion,
+    arouted_completion,
+    astream_completion,
+    combined_completion,
+    digest_completion,
+    get_cached_completion,
+    prompt_concept,
+    prompt_draft,
+    prompt_events,
+    prompt_excerpt,
+    prompt_followup,
+    prompt_further_reading,
+    prompt_goals,
+    prompt_improvements,
+    prompt_interpretation,
+    prompt_keywords,
+    prompt_mood,
+    prompt_name,
+    prompt_preparation,
+    prompt_recommandations,
+    prompt_results,
+    prompt_target_audience,
+    prompt_tasks,
+    prompt_title,
+    routed_completion,
+    set_cached_completion,
+    stream_completion,
+)
+from lib.metrics import FIELD_SECONDS, stage, timed
+from lib.models import DEFAULT_ROUTES, ModelRoutes
+from lib.tokens import truncate
+from lib.usage import labelled
+
+# Maximum number of fields generated at the same time
+FIELD_WORKERS = int(os.environ.get("FIELD_WORKERS", "6"))
+# Fill the independent GPT fields with a single completion by default
+COMBINED_FIELDS = os.environ.get("COMBINED_FIELDS", "false").lower() == "true"
+
+# The node of the digest of the transcript in the graph of the fields
+DIGEST = "(digest)"
+# The views of the digest a field can be built from
+DIGEST_VIEWS = ("summary", "clean")
+
+
+def current_date() -> str:
+    """
+    This function returns the current date in iso8601 format, in the
+    timezone set by the TIME_ZONE environment variable.
+    """
+    timezone = pytz.timezone(os.environ.get("TIME_ZONE", "UTC"))
+    return datetime.datetime.now(timezone).isoformat()
+
+
+# A field is described by:
+# - type: the Notion property type of the value
+# - requires: the fields that must be generated before this one
+# - prompt: for the fields written by GPT, a function taking
+#   (text, language, values) and returning the prompt of the field, where
+#   values holds the already generated fields
+# - value: for the other fields, a function with the same arguments
+#   returning the value itself
+Field = namedtuple("Field", ["type", "requires", "prompt", "value"])
+
+
+def gpt_field(field_type: str, requires: tuple, prompt) -> Field:
+    """
+    This function describes a field written by GPT.
+    """
+    return Field(field_type, requires, prompt, None)
+
+
+def local_field(field_type: str, value) -> Field:
+    """
+    This function describes a field computed without calling GPT.
+    """
+    return Field(field_type, (), None, value)
+
+
+FIELDS = {
+    "Concept": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_concept(text, lang)
+    ),
+    "Date": local_field("date", lambda text, lang, v: {"start": current_date()}),
+    "Draft": gpt_field(
+        "rich_text",
+        ("Target", "Keywords"),
+        lambda text, lang, v: prompt_draft(text, v["Target"], v["Keywords"], lang),
+    ),
+    "Events": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_events(text, lang)
+    ),
+    "Excerpt": gpt_field(
+        "rich_text",
+        ("Keywords",),
+        lambda text, lang, v: prompt_excerpt(text, v["Keywords"], lang),
+    ),
+    "Followup": gpt_field(
+        "rich_text",
+        ("Tasks",),
+        lambda text, lang, v: prompt_followup(v["Tasks"], lang),
+    ),
+    "Goals": gpt_field("rich_text", (), lambda text, lang, v: prompt_goals(text, lang)),
+    "Improvements": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_improvements(text, lang)
+    ),
+    "Input": local_field("rich_text", lambda text, lang, v: text),
+    "Interpretation": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_interpretation(text, lang)
+    ),
+    "Keywords": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_keywords(text, lang)
+    ),
+    "Mood": gpt_field("rich_text", (), lambda text, lang, v: prompt_mood(text, lang)),
+    "Name": gpt_field("title", (), lambda text, lang, v: prompt_name(text, lang)),
+    "Preparation": gpt_field(
+        "rich_text",
+        ("Tasks",),
+        lambda text, lang, v: prompt_preparation(v["Tasks"], lang),
+    ),
+    "Reading": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_further_reading(text, lang)
+    ),
+    "Recommendations": gpt_field(
+        "rich_text",
+        ("Mood", "Events"),
+        lambda text, lang, v: prompt_recommandations(v["Mood"], v["Events"], lang),
+    ),
+    "Results": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_results(text, lang)
+    ),
+    "Target": gpt_field(
+        "rich_text", (), lambda text, lang, v: prompt_target_audience(text, lang)
+    ),
+    "Tasks": gpt_field("rich_text", (), lambda text, lang, v: prompt_tasks(text, lang)),
+    "Title": gpt_field("title", (), lambda text, lang, v: prompt_title(text, lang)),
+    # Todo: call the weather API
+    # https://api.openweathermap.org/data/3.0/onecall
+    # /day_summary?lat={lat}
+    # &lon={lon}&date={date}&tz={tz}&appid={API key}
+    "Weather": local_field("rich_text", lambda text, lang, v: "No implementation yet"),
+}
+
+# Unknown fields receive the text as is
+DEFAULT_FIELD = local_field("rich_text", lambda text, lang, v: text)
+
+
+def get_field(name: str) -> Field:
+    """
+    This function returns the description of a field, falling back to a
+    simple copy of the text for the unknown ones.
+    """
+    return FIELDS.get(name, DEFAULT_FIELD)
+
+
+def resolve_fields(fields: list) -> list:
+    """
+    This function returns the fields to generate, in an order where each
+    field comes after the fields it requires. The required fields missing
+    from the list are added automatically.
+
+    Raises:
+        ValueError: if the fields depend on each other in a cycle.
+    """
+    order = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            cycle = " -> ".join(path + [name])
+            raise ValueError(f"Cyclic dependency between fields: {cycle}")
+        state[name] = "visiting"
+        for required in get_field(name).requires:
+            visit(required, path + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for field in fields:
+        visit(field, [])
+    return order
+
+
+def digest_views(digest) -> dict:
+    """
+    This function returns the view of the digest each field is built from,
+    from the "digest" setting of a destination: a list of fields, built from
+    the summary, or the view of each field ("summary" or "clean").
+    """
+    if not digest:
+        return {}
+    if not isinstance(digest, dict):
+        digest = {name: "summary" for name in digest}
+    views = {}
+    for name, view in digest.items():
+        if view not in DIGEST_VIEWS:
+            logging.warning("Unknown view of the digest for %s: %s", name, view)
+            view = "summary"
+        views[name] = view
+    return views
+
+
+def requirements(name: str, views: dict) -> tuple:
+    """
+    This function returns the nodes a field waits for: the fields it
+    requires, and the digest when it is built from it.
+    """
+    requires = get_field(name).requires
+    return requires + (DIGEST,) if name in views else requires
+
+
+def digest_text(text: str, digest, view: str) -> str:
+    """
+    This function returns a view of the digest of a transcript, or the
+    transcript when there is no digest or the field has no view of it.
+    """
+    if digest is None or view is None:
+        return text
+    if view == "clean":
+        return digest["clean"]
+    entities = ", ".join(digest["entities"])
+    return digest["summary"] + (f"\n\nKey entities: {entities}" if entities else "")
+
+
+def generate_digest(text: str, language: str, use_cache: bool = True):
+    """
+    This function condenses the transcript for the fields built from its
+    digest, or returns None when it failed.
+    """
+    with stage("digest"), labelled(field=DIGEST):
+        return digest_completion(text, language, use_cache)
+
+
+async def agenerate_digest(text: str, language: str, use_cache: bool = True):
+    """
+    This function is the asynchronous version of generate_digest.
+    """
+    with stage("digest"), labelled(field=DIGEST):
+        return await adigest_completion(text, language, use_cache)
+
+
+def field_text(name: str, text: str, language: str, values: dict, digest) -> str:
+    """
+    This function returns the text a field is built from: the view of the
+    digest it opted into, computed when it is not in the values yet, or the
+    transcript.
+    """
+    views = digest_views(digest)
+    if name not in views:
+        return text
+    if DIGEST not in values:
+        values[DIGEST] = generate_digest(text, language)
+    return digest_text(text, values[DIGEST], views[name])
+
+
+async def afield_text(name: str, text: str, language: str, values: dict, digest):
+    """
+    This function is the asynchronous version of field_text.
+    """
+    views = digest_views(digest)
+    if name not in views:
+        return text
+    if DIGEST not in values:
+        values[DIGEST] = await agenerate_digest(text, language)
+    return digest_text(text, values[DIGEST], views[name])
+
+
+def budget_prompt(name: str, text: str, language: str, values: dict, routes):
+    """
+    This function builds the prompt of a GPT field with the text cut to the
+    budget the routes give it, and returns it with the number of tokens
+    removed from the text.
+    """
+    prompt = get_field(name).prompt
+    short, truncated = truncate(text, routes.budget(name))
+    messages = prompt(short, language, values)
+    if truncated and messages == prompt(text, language, values):
+        # The field is built from other fields, not from the text
+        truncated = 0
+    elif truncated:
+        logging.debug("%s tokens of the text are not sent to %s", truncated, name)
+    return messages, truncated
+
+
+def generate_field(
+    name: str,
+    text: str,
+    language: str,
+    values: dict,
+    routes: ModelRoutes = None,
+    use_cache: bool = True,
+):
+    """
+    This function generates the value of one field, from the text and the
+    values of the fields it requires, with the models the routes give it.
+    Without use_cache, the field is generated again even when it is cached.
+    """
+    field = get_field(name)
+    if field.prompt is None:
+        return field.value(text, language, values)
+    routes = routes or DEFAULT_ROUTES
+    (system_msg, user_msg, model), truncated = budget_prompt(
+        name, text, language, values, routes
+    )
+    models = routes.chain(name, model)
+    with timed(FIELD_SECONDS, "field", field=name):
+        with labelled(field=name, truncated=truncated):
+            return routed_completion(system_msg, user_msg, models, use_cache)
+
+
+async def agenerate_field(
+    name: str,
+    text: str,
+    language: str,
+    values: dict,
+    routes: ModelRoutes = None,
+    use_cache: bool = True,
+):
+    """
+    This function is the asynchronous version of generate_field.
+    """
+    field = get_field(name)
+    if field.prompt is None:
+        return field.value(text, language, values)
+    routes = routes or DEFAULT_ROUTES
+    (system_msg, user_msg, model), truncated = budget_prompt(
+        name, text, language, values, routes
+    )
+    models = routes.chain(name, model)
+    with timed(FIELD_SECONDS, "field", field=name):
+        with labelled(field=name, truncated=truncated):
+            return await arouted_completion(system_msg, user_msg, models, use_cache)
+
+
+def split_streamed(fields: list, stream: list):
+    """
+    This function returns the fields which can be streamed among the wanted
+    ones, the GPT fields no other field requires, with the fields to generate
+    before them.
+    """
+    others = [name for name in fields if name not in stream]
+    required = set(resolve_fields(others))
+    streamed = [
+        name
+        for name in fields
+        if name in stream
+        and get_field(name).prompt is not None
+        and name not in required
+    ]
+    before = [name for name in fields if name not in streamed]
+    for name in streamed:
+        before += [r for r in get_field(name).requires if r not in before]
+    return streamed, before
+
+
+def stream_field(
+    name: str, text: str, language: str, values: dict, routes: ModelRoutes = None
+):
+    """
+    This function yields the value of a GPT field as it is generated, from
+    the text and the values of the fields it requires. It is generated by the
+    first model the routes give it.
+    """
+    routes = routes or DEFAULT_ROUTES
+    (system_msg, user_msg, model), truncated = budget_prompt(
+        name, text, language, values, routes
+    )
+    model = routes.chain(name, model)[0]
+    with timed(FIELD_SECONDS, "field", field=name):
+        with labelled(field=name, truncated=truncated):
+            yield from stream_completion(system_msg, user_msg, model)
+
+
+async def astream_field(
+    name: str, text: str, language: str, values: dict, routes: ModelRoutes = None
+):
+    """
+    This function is the asynchronous version of stream_field.
+    """
+    routes = routes or DEFAULT_ROUTES
+    (system_msg, user_msg, model), truncated = budget_prompt(
+        name, text, language, values, routes
+    )
+    model = routes.chain(name, model)[0]
+    with timed(FIELD_SECONDS, "field", field=name):
+        with labelled(field=name, truncated=truncated):
+            async for token in astream_completion(system_msg, user_msg, model):
+                yield token
+
+
+def prepare_combined(
+    order: list,
+    text: str,
+    language: str,
+    routes: ModelRoutes = None,
+    views=None,
+    use_cache: bool = True,
+):
+    """
+    This function returns the values of the GPT fields which do not require
+    other fields and are already cached, with the prompts of the other ones,
+    to be filled by a combined completion. The prompts are keyed by field
+    name as (prompt of the field, prompt for the combined completion).
+
+    A field is looked up in the cache under the first model the routes give
+    it, as if it were generated separately, then under COMBINED_MODEL, as a
+    combined completion stores it (see store_combined). The fields built from
+    the digest (views), or from less of the text than the whole of it (their
+    budget), are left to be generated separately: the combined completion
+    gets the whole text.
+    Without use_cache, every field goes to the combined completion.
+    """
+    routes = routes or DEFAULT_ROUTES
+    values = {}
+    prompts = {}
+    for name in order:
+        field = get_field(name)
+        if field.prompt is None or field.requires or name in (views or {}):
+            continue
+        prompt, truncated = budget_prompt(name, text, language, {}, routes)
+        if truncated:
+            continue
+        prompt = prompt._replace(model=routes.chain(name, prompt.model)[0])
+        content = None
+        for model in (prompt.model, COMBINED_MODEL) if use_cache else ():
+            content = get_cached_completion(*prompt._replace(model=model))
+            if content is not None:
+                break
+        if content is not None:
+            values[name] = content
+        else:
+            prompts[name] = (prompt, field.prompt(COMBINED_TEXT_REF, language, {}))
+    # A single field gains nothing from being combined
+    return values, prompts if len(prompts) > 1 else {}
+
+
+def store_combined(prompts: dict, values: dict) -> dict:
+    """
+    This function caches the fields filled by a combined completion with the
+    prompts of the fields, so that adding a field to a destination does not
+    generate the others again. They are cached under COMBINED_MODEL, the
+    model which wrote them, not under the models of the fields.
+    """
+    for name, content in values.items():
+        set_cached_completion(*prompts[name][0]._replace(model=COMBINED_MODEL), content)
+    logging.debug("Combined fields: %s", list(values))
+    return values
+
+
+def combine_fields(
+    order: list,
+    text: str,
+    language: str,
+    routes: ModelRoutes = None,
+    views=None,
+    use_cache: bool = True,
+) -> dict:
+    """
+    This function fills the GPT fields which do not require other fields with
+    a single completion, and returns the ones correctly filled (see
+    prepare_combined).
+    """
+    values, prompts = prepare_combined(order, text, language, routes, views, use_cache)
+    if prompts:
+        with labelled(field="(combined)"):
+            combined = combined_completion(
+                {name: prompt[1] for name, prompt in prompts.items()}, text
+            )
+        values.update(store_combined(prompts, combined))
+    return values
+
+
+async def acombine_fields(
+    order: list,
+    text: str,
+    language: str,
+    routes: ModelRoutes = None,
+    views=None,
+    use_cache: bool = True,
+) -> dict:
+    """
+    This function is the asynchronous version of combine_fields.
+    """
+    values, prompts = await asyncio.to_thread(
+        prepare_combined, order, text, language, routes, views, use_cache
+    )
+    if prompts:
+        with labelled(field="(combined)"):
+            combined = await acombined_completion(
+                {name: prompt[1] for name, prompt in prompts.items()}, text
+            )
+        values.update(await asyncio.to_thread(store_combined, prompts, combined))
+    return values
+
+
+def generate_fields(
+    text: str,
+    fields: list,
+    language: str,
+    max_workers: int = FIELD_WORKERS,
+    combined: bool = None,
+    routes: ModelRoutes = None,
+    digest=None,
+    use_cache: bool = True,
+) -> dict:
+    """
+    This function generates the values of the given fields and of the fields
+    they require. Fields whose requirements are met run at the same time,
+    with at most max_workers of them in flight.
+
+    In combined mode, the independent GPT fields are first filled by a single
+    completion, and only the ones missing from its answer are generated
+    separately (see prepare_combined).
+
+    The routes choose the models of the fields, the models of their prompts
+    are used without them. The fields of the digest setting (see
+    digest_views) are built from the digest of the text, computed once
+    before them, instead of the text.
+
+    Without use_cache, the fields and the digest are generated again even when
+    they are cached (a backfill after a prompt was fixed).
+
+    Returns:
+        dict: the value of every generated field, keyed by field name, with
+        the digest under DIGEST when it was computed.
+    """
+    views = digest_views(digest)
+    order = resolve_fields(fields)
+    values = {}
+    if COMBINED_FIELDS if combined is None else combined:
+        values = combine_fields(order, text, language, routes, views, use_cache)
+    pending = [name for name in order if name not in values]
+    if any(name in views for name in pending):
+        pending.insert(0, DIGEST)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            # Start every field whose requirements are all generated
+            for name in list(pending):
+                if all(required in values for required in requirements(name, views)):
+                    pending.remove(name)
+                    logging.debug("Generating the field: %s", name)
+                    # The field is measured in the trace of the request
+                    context = contextvars.copy_context()
+                    if name == DIGEST:
+                        future = executor.submit(
+                            context.run, generate_digest, text, language, use_cache
+                        )
+                    else:
+                        future = executor.submit(
+                            context.run,
+                            generate_field,
+                            name,
+                            digest_text(text, values.get(DIGEST), views.get(name)),
+                            language,
+                            dict(values),
+                            routes,
+                            use_cache,
+                        )
+                    running[future] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    values[name] = future.result()
+                except Exception:
+                    logging.error("Error while generating %s", name, exc_info=True)
+                    for other in running:
+                        other.cancel()
+                    raise
+    return values
+
+
+async def agenerate_fields(
+    text: str,
+    fields: list,
+    language: str,
+    max_workers: int = FIELD_WORKERS,
+    combined: bool = None,
+    routes: ModelRoutes = None,
+    digest=None,
+    use_cache: bool = True,
+) -> dict:
+    """
+    This function is the asynchronous version of generate_fields. Each field
+    is a task waiting for the tasks of the fields it requires, and of the
+    digest when it is built from it.
+    """
+    views = digest_views(digest)
+    order = resolve_fields(fields)
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+    tasks = {}
+    values = {}
+    if COMBINED_FIELDS if combined is None else combined:
+        values = await acombine_fields(order, text, language, routes, views, use_cache)
+
+    async def run(name):
+        if name in values:
+            return values[name]
+        requires = requirements(name, views)
+        results = await asyncio.gather(*(tasks[required] for required in requires))
+        results = dict(zip(requires, results))
+        async with semaphore:
+            logging.debug("Generating the field: %s", name)
+            if name == DIGEST:
+                return await agenerate_digest(text, language, use_cache)
+            return await agenerate_field(
+                name,
+                digest_text(text, results.get(DIGEST), views.get(name)),
+                language,
+                results,
+                routes,
+                use_cache,
+            )
+
+    if any(name in views and name not in values for name in order):
+        order = [DIGEST] + order
+    # The order makes sure the tasks of the required fields already exist
+    for name in order:
+        tasks[name] = asyncio.ensure_future(run(name))
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except Exception:
+        logging.error("Error while generating the fields", exc_info=True)
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return dict(zip(tasks.keys(), results))
@@ -1,33 +1,257 @@
 """
 Library to handle OpenAPI GPT API calls.
+
+Every call exists in a synchronous flavour, used by the Flask app, and an
+asynchronous one (prefixed with "a"), used by the ASGI app. Both share the
+same prompts and the same handling of the responses.
 """
 
 # Import necessary modules
 # from typing import Optional
 # from dataclasses import dataclass, asdict
 
+import asyncio
+import contextvars
+import json
 import logging
 import os
-import requests
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from dotenv import load_dotenv
-from openai import OpenAI, OpenAIError
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AsyncOpenAI,
+    OpenAI,
+    OpenAIError,
+)
+
+from lib.audio import is_long, merge_transcripts, segments_directory, split_recording
+from lib.cache import SQLiteCache, create_cache, hash_file, hash_key
+from lib.metrics import OPENAI_TOKENS, register
+from lib.models import tracker
+from lib.ratelimit import Governor, retry_after
+from lib.tokens import count_tokens
+from lib.usage import spend
 
 load_dotenv()
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-MAX_RETRIES = 3
+# The clients of OpenAI, created on first use (see get_openai_client)
+_clients = {}
+_clients_lock = threading.Lock()
+MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "5"))
+# Number of times a call is made again before falling back to the next model
+FALLBACK_RETRIES = int(os.environ.get("OPENAI_FALLBACK_RETRIES", "1"))
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# The model and the optional language (ISO-639-1) of the transcriptions
+TRANSCRIBE_MODEL = os.environ.get("TRANSCRIBE_MODEL", "whisper-1")
+TRANSCRIBE_LANGUAGE = os.environ.get("TRANSCRIBE_LANGUAGE") or None
+# The number of segments of a long recording transcribed at the same time
+TRANSCRIBE_WORKERS = int(os.environ.get("TRANSCRIBE_WORKERS", "4"))
+
+# The transcripts are cached by the hash of the audio, so that an upload sent
+# again does not call Whisper again
+TRANSCRIPT_CACHE = (
+    SQLiteCache(
+        os.environ.get("TRANSCRIPT_CACHE_PATH", SCRIPT_DIR + "/transcripts.sqlite3"),
+        max_entries=int(os.environ.get("TRANSCRIPT_CACHE_MAX_ENTRIES", "1000")),
+        max_bytes=int(os.environ.get("TRANSCRIPT_CACHE_MAX_MB", "50")) * 1024 * 1024,
+        ttl=float(os.environ.get("TRANSCRIPT_CACHE_TTL_DAYS", "30")) * 86400,
+    )
+    if os.environ.get("TRANSCRIPT_CACHE", "true").lower() == "true"
+    else None
+)
+
+# The completions are cached by the hash of their model and messages:
+# "sqlite" (kept across restarts), "memory" or "off"
+COMPLETION_CACHE = create_cache(
+    os.environ.get("COMPLETION_CACHE", "sqlite").lower(),
+    os.environ.get("COMPLETION_CACHE_PATH", SCRIPT_DIR + "/completions.sqlite3"),
+    max_entries=int(os.environ.get("COMPLETION_CACHE_MAX_ENTRIES", "10000")),
+    max_bytes=int(os.environ.get("COMPLETION_CACHE_MAX_MB", "100")) * 1024 * 1024,
+    ttl=float(os.environ.get("COMPLETION_CACHE_TTL_DAYS", "90")) * 86400,
+)
+
+
+def parse_budgets(value: str) -> dict:
+    """
+    This function parses a list of budgets per model, such as
+    "gpt-4-1106-preview=150000,gpt-3.5-turbo-1106=160000".
+    """
+    budgets = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, budget = item.split("=", 1)
+            budgets[model.strip()] = int(budget)
+    return budgets
+
 
-# Set loggin config
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    filename=os.environ.get("LOG_PATH"),
-    filemode="w",
+def classify_error(error: Exception):
+    """
+    This function tells whether a failed OpenAI call is worth making again,
+    whether it was throttled, and the delay asked by the API.
+    """
+    if isinstance(error, APIStatusError):
+        headers = error.response.headers
+        delay = retry_after(headers)
+        if delay is None and headers.get("retry-after-ms"):
+            delay = float(headers["retry-after-ms"]) / 1000
+        throttled = error.status_code == 429
+        return throttled or error.status_code >= 500, throttled, delay
+    if isinstance(
+        error, (APIConnectionError, APITimeoutError, requests.exceptions.Timeout)
+    ):
+        return True, False, None
+    return False, False, None
+
+
+# The budget of tokens per minute of some models, such as
+# "gpt-4-1106-preview=150000"
+OPENAI_TPM = parse_budgets(os.environ.get("OPENAI_TPM", ""))
+
+# Every call to OpenAI goes through the governor: per model, it limits the
+# calls in flight (halving the limit when OpenAI throttles them), keeps the
+# tokens sent under a budget per minute, and retries with a backoff
+governor = Governor(
+    "openai",
+    concurrency=int(os.environ.get("OPENAI_CONCURRENCY", "4")),
+    max_concurrency=int(os.environ.get("OPENAI_MAX_CONCURRENCY", "16")),
+    tokens_per_minute=OPENAI_TPM,
+    max_retries=MAX_RETRIES,
+    classify=classify_error,
 )
 
 
-def transcribe(audio_file_path: str) -> str:
+def share_budgets(workers: int):
+    """
+    This function gives the process its share of the budgets of tokens per
+    minute, when they are spent by workers processes at the same time.
+    """
+    governor.set_budgets(
+        {model: budget // max(1, workers) for model, budget in OPENAI_TPM.items()}
+    )
+
+
+# The messages and the model of a completion
+Prompt = namedtuple("Prompt", ["system_msg", "user_msg", "model"])
+
+# The model filling several fields with a single completion
+COMBINED_MODEL = os.environ.get("COMBINED_MODEL", "gpt-4-1106-preview")
+# The completions answering with a JSON object
+JSON_FORMAT = {"type": "json_object"}
+# What the prompts of a combined completion refer to instead of the text
+COMBINED_TEXT_REF = "the text given by the user"
+# The model condensing a transcript into the digest some fields are built from
+DIGEST_MODEL = os.environ.get("DIGEST_MODEL", "gpt-3.5-turbo-1106")
+
+
+def get_openai_client(asynchronous: bool = False):
+    """
+    This function returns the client of OpenAI shared by the whole process,
+    or its asynchronous version, created on first use.
+    """
+    client = _clients.get(asynchronous)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(asynchronous)
+            if client is None:
+                # The retries are made by the governor, not by the client
+                client = (AsyncOpenAI if asynchronous else OpenAI)(
+                    api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0
+                )
+                _clients[asynchronous] = client
+    return client
+
+
+def prewarm_openai() -> bool:
+    """
+    This function opens a connection of the pool of the client of OpenAI,
+    with a call listing the models, and returns whether it succeeded.
+    """
+    try:
+        get_openai_client().models.list()
+    except OpenAIError:
+        logging.warning("The connection to OpenAI could not be opened", exc_info=True)
+        return False
+    return True
+
+
+async def aprewarm_openai() -> bool:
+    """
+    This function is the asynchronous version of prewarm_openai.
+    """
+    try:
+        await get_openai_client(True).models.list()
+    except OpenAIError:
+        logging.warning("The connection to OpenAI could not be opened", exc_info=True)
+        return False
+    return True
+
+
+def check_api_key():
+    """
+    This function raises an error if the OpenAI API key is not set.
+    """
+    if not os.environ.get("OPENAI_API_KEY"):
+        logging.error("OPENAI_API_KEY environment variable is not set", exc_info=True)
+        raise ValueError("OPENAI_API_KEY environment variable is not set.")
+
+
+def save_transcript(audio_file_path: str, text: str) -> str:
+    """
+    This function saves the transcript next to the audio file and returns it.
+    """
+    # Create a file path for the transcript from the audio file path
+    transcript_file_path = audio_file_path.replace(".m4a", ".txt")
+
+    # Save the transcript to a file
+    with open(transcript_file_path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+    logging.debug("Transcription: %s", text)
+    return text
+
+
+def transcript_cache_key(audio_hash: str, language) -> str:
+    """
+    This function returns the key of a transcript in the cache.
+    """
+    return f"{audio_hash}:{TRANSCRIBE_MODEL}:{language or ''}"
+
+
+def cached_transcript(audio_file_path: str, language, audio_hash):
+    """
+    This function returns the cache key of an audio file with its cached
+    transcript, or None when it is not cached.
+    """
+    if TRANSCRIPT_CACHE is None:
+        return None, None
+    if audio_hash is None:
+        audio_hash = hash_file(audio_file_path)
+    key = transcript_cache_key(audio_hash, language)
+    return key, TRANSCRIPT_CACHE.get(key)
+
+
+def store_transcript(audio_file_path: str, key, text: str) -> str:
+    """
+    This function caches the transcript of an audio file under its key, when
+    the cache is on, and saves it next to the file.
+    """
+    if key is not None:
+        TRANSCRIPT_CACHE.set(key, text)
+    return save_transcript(audio_file_path, text)
+
+
+def transcribe(
+    audio_file_path: str, language: str = TRANSCRIBE_LANGUAGE, audio_hash: str = None
+) -> str:
     """
     This function takes a file path as an argument, reads the content
     of the file, and calls the OpenAI Whisper API to generate a response.
@@ -35,32 +259,288 @@ def transcribe(audio_file_path: str) -> str:
 
     Args:
         audio_file_path (str): The path to the file.
+        language (str, optional): The language of the audio, in ISO-639-1.
+        audio_hash (str, optional): The SHA-256 of the file, when it is
+            already known.
 
     Returns:
         str: The generated response from the OpenAI Whisper API.
     """
-    if not os.environ.get("OPENAI_API_KEY"):
-        logging.error("OPENAI_API_KEY environment variable is not set", exc_info=True)
-        raise ValueError("OPENAI_API_KEY environment variable is not set.")
+    check_api_key()
 
-    audio_file = open(audio_file_path, "rb")
-    transcript = client.audio.transcriptions.create(model="whisper-1", file=audio_file)
+    key, text = cached_transcript(audio_file_path, language, audio_hash)
+    if text is not None:
+        logging.debug("The transcript of %s is cached", audio_file_path)
+        return save_transcript(audio_file_path, text)
 
-    audio_file.close()
+    options = {"language": language} if language else {}
+    if is_long(audio_file_path):
+        text = transcribe_segments(audio_file_path, options)
+    else:
+        text = whisper(audio_file_path, options)
+    return store_transcript(audio_file_path, key, text)
 
-    # Create a file path for the transcript from the audio file path
-    transcript_file_path = audio_file_path.replace(".m4a", ".txt")
 
-    # Save the transcript to a file
-    with open(transcript_file_path, "w", encoding="utf-8") as f:
-        f.write(transcript.text)
+async def atranscribe(
+    audio_file_path: str, language: str = TRANSCRIBE_LANGUAGE, audio_hash: str = None
+) -> str:
+    """
+    This function is the asynchronous version of transcribe.
+    """
+    check_api_key()
+
+    key, text = await asyncio.to_thread(
+        cached_transcript, audio_file_path, language, audio_hash
+    )
+    if text is not None:
+        logging.debug("The transcript of %s is cached", audio_file_path)
+        return await asyncio.to_thread(save_transcript, audio_file_path, text)
 
-    logging.info("Transcription: %s", transcript.text)
-    return transcript.text
+    options = {"language": language} if language else {}
+    if await asyncio.to_thread(is_long, audio_file_path):
+        text = await atranscribe_segments(audio_file_path, options)
+    else:
+        text = await awhisper(audio_file_path, options)
+    return await asyncio.to_thread(store_transcript, audio_file_path, key, text)
+
+
+def whisper(audio_file_path: str, options: dict) -> str:
+    """
+    This function sends an audio file to Whisper and returns its text.
+    """
+
+    def send():
+        with open(audio_file_path, "rb") as audio_file:
+            return get_openai_client().audio.transcriptions.create(
+                model=TRANSCRIBE_MODEL, file=audio_file, **options
+            )
+
+    return governor.call(TRANSCRIBE_MODEL, send).text
+
+
+async def awhisper(audio_file_path: str, options: dict) -> str:
+    """
+    This function is the asynchronous version of whisper.
+    """
+
+    async def asend():
+        with open(audio_file_path, "rb") as audio_file:
+            return await get_openai_client(True).audio.transcriptions.create(
+                model=TRANSCRIBE_MODEL, file=audio_file, **options
+            )
+
+    return (await governor.acall(TRANSCRIBE_MODEL, asend)).text
+
+
+def transcribe_segments(audio_file_path: str, options: dict) -> str:
+    """
+    This function splits a long recording into segments, transcribes them
+    at the same time and returns the stitched text.
+    """
+    with segments_directory() as directory:
+        paths = split_recording(audio_file_path, directory)
+        logging.info("Transcribing %s in %s segments", audio_file_path, len(paths))
+        with ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS) as executor:
+            texts = list(
+                executor.map(
+                    lambda path: contextvars.copy_context().run(whisper, path, options),
+                    paths,
+                )
+            )
+    return merge_transcripts(texts)
+
+
+async def atranscribe_segments(audio_file_path: str, options: dict) -> str:
+    """
+    This function is the asynchronous version of transcribe_segments.
+    """
+    semaphore = asyncio.Semaphore(TRANSCRIBE_WORKERS)
+
+    async def atranscribe_segment(path):
+        async with semaphore:
+            return await awhisper(path, options)
+
+    with segments_directory() as directory:
+        paths = await asyncio.to_thread(split_recording, audio_file_path, directory)
+        logging.info("Transcribing %s in %s segments", audio_file_path, len(paths))
+        texts = await asyncio.gather(*(atranscribe_segment(path) for path in paths))
+    return merge_transcripts(texts)
+
+
+def cache_stats() -> dict:
+    """
+    This function returns the counters of the caches, for monitoring.
+    """
+    return {
+        "transcripts": TRANSCRIPT_CACHE.stats() if TRANSCRIPT_CACHE else None,
+        "completions": COMPLETION_CACHE.stats() if COMPLETION_CACHE else None,
+    }
+
+
+def openai_stats() -> dict:
+    """
+    This function returns the metrics of the calls to OpenAI, with the recent
+    average latency of each model, for monitoring.
+    """
+    return {
+        model: {**stats, "latency": tracker.latency(model)}
+        for model, stats in governor.stats().items()
+    }
+
+
+@register
+def collect_metrics() -> list:
+    """
+    This function returns the counters of the calls to OpenAI and of the
+    caches, for the metrics.
+    """
+    models = governor.stats()
+    caches = {name: stats for name, stats in cache_stats().items() if stats}
+    return [
+        (
+            f"openai_{name}_total",
+            "counter",
+            f"{description}, by model.",
+            [({"model": model}, stats[name]) for model, stats in models.items()],
+        )
+        for name, description in (
+            ("calls", "Calls made"),
+            ("retries", "Calls made again"),
+            ("throttled", "Calls throttled"),
+            ("failures", "Calls failed"),
+        )
+    ] + [
+        (
+            "openai_concurrency_limit",
+            "gauge",
+            "Limit of the calls in flight of each model.",
+            [
+                ({"model": model}, stats["concurrency_limit"])
+                for model, stats in models.items()
+            ],
+        ),
+        (
+            "cache_requests_total",
+            "counter",
+            "Lookups of each cache, by result.",
+            [
+                ({"cache": cache, "result": result}, stats[key])
+                for cache, stats in caches.items()
+                for result, key in (("hit", "hits"), ("miss", "misses"))
+            ],
+        ),
+    ]
+
+
+def completion_cache_key(system_msg: str, user_msg: str, model: str) -> str:
+    """
+    This function returns the key of a completion in the cache.
+    """
+    return hash_key(model, build_messages(system_msg, user_msg))
+
+
+def get_cached_completion(system_msg: str, user_msg: str, model: str):
+    """
+    This function returns the cached content of a completion, or None.
+    """
+    if COMPLETION_CACHE is None:
+        return None
+    return COMPLETION_CACHE.get(completion_cache_key(system_msg, user_msg, model))
+
+
+def set_cached_completion(system_msg: str, user_msg: str, model: str, content: str):
+    """
+    This function stores the content of a completion in the cache.
+    """
+    if COMPLETION_CACHE is not None:
+        COMPLETION_CACHE.set(completion_cache_key(system_msg, user_msg, model), content)
+
+
+def build_messages(system_msg: str, user_msg: str) -> list:
+    """
+    This function builds the messages of a chat completion.
+    """
+    return [
+        {
+            "role": "system",
+            "content": system_msg,
+        },
+        {
+            "role": "user",
+            "content": user_msg,
+        },
+    ]
+
+
+def estimate_tokens(*texts: str) -> int:
+    """
+    This function counts the tokens of some texts, before they are sent.
+    """
+    return sum(count_tokens(text) for text in texts)
+
+
+def record_usage(model: str, response, system_msg: str, user_msg: str, content=""):
+    """
+    This function counts the tokens of a completion, in the metrics and in the
+    ledger, from its usage or, for a stream which has none, from its messages
+    and its content.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        prompt, answer = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt, answer = estimate_tokens(system_msg, user_msg), estimate_tokens(content)
+    OPENAI_TOKENS.inc(prompt, model=model, direction="prompt")
+    OPENAI_TOKENS.inc(answer, model=model, direction="completion")
+    spend(model, prompt, answer)
+
+
+def extract_content(response) -> str:
+    """
+    This function extracts the content from a chat completion response and
+    removes double quotes from it.
+    """
+    content = response.choices[0].message.content if response.choices else ""
+
+    # Remove double quotes from the content
+    logging.debug("The content is: %s", content)
+    return content.replace('"', "")
+
+
+def chat(asynchronous: bool, system_msg: str, user_msg: str, model: str, **options):
+    """
+    This function returns the function sending a chat completion with the
+    synchronous or the asynchronous client, to be called by the governor.
+    """
+    return lambda: get_openai_client(asynchronous).chat.completions.create(
+        messages=build_messages(system_msg, user_msg),
+        # List of available model:
+        # https://platform.openai.com/docs/models/gpt-4-and-gpt-4-turbo
+        model=model,
+        **options,
+    )
+
+
+def finish_completion(
+    model: str, started: float, response, system_msg: str, user_msg: str
+) -> str:
+    """
+    This function records the latency and the tokens of a completion, caches
+    its content and returns it.
+    """
+    tracker.observe(model, time.monotonic() - started)
+    record_usage(model, response, system_msg, user_msg)
+    content = extract_content(response)
+    set_cached_completion(system_msg, user_msg, model, content)
+    return content
 
 
 def completion(
-    system_msg: str, user_msg: str, model: str = "gpt-4-1106-preview"
+    system_msg: str,
+    user_msg: str,
+    model: str = "gpt-4-1106-preview",
+    use_cache: bool = True,
+    max_retries: int = None,
 ) -> str:
     """
     This function sends a system message and a user message to the OpenAI API
@@ -73,61 +553,451 @@ def completion(
         user_msg (str): The user message to send to the OpenAI API.
         model (str, optional): The model to use for the OpenAI API. Defaults
             to 'gpt-4-1106-preview'.
+        use_cache (bool, optional): Whether the cached content can be
+            returned instead of calling the OpenAI API. Defaults to True.
+        max_retries (int, optional): The number of times the call is made
+            again, instead of OPENAI_MAX_RETRIES.
 
     Returns:
         str: The content from the OpenAI API response, with double quotes
         removed.
     """
-    if not os.environ.get("OPENAI_API_KEY"):
-        logging.error("OPENAI_API_KEY environment variable is not set", exc_info=True)
-        raise ValueError("OPENAI_API_KEY environment variable is not set.")
-    response = {
-        "choices": [
-            {"message": {"content": "default value"}},
-        ]
-    }
-    for i in range(MAX_RETRIES):
+    check_api_key()
+    content = get_cached_completion(system_msg, user_msg, model) if use_cache else None
+    if content is not None:
+        return content
+    started = time.monotonic()
+    try:
+        response = governor.call(
+            model,
+            chat(False, system_msg, user_msg, model),
+            estimate_tokens(system_msg, user_msg),
+            max_retries,
+        )
+    except (requests.exceptions.Timeout, OpenAIError) as e:
+        logging.error("Error: %s", e)
+        raise
+    return finish_completion(model, started, response, system_msg, user_msg)
+
+
+async def acompletion(
+    system_msg: str,
+    user_msg: str,
+    model: str = "gpt-4-1106-preview",
+    use_cache: bool = True,
+    max_retries: int = None,
+) -> str:
+    """
+    This function is the asynchronous version of completion.
+    """
+    check_api_key()
+    content = (
+        await asyncio.to_thread(get_cached_completion, system_msg, user_msg, model)
+        if use_cache
+        else None
+    )
+    if content is not None:
+        return content
+    started = time.monotonic()
+    try:
+        response = await governor.acall(
+            model,
+            chat(True, system_msg, user_msg, model),
+            estimate_tokens(system_msg, user_msg),
+            max_retries,
+        )
+    except (requests.exceptions.Timeout, OpenAIError) as e:
+        logging.error("Error: %s", e)
+        raise
+    return await asyncio.to_thread(
+        finish_completion, model, started, response, system_msg, user_msg
+    )
+
+
+def fall_back(models: list, i: int, error: Exception) -> bool:
+    """
+    This function tells whether the model i of a chain, which failed with
+    the error, is followed by the next one: a model throttled or failing
+    after FALLBACK_RETRIES retries is, the last model gets all its retries.
+    """
+    retryable, throttled, delay = classify_error(error)
+    if i == len(models) - 1 or not retryable:
+        return False
+    if throttled:
+        tracker.throttle(models[i], delay)
+    logging.warning("%s failed, falling back to %s", models[i], models[i + 1])
+    return True
+
+
+def chain_retries(models: list, i: int):
+    """
+    This function returns the number of retries of the model i of a chain.
+    """
+    return None if i == len(models) - 1 else FALLBACK_RETRIES
+
+
+def routed_completion(
+    system_msg: str, user_msg: str, models: list, use_cache: bool = True
+) -> str:
+    """
+    This function sends the messages to the models of a chain in order, until
+    one of them answers (see fall_back). Without use_cache, the cached
+    contents are not returned (see completion).
+    """
+    for i, model in enumerate(models):
         try:
-            # Call the OpenAI API
-            response = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_msg,
-                    },
-                    {
-                        "role": "user",
-                        "content": user_msg,
-                    },
-                ],
-                # List of available model:
-                # https://platform.openai.com/docs/models/gpt-4-and-gpt-4-turbo
-                model=model,
+            return completion(
+                system_msg,
+                user_msg,
+                model,
+                use_cache,
+                max_retries=chain_retries(models, i),
             )
-            # If the API call is successful, exit the loop
-            break
         except (requests.exceptions.Timeout, OpenAIError) as e:
-            if i < MAX_RETRIES - 1:  # i is zero indexed
-                logging.warning("Retrying %s/%s...", i + 1, MAX_RETRIES)
-                continue  # Try again
-            logging.error("Error: %s", e)
-            raise  # If this was the last attempt, re-raise the last exception
+            if not fall_back(models, i, e):
+                raise
 
-    # Assuming `completion` is your response object from OpenAI
-    content = response.choices[0].message.content if response.choices else ""
-    # To test :
-    # content = response["choices"][0]["message"]["content"]
-    # if response["choices"]
-    # else ""
 
-    # Remove double quotes from the content
-    logging.debug("The content is: %s", content)
-    return content.replace('"', "")
+async def arouted_completion(
+    system_msg: str, user_msg: str, models: list, use_cache: bool = True
+) -> str:
+    """
+    This function is the asynchronous version of routed_completion.
+    """
+    for i, model in enumerate(models):
+        try:
+            return await acompletion(
+                system_msg,
+                user_msg,
+                model,
+                use_cache,
+                max_retries=chain_retries(models, i),
+            )
+        except (requests.exceptions.Timeout, OpenAIError) as e:
+            if not fall_back(models, i, e):
+                raise
 
 
-def generate_concept(text: str, language: str) -> str:
+def stream_delta(chunk) -> str:
     """
-    This function improves the clarity of an idea by describing its concept.
+    This function returns the content of a chunk of a stream, without double
+    quotes.
+    """
+    delta = chunk.choices[0].delta.content if chunk.choices else None
+    return delta.replace('"', "") if delta else ""
+
+
+def finish_stream(model: str, system_msg: str, user_msg: str, parts: list):
+    """
+    This function records the tokens of a stream and caches its content.
+    """
+    content = "".join(parts)
+    record_usage(model, None, system_msg, user_msg, content)
+    set_cached_completion(system_msg, user_msg, model, content)
+
+
+def stream_completion(
+    system_msg: str,
+    user_msg: str,
+    model: str = "gpt-4-1106-preview",
+    use_cache: bool = True,
+):
+    """
+    This function is the streaming version of completion: it yields the
+    content, without double quotes, as it is generated. A cached content is
+    yielded at once, and the whole content is cached at the end.
+
+    The stream keeps its slot of the governor until it is read; an error
+    while it is read is raised to the caller.
+    """
+    check_api_key()
+    content = get_cached_completion(system_msg, user_msg, model) if use_cache else None
+    if content is not None:
+        yield content
+        return
+    try:
+        stream = governor.call(
+            model,
+            chat(False, system_msg, user_msg, model, stream=True),
+            estimate_tokens(system_msg, user_msg),
+            hold=True,
+        )
+    except (requests.exceptions.Timeout, OpenAIError) as e:
+        logging.error("Error: %s", e)
+        raise
+    parts = []
+    try:
+        for chunk in stream:
+            delta = stream_delta(chunk)
+            if delta:
+                parts.append(delta)
+                yield delta
+    finally:
+        governor.release(model)
+    finish_stream(model, system_msg, user_msg, parts)
+
+
+async def astream_completion(
+    system_msg: str,
+    user_msg: str,
+    model: str = "gpt-4-1106-preview",
+    use_cache: bool = True,
+):
+    """
+    This function is the asynchronous version of stream_completion.
+    """
+    check_api_key()
+    content = (
+        await asyncio.to_thread(get_cached_completion, system_msg, user_msg, model)
+        if use_cache
+        else None
+    )
+    if content is not None:
+        yield content
+        return
+    try:
+        stream = await governor.acall(
+            model,
+            chat(True, system_msg, user_msg, model, stream=True),
+            estimate_tokens(system_msg, user_msg),
+            hold=True,
+        )
+    except (requests.exceptions.Timeout, OpenAIError) as e:
+        logging.error("Error: %s", e)
+        raise
+    parts = []
+    try:
+        async for chunk in stream:
+            delta = stream_delta(chunk)
+            if delta:
+                parts.append(delta)
+                yield delta
+    finally:
+        governor.release(model)
+    await asyncio.to_thread(finish_stream, model, system_msg, user_msg, parts)
+
+
+def build_combined_prompt(prompts: dict, text: str) -> Prompt:
+    """
+    This function merges the prompts of several fields into one prompt
+    asking for a JSON object keyed by field name. The prompts must have been
+    built with COMBINED_TEXT_REF as text.
+    """
+    keys = ", ".join(json.dumps(name) for name in prompts)
+    instructions = "\n\n".join(
+        f"## {name}\n{prompt.system_msg}\n{prompt.user_msg}"
+        for name, prompt in prompts.items()
+    )
+    system_msg = (
+        "You fill several fields about a text at once. You answer with a "
+        f"JSON object whose keys are exactly: {keys}. The value of each key "
+        "is a string following the instructions of the key below.\n\n"
+        f"{instructions}"
+    )
+    return Prompt(system_msg, text, COMBINED_MODEL)
+
+
+def parse_combined_content(content: str, names) -> dict:
+    """
+    This function extracts the valid fields from the JSON answer of a combined
+    completion. The missing or malformed fields are left out.
+    """
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        logging.warning("The combined completion is not valid JSON: %s", content)
+        return {}
+    if not isinstance(data, dict):
+        logging.warning("The combined completion is not a JSON object")
+        return {}
+    values = {}
+    for name in names:
+        value = data.get(name)
+        # Lists are accepted for the fields asking for a list
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            value = "\n".join(value)
+        if isinstance(value, str) and value.strip():
+            values[name] = value.replace('"', "")
+        else:
+            logging.warning("The field %s is missing from the combined answer", name)
+    return values
+
+
+def json_content(model: str, response, system_msg: str, user_msg: str) -> str:
+    """
+    This function records the tokens of a completion answering in JSON and
+    returns its content, as is.
+    """
+    record_usage(model, response, system_msg, user_msg)
+    return response.choices[0].message.content if response.choices else ""
+
+
+def combined_completion(prompts: dict, text: str) -> dict:
+    """
+    This function fills several fields with a single completion answering
+    in JSON. It returns the fields that were correctly filled, the others
+    must be generated separately.
+
+    Args:
+        prompts (dict): The prompt of each field, built with
+            COMBINED_TEXT_REF as text.
+        text (str): The text the fields are about.
+
+    Returns:
+        dict: The value of each correctly filled field.
+    """
+    check_api_key()
+    system_msg, user_msg, model = build_combined_prompt(prompts, text)
+    try:
+        response = governor.call(
+            model,
+            chat(False, system_msg, user_msg, model, response_format=JSON_FORMAT),
+            estimate_tokens(system_msg, user_msg),
+        )
+    except (requests.exceptions.Timeout, OpenAIError):
+        logging.warning("The combined completion failed", exc_info=True)
+        return {}
+    content = json_content(model, response, system_msg, user_msg)
+    return parse_combined_content(content, prompts)
+
+
+async def acombined_completion(prompts: dict, text: str) -> dict:
+    """
+    This function is the asynchronous version of combined_completion.
+    """
+    check_api_key()
+    system_msg, user_msg, model = build_combined_prompt(prompts, text)
+    try:
+        response = await governor.acall(
+            model,
+            chat(True, system_msg, user_msg, model, response_format=JSON_FORMAT),
+            estimate_tokens(system_msg, user_msg),
+        )
+    except (requests.exceptions.Timeout, OpenAIError):
+        logging.warning("The combined completion failed", exc_info=True)
+        return {}
+    content = await asyncio.to_thread(
+        json_content, model, response, system_msg, user_msg
+    )
+    return parse_combined_content(content, prompts)
+
+
+def prompt_digest(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of digest_completion.
+    """
+    system_msg = (
+        "You condense voice memos. You answer with a JSON object whose keys "
+        'are exactly: "clean", the memo without its hesitations, repetitions '
+        'and filler words, keeping all of its content; "summary", the memo '
+        'summed up in a few sentences; "entities", the list of the people, '
+        "places, organisations, projects, products and dates the memo "
+        f"mentions. You use {language} as output language."
+    )
+    return Prompt(system_msg, text, DIGEST_MODEL)
+
+
+def digest_cache_key(text: str, language: str) -> str:
+    """
+    This function returns the key of the digest of a transcript in the cache
+    of the transcripts.
+    """
+    return "digest:" + hash_key(DIGEST_MODEL, language, text)
+
+
+def parse_digest(content: str):
+    """
+    This function extracts the digest from the JSON answer of
+    digest_completion, as a dict with its "clean" text, its "summary" and its
+    "entities", or returns None when it is malformed.
+    """
+    try:
+        data = json.loads(content)
+        digest = {
+            "clean": str(data["clean"]).strip(),
+            "summary": str(data["summary"]).strip(),
+            "entities": [str(entity) for entity in data.get("entities") or []],
+        }
+    except (TypeError, ValueError, KeyError):
+        logging.warning("The digest is not valid: %s", content)
+        return None
+    return digest if digest["clean"] and digest["summary"] else None
+
+
+def cached_digest(text: str, language: str):
+    """
+    This function returns the cache key of the digest of a transcript with
+    the cached digest, or None when it is not cached.
+    """
+    if TRANSCRIPT_CACHE is None:
+        return None, None
+    key = digest_cache_key(text, language)
+    content = TRANSCRIPT_CACHE.get(key)
+    return key, json.loads(content) if content is not None else None
+
+
+def store_digest(key, content: str):
+    """
+    This function extracts the digest from the answer of digest_completion,
+    caches it when it is valid, and returns it.
+    """
+    digest = parse_digest(content)
+    if digest is not None and key is not None:
+        TRANSCRIPT_CACHE.set(key, json.dumps(digest, ensure_ascii=False))
+    return digest
+
+
+def digest_completion(text: str, language: str, use_cache: bool = True):
+    """
+    This function condenses a transcript into a digest, cached with the
+    transcripts, and returns it, or None when it failed: the fields using it
+    are then built from the transcript. Without use_cache, the cached digest
+    is replaced.
+    """
+    check_api_key()
+    key, digest = cached_digest(text, language)
+    if digest is not None and use_cache:
+        return digest
+    system_msg, user_msg, model = prompt_digest(text, language)
+    try:
+        response = governor.call(
+            model,
+            chat(False, system_msg, user_msg, model, response_format=JSON_FORMAT),
+            estimate_tokens(system_msg, user_msg),
+        )
+    except (requests.exceptions.Timeout, OpenAIError):
+        logging.warning("The digest failed", exc_info=True)
+        return None
+    return store_digest(key, json_content(model, response, system_msg, user_msg))
+
+
+async def adigest_completion(text: str, language: str, use_cache: bool = True):
+    """
+    This function is the asynchronous version of digest_completion.
+    """
+    check_api_key()
+    key, digest = await asyncio.to_thread(cached_digest, text, language)
+    if digest is not None and use_cache:
+        return digest
+    system_msg, user_msg, model = prompt_digest(text, language)
+    try:
+        response = await governor.acall(
+            model,
+            chat(True, system_msg, user_msg, model, response_format=JSON_FORMAT),
+            estimate_tokens(system_msg, user_msg),
+        )
+    except (requests.exceptions.Timeout, OpenAIError):
+        logging.warning("The digest failed", exc_info=True)
+        return None
+    content = await asyncio.to_thread(
+        json_content, model, response, system_msg, user_msg
+    )
+    return await asyncio.to_thread(store_digest, key, content)
+
+
+def prompt_concept(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_concept.
     """
 
     # Define the system message
@@ -145,13 +1015,19 @@ def generate_concept(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_draft(text: str, target: str, keywords: str, language: str) -> str:
+def generate_concept(text: str, language: str) -> str:
     """
-    This function generate a draft for an article.
+    This function improves the clarity of an idea by describing its concept.
+    """
+    return completion(*prompt_concept(text, language))
+
+
+def prompt_draft(text: str, target: str, keywords: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_draft.
     """
 
     # Define the system message
@@ -180,13 +1056,19 @@ def generate_draft(text: str, target: str, keywords: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_events(text: str, language: str) -> str:
+def generate_draft(text: str, target: str, keywords: str, language: str) -> str:
     """
-    This function extract the events from a text.
+    This function generate a draft for an article.
+    """
+    return completion(*prompt_draft(text, target, keywords, language))
+
+
+def prompt_events(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_events.
     """
 
     # Define the system message
@@ -205,13 +1087,19 @@ def generate_events(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_excerpt(text: str, keywords: str, language: str) -> str:
+def generate_events(text: str, language: str) -> str:
     """
-    This function generate an excerpt for an article.
+    This function extract the events from a text.
+    """
+    return completion(*prompt_events(text, language))
+
+
+def prompt_excerpt(text: str, keywords: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_excerpt.
     """
 
     # Define the system message
@@ -231,13 +1119,19 @@ def generate_excerpt(text: str, keywords: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_followup(text: str, language: str) -> str:
+def generate_excerpt(text: str, keywords: str, language: str) -> str:
     """
-    This function suggests follow-ups for tasks.
+    This function generate an excerpt for an article.
+    """
+    return completion(*prompt_excerpt(text, keywords, language))
+
+
+def prompt_followup(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_followup.
     """
 
     # Define the system message
@@ -255,13 +1149,19 @@ def generate_followup(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_further_reading(text: str, language: str) -> str:
+def generate_followup(text: str, language: str) -> str:
     """
-    This function returns sources of information about a subject.
+    This function suggests follow-ups for tasks.
+    """
+    return completion(*prompt_followup(text, language))
+
+
+def prompt_further_reading(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_further_reading.
     """
 
     # Define the system message
@@ -279,13 +1179,19 @@ def generate_further_reading(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_goals(text: str, language: str) -> str:
+def generate_further_reading(text: str, language: str) -> str:
     """
-    This function improves the clarity of an idea by describing its goals.
+    This function returns sources of information about a subject.
+    """
+    return completion(*prompt_further_reading(text, language))
+
+
+def prompt_goals(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_goals.
     """
 
     # Define the system message
@@ -302,13 +1208,19 @@ def generate_goals(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_improvements(text: str, language: str) -> str:
+def generate_goals(text: str, language: str) -> str:
     """
-    This function improves an idea by suggesting improvement.
+    This function improves the clarity of an idea by describing its goals.
+    """
+    return completion(*prompt_goals(text, language))
+
+
+def prompt_improvements(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_improvements.
     """
 
     # Define the system message
@@ -326,13 +1238,19 @@ def generate_improvements(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_interpretation(text: str, language: str) -> str:
+def generate_improvements(text: str, language: str) -> str:
     """
-    This function describe the interpretation of a dream, a tought.
+    This function improves an idea by suggesting improvement.
+    """
+    return completion(*prompt_improvements(text, language))
+
+
+def prompt_interpretation(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_interpretation.
     """
 
     # Define the system message
@@ -351,13 +1269,19 @@ def generate_interpretation(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_keywords(text: str, language: str) -> str:
+def generate_interpretation(text: str, language: str) -> str:
     """
-    This function generate keywords.
+    This function describe the interpretation of a dream, a tought.
+    """
+    return completion(*prompt_interpretation(text, language))
+
+
+def prompt_keywords(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_keywords.
     """
 
     # Define the system message
@@ -374,13 +1298,19 @@ def generate_keywords(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_mood(text: str, language: str) -> str:
+def generate_keywords(text: str, language: str) -> str:
     """
-    This function extract the moods from a text.
+    This function generate keywords.
+    """
+    return completion(*prompt_keywords(text, language))
+
+
+def prompt_mood(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_mood.
     """
 
     # Define the system message
@@ -398,16 +1328,19 @@ def generate_mood(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_name(text: str, language: str) -> str:
+def generate_mood(text: str, language: str) -> str:
     """
-    This function generates a name to sum up a given text using the OpenAI API.
-    It sends a system message and a user message to the API, receives a
-    response, removes double quotes from the response content, and returns
-    the content.
+    This function extract the moods from a text.
+    """
+    return completion(*prompt_mood(text, language))
+
+
+def prompt_name(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_name.
     """
 
     # Define the system message
@@ -423,13 +1356,22 @@ def generate_name(text: str, language: str) -> str:
     # Define the model
     model = "gpt-3.5-turbo-1106"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_preparation(text: str, language: str) -> str:
+def generate_name(text: str, language: str) -> str:
     """
-    This function suggests preparation for tasks.
+    This function generates a name to sum up a given text using the OpenAI API.
+    It sends a system message and a user message to the API, receives a
+    response, removes double quotes from the response content, and returns
+    the content.
+    """
+    return completion(*prompt_name(text, language))
+
+
+def prompt_preparation(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_preparation.
     """
 
     # Define the system message
@@ -447,14 +1389,19 @@ def generate_preparation(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_recommandations(moods: str, events: str, language: str) -> str:
+def generate_preparation(text: str, language: str) -> str:
     """
-    This function generate recommandation to self improve based
-    on moods and events.
+    This function suggests preparation for tasks.
+    """
+    return completion(*prompt_preparation(text, language))
+
+
+def prompt_recommandations(moods: str, events: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_recommandations.
     """
 
     # Define the system message
@@ -478,13 +1425,20 @@ def generate_recommandations(moods: str, events: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_results(text: str, language: str) -> str:
+def generate_recommandations(moods: str, events: str, language: str) -> str:
     """
-    This function describes the expected results.
+    This function generate recommandation to self improve based
+    on moods and events.
+    """
+    return completion(*prompt_recommandations(moods, events, language))
+
+
+def prompt_results(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_results.
     """
 
     # Define the system message
@@ -502,13 +1456,19 @@ def generate_results(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_target_audience(text: str, language: str) -> str:
+def generate_results(text: str, language: str) -> str:
     """
-    This function returns the target audience of a subject.
+    This function describes the expected results.
+    """
+    return completion(*prompt_results(text, language))
+
+
+def prompt_target_audience(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_target_audience.
     """
 
     # Define the system message
@@ -526,13 +1486,19 @@ def generate_target_audience(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_tasks(text: str, language: str) -> str:
+def generate_target_audience(text: str, language: str) -> str:
     """
-    This function extract the tasks from a text.
+    This function returns the target audience of a subject.
+    """
+    return completion(*prompt_target_audience(text, language))
+
+
+def prompt_tasks(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_tasks.
     """
 
     # Define the system message
@@ -550,16 +1516,19 @@ def generate_tasks(text: str, language: str) -> str:
     # Define the model
     model = "gpt-4-1106-preview"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
 
 
-def generate_title(text: str, language: str) -> str:
+def generate_tasks(text: str, language: str) -> str:
     """
-    This function generates a title for a given text using the OpenAI API.
-    It sends a system message and a user message to the API, receives a
-    response, removes double quotes from the response content, and returns
-    the content.
+    This function extract the tasks from a text.
+    """
+    return completion(*prompt_tasks(text, language))
+
+
+def prompt_title(text: str, language: str) -> Prompt:
+    """
+    This function builds the prompt of generate_title.
     """
 
     # Define the system message
@@ -574,5 +1543,14 @@ def generate_title(text: str, language: str) -> str:
     # Define the model
     model = "gpt-3.5-turbo-1106"
 
-    # Call the completion function
-    return completion(system_msg, user_msg, model)
+    return Prompt(system_msg, user_msg, model)
+
+
+def generate_title(text: str, language: str) -> str:
+    """
+    This function generates a title for a given text using the OpenAI API.
+    It sends a system message and a user message to the API, receives a
+    response, removes double quotes from the response content, and returns
+    the content.
+    """
+    return completion(*prompt_title(text, language))
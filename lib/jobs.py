@@ -0,0 +1,409 @@
+"""
+Library to handle the queue of uploaded voice memos.
+
+The jobs are stored in a local SQLite database so that they survive a
+restart: a job taken by a worker keeps a lease, and a job whose lease expired
+(because its worker died) is taken again by another worker.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+JOBS_DB = os.environ.get("JOBS_DB", SCRIPT_DIR + "/jobs.sqlite3")
+# Number of seconds a worker owns a job before another one can take it
+JOB_LEASE = float(os.environ.get("JOB_LEASE", "600"))
+# Number of times a job is tried before being marked as failed
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# Number of seconds an idle worker waits before looking for a new job
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+
+# Whether an audio already processed, or being processed, is skipped when it
+# is uploaded again
+DEDUP_UPLOADS = os.environ.get("DEDUP_UPLOADS", "true").lower() == "true"
+
+# The stages of the pipeline, in order
+STAGES = ["upload", "transcribe", "route", "generate", "notion"]
+
+# The columns added after the first version of the jobs table
+COLUMNS = {"audio_hash": "TEXT", "idem_key": "TEXT", "page_id": "TEXT"}
+
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+
+def connect() -> sqlite3.Connection:
+    """
+    This function opens a connection to the jobs database, creating its
+    schema on first use.
+    """
+    conn = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if JOBS_DB not in _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    filepath TEXT NOT NULL,
+                    audio_hash TEXT,
+                    idem_key TEXT,
+                    page_id TEXT,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    stages TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_until REAL,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+                """
+            )
+            migrate(conn)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_audio_hash ON jobs (audio_hash)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_idem_key ON jobs (idem_key)")
+            _schema_ready.add(JOBS_DB)
+    return conn
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    This function adds the columns missing from a jobs table created by an
+    older version.
+    """
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+    for column, definition in COLUMNS.items():
+        if column not in columns:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+
+def to_dict(row: sqlite3.Row) -> dict:
+    """
+    This function converts a row of the jobs table to a dictionary.
+    """
+    job = dict(row)
+    job["stages"] = json.loads(job["stages"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def find_duplicate(conn: sqlite3.Connection, audio_hash: str, idem_key: str):
+    """
+    This function returns the last job which was not failed with the same
+    idempotency key or, without a key, with the same audio, or None.
+    """
+    if idem_key is not None:
+        column, value = "idem_key", idem_key
+    elif audio_hash is not None and DEDUP_UPLOADS:
+        column, value = "audio_hash", audio_hash
+    else:
+        return None
+    return conn.execute(
+        f"SELECT * FROM jobs WHERE {column} = ? AND status != 'failed'"
+        " ORDER BY created DESC LIMIT 1",
+        (value,),
+    ).fetchone()
+
+
+def enqueue(
+    filepath: str,
+    audio_hash: str = None,
+    idem_key: str = None,
+    status: str = "queued",
+):
+    """
+    This function adds an uploaded file, with its SHA-256 when it is known,
+    to the queue and returns the job id with True. When the same upload was
+    already received, it returns the id of its job with False instead.
+    A job added with the "running" status is processed by the caller.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    stages = {stage: {"status": "pending"} for stage in STAGES}
+    stages["upload"] = {"status": "done", "started": now, "ended": now}
+    running = status == "running"
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            duplicate = find_duplicate(conn, audio_hash, idem_key)
+            if duplicate is None:
+                conn.execute(
+                    "INSERT INTO jobs (id, filepath, audio_hash, idem_key, status,"
+                    " stage, stages, attempts, lease_until, created, updated)"
+                    " VALUES (?, ?, ?, ?, ?, 'upload', ?, ?, ?, ?, ?)",
+                    (
+                        job_id,
+                        filepath,
+                        audio_hash,
+                        idem_key,
+                        status,
+                        json.dumps(stages),
+                        1 if running else 0,
+                        now + JOB_LEASE if running else None,
+                        now,
+                        now,
+                    ),
+                )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+    if duplicate is not None:
+        logging.info("%s is a duplicate of the job %s", filepath, duplicate["id"])
+        return duplicate["id"], False
+    logging.debug("The job %s is queued for %s", job_id, filepath)
+    return job_id, True
+
+
+def get_job(job_id: str):
+    """
+    This function returns a job by its id, or None if it does not exist.
+    """
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return to_dict(row) if row is not None else None
+
+
+def find_page_id(filepath: str, audio_hash: str = None):
+    """
+    This function returns the Notion page created for an upload, by its hash
+    or its path, or None when none was delivered.
+    """
+    with closing(connect()) as conn:
+        row = conn.execute(
+            "SELECT page_id FROM jobs WHERE (audio_hash = ? OR filepath = ?)"
+            " AND page_id IS NOT NULL ORDER BY updated DESC LIMIT 1",
+            (audio_hash, filepath),
+        ).fetchone()
+    return row["page_id"] if row is not None else None
+
+
+def claim_job():
+    """
+    This function takes the oldest waiting job, or a job whose lease expired,
+    and returns it. It returns None when there is nothing to do.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued'"
+                " OR (status = 'running' AND lease_until < ?)"
+                " ORDER BY created LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row["attempts"] >= JOB_MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, updated = ?"
+                    " WHERE id = ?",
+                    ("Too many attempts", now, row["id"]),
+                )
+                conn.execute("COMMIT")
+                logging.error("The job %s failed too many times", row["id"])
+                return claim_job()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1,"
+                " lease_until = ?, updated = ? WHERE id = ?",
+                (now + JOB_LEASE, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+    return get_job(row["id"])
+
+
+def start_job(job_id: str):
+    """
+    This function takes a given job of the queue, when it is still waiting,
+    and returns it. It returns None when a worker already took it.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1,"
+            " lease_until = ?, updated = ? WHERE id = ? AND status = 'queued'",
+            (now + JOB_LEASE, now, job_id),
+        )
+    return get_job(job_id) if cursor.rowcount else None
+
+
+def wait_job(job_id: str) -> dict:
+    """
+    This function waits for a job taken by a worker to be done or failed, and
+    returns it.
+    """
+    while True:
+        job = get_job(job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(JOB_POLL_INTERVAL)
+
+
+def update_stage(job_id: str, stage: str, status: str):
+    """
+    This function records the progress of a job in one stage of the pipeline
+    and renews its lease.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT stages FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            stages = json.loads(row["stages"])
+            stages.setdefault(stage, {})["status"] = status
+            stages[stage]["started" if status == "running" else "ended"] = now
+            conn.execute(
+                "UPDATE jobs SET stage = ?, stages = ?, lease_until = ?, updated = ?"
+                " WHERE id = ?",
+                (stage, json.dumps(stages), now + JOB_LEASE, now, job_id),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def finish_job(job_id: str, result: dict, status_code: int):
+    """
+    This function stores the response of a processed job.
+    """
+    with closing(connect()) as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, lease_until = NULL, updated = ?"
+            " WHERE id = ?",
+            (
+                "done" if status_code < 400 else "failed",
+                json.dumps({"status_code": status_code, "body": result}),
+                time.time(),
+                job_id,
+            ),
+        )
+
+
+def set_page_id(job_id: str, page_id: str):
+    """
+    This function records the Notion page created for a job, once it is
+    delivered.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT stages FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return
+            stages = json.loads(row["stages"])
+            stages.setdefault("notion", {}).update(status="done", ended=now)
+            conn.execute(
+                "UPDATE jobs SET page_id = ?, stages = ?, updated = ? WHERE id = ?",
+                (page_id, json.dumps(stages), now, job_id),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def retry_job(job_id: str, error: str):
+    """
+    This function puts back a job in the queue after an error, or marks it as
+    failed when it has no attempt left.
+    """
+    with closing(connect()) as conn:
+        conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued'"
+            " ELSE 'failed' END, error = ?, lease_until = NULL, updated = ?"
+            " WHERE id = ?",
+            (JOB_MAX_ATTEMPTS, error, time.time(), job_id),
+        )
+
+
+def run_worker(handler, stop: threading.Event):
+    """
+    This function processes the jobs of the queue until stop is set.
+    The handler receives the job and a progress function taking a stage and
+    its status, and returns the response body with its status code.
+    """
+    while not stop.is_set():
+        try:
+            job = claim_job()
+        except sqlite3.Error:
+            logging.error("Error while reading the job queue", exc_info=True)
+            job = None
+        if job is None:
+            stop.wait(JOB_POLL_INTERVAL)
+            continue
+        logging.debug("Processing the job %s", job["id"])
+        try:
+            process_job(handler, job)
+        except Exception:
+            logging.error("Error while processing job %s", job["id"], exc_info=True)
+
+
+def process_job(handler, job: dict, requeue: bool = True):
+    """
+    This function processes a job taken from the queue with the handler and
+    stores its response, which is returned. After an error, the job is put
+    back in the queue before the error is raised or, without requeue (a
+    client waiting for the response), it fails with a 500 response.
+    """
+    try:
+        body, status_code = handler(
+            job,
+            lambda stage, status, job_id=job["id"]: update_stage(job_id, stage, status),
+        )
+    except Exception as e:
+        if requeue:
+            retry_job(job["id"], repr(e))
+            raise
+        logging.error("Error while processing job %s", job["id"], exc_info=True)
+        body, status_code = {"message": "Error"}, 500
+    finish_job(job["id"], body, status_code)
+    return body, status_code
+
+
+def start_workers(handler, concurrency: int):
+    """
+    This function starts concurrency worker threads processing the queue and
+    returns the event stopping them with the list of the threads.
+    """
+    stop = threading.Event()
+    threads = []
+    for i in range(concurrency):
+        thread = threading.Thread(
+            target=run_worker,
+            args=(handler, stop),
+            name=f"job-worker-{i}",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    return stop, threads
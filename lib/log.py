@@ -0,0 +1,281 @@
+"""
+Library to configure the logs of the app.
+
+The thread logging a record only builds its message and puts it in a queue: a
+listener thread serializes and writes it, so that logging costs almost nothing
+to the requests. The
+records are written as JSON lines (or as text with LOG_FORMAT=text), with the
+id of the request and of the job they belong to, to LOG_PATH, rotated by size
+and kept across restarts, or to the standard error. The messages over
+LOG_MAX_CHARS characters (a transcript, an answer of Notion...) are truncated.
+
+The level and the sampling of the records can be set per module, such as
+LOG_LEVELS="gpt=DEBUG,httpx=WARNING" and LOG_SAMPLING="fields=0.1". The
+module of a record is its logger, or its file for the root logger.
+"""
+
+import atexit
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import uuid
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOG_PATH = os.environ.get("LOG_PATH")
+# The level of the modules missing from LOG_LEVELS
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# The level of some modules, such as "gpt=DEBUG,httpx=WARNING"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# The share of the records under WARNING kept for some modules, such as
+# "fields=0.1,routing=0"
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "")
+# "json" for a JSON object per line, or "text"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# Number of characters of a message written, 0 to write it whole
+LOG_MAX_CHARS = int(os.environ.get("LOG_MAX_CHARS", "2000"))
+# Size of the log file before it is rotated, and number of old files kept
+LOG_MAX_MB = float(os.environ.get("LOG_MAX_MB", "10"))
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", "5"))
+
+_context = contextvars.ContextVar("log_context", default={})
+_lock = threading.Lock()
+_handler = None
+_listener = None
+_listening = False
+
+
+def parse_settings(value: str, convert) -> dict:
+    """
+    This function parses a list of settings per module, such as
+    "gpt=DEBUG,httpx=WARNING", converting each value with convert.
+    """
+    settings = {}
+    for item in value.split(","):
+        if "=" in item:
+            module, setting = item.split("=", 1)
+            settings[module.strip()] = convert(setting.strip())
+    return settings
+
+
+def module_of(record: logging.LogRecord) -> str:
+    """
+    This function returns the module of a record.
+    """
+    return record.module if record.name == "root" else record.name
+
+
+def lookup(settings: dict, module: str, default=None):
+    """
+    This function returns the setting of a module, or of the closest package
+    it belongs to, such as "openai" for "openai._base_client".
+    """
+    while module:
+        if module in settings:
+            return settings[module]
+        module = module.rpartition(".")[0]
+    return default
+
+
+def shorten(text: str, size: int = LOG_MAX_CHARS) -> str:
+    """
+    This function truncates a message to size characters.
+    """
+    if not size or len(text) <= size:
+        return text
+    return f"{text[:size]}… ({len(text) - size} more characters)"
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    This function adds fields, such as the id of the request or of the job,
+    to the records logged by the code it wraps.
+    """
+    token = bind(**fields)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind(**fields):
+    """
+    This function adds fields to the records logged from now on in the
+    current context, and returns the token removing them (see unbind).
+    """
+    return _context.set({**_context.get(), **fields})
+
+
+def unbind(token):
+    """
+    This function removes the fields added by bind.
+    """
+    _context.reset(token)
+
+
+def new_request_id() -> str:
+    """
+    This function returns a new id for a request.
+    """
+    return uuid.uuid4().hex[:16]
+
+
+class ContextFilter(logging.Filter):
+    """
+    A filter applying the levels and the sampling of the modules, and
+    attaching the fields of the context to the records it keeps.
+
+    Args:
+        level (int): The level of the modules without their own.
+        levels (dict): The level of some modules.
+        sampling (dict): The share of the records under WARNING kept for
+            some modules.
+    """
+
+    def __init__(self, level: int, levels: dict, sampling: dict):
+        super().__init__()
+        self.level = level
+        self.levels = levels
+        self.sampling = sampling
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        module = module_of(record)
+        if record.levelno < lookup(self.levels, module, self.level):
+            return False
+        if record.levelno < logging.WARNING:
+            share = lookup(self.sampling, module)
+            if share is not None and random.random() >= share:
+                return False
+        record.context = _context.get()
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    A handler putting the records in a queue, to be written by the listener
+    thread instead of the thread logging them. The message is merged with its
+    arguments before, since they may change once the call returns; only its
+    serialization is left to the listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record may also be given to other handlers
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class Formatter(logging.Formatter):
+    """
+    A formatter writing a record as a JSON object, or as a line of text, with
+    the fields of its context and its message truncated.
+
+    Args:
+        structured (bool): Whether the records are written in JSON.
+    """
+
+    def __init__(self, structured: bool = True):
+        super().__init__()
+        self.structured = structured
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = shorten(record.getMessage())
+        context = getattr(record, "context", {})
+        exception = self.formatException(record.exc_info) if record.exc_info else None
+        if self.structured:
+            data = {
+                "time": datetime.datetime.fromtimestamp(
+                    record.created, datetime.timezone.utc
+                ).isoformat(timespec="milliseconds"),
+                "level": record.levelname,
+                "module": module_of(record),
+                "message": message,
+                **context,
+            }
+            if exception is not None:
+                data["exception"] = exception
+            return json.dumps(data, ensure_ascii=False, default=str)
+        fields = "".join(f"[{name}={value}] " for name, value in context.items())
+        line = (
+            f"{self.formatTime(record)} - {record.levelname} - {module_of(record)}"
+            f" - {fields}{message}"
+        )
+        return line + "\n" + exception if exception is not None else line
+
+
+def setup_logging():
+    """
+    This function sends the records of the whole process to the listener
+    thread, once. The listener is stopped around a fork, so that a server
+    forking its workers (gunicorn) gives each of them its own.
+    """
+    global _handler, _listener, _listening
+    with _lock:
+        if _handler is not None:
+            return
+        if LOG_PATH:
+            target = logging.handlers.RotatingFileHandler(
+                LOG_PATH,
+                maxBytes=int(LOG_MAX_MB * 1024 * 1024),
+                backupCount=LOG_BACKUPS,
+                encoding="utf-8",
+            )
+        else:
+            target = logging.StreamHandler()
+        target.setFormatter(Formatter(LOG_FORMAT != "text"))
+
+        level = logging.getLevelName(LOG_LEVEL)
+        levels = parse_settings(LOG_LEVELS, logging.getLevelName)
+        _handler = QueueHandler(queue.SimpleQueue())
+        _handler.addFilter(
+            ContextFilter(level, levels, parse_settings(LOG_SAMPLING, float))
+        )
+        root = logging.getLogger()
+        root.addHandler(_handler)
+        # The records are created for the most verbose module, then filtered
+        root.setLevel(min([level, *levels.values()]))
+        _listener = logging.handlers.QueueListener(_handler.queue, target)
+        _listener.start()
+        _listening = True
+    os.register_at_fork(
+        before=stop_listener,
+        after_in_parent=start_listener,
+        after_in_child=start_listener,
+    )
+    # The records left in the queue are written before the process exits
+    atexit.register(stop_listener)
+
+
+def start_listener():
+    """
+    This function starts the listener thread writing the records.
+    """
+    global _listening
+    with _lock:
+        if _listener is not None and not _listening:
+            _listener.start()
+            _listening = True
+
+
+def stop_listener():
+    """
+    This function writes the records left in the queue and stops the
+    listener thread.
+    """
+    global _listening
+    with _lock:
+        if _listening:
+            _listener.stop()
+            _listening = False
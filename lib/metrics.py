@@ -0,0 +1,284 @@
+"""
+Library to measure the pipeline.
+
+The time spent in each stage and in each field, the calls and tokens of each
+model and the responses of the APIs are kept as counters and histograms,
+exported in the Prometheus text format at /metrics. The modules keeping their
+own counters (the caches, the governor of OpenAI...) register a collector
+returning them when the metrics are exported.
+
+A request can also collect the trace of its spans. The trace is kept in a
+context variable, so that it follows the request into its tasks and, when
+they are started with contextvars.copy_context, into its threads.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "whisper_notion_"
+# The upper bounds of the buckets of the durations, in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+
+_registry = []
+_collectors = []
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def format_labels(labels: dict) -> str:
+    """
+    This function formats labels as in the Prometheus text format.
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    """
+    This function formats a value as in the Prometheus text format.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A counter, one per combination of labels.
+
+    Args:
+        name (str): The name of the metric, without the prefix.
+        help (str): The description of the metric.
+        labels (tuple): The names of its labels.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        """
+        This function returns the values of the labels, in order.
+        """
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def inc(self, value: float = 1, **labels):
+        """
+        This function increments the counter of the labels.
+        """
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> list:
+        """
+        This function returns the samples of the counter, as (name, labels,
+        value).
+        """
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, dict(zip(self.labels, key)), v) for key, v in values]
+
+
+class Histogram(Counter):
+    """
+    A histogram of durations, one per combination of labels.
+
+    Args:
+        buckets (tuple, optional): The upper bounds of its buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: tuple = (), buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        """
+        This function records a value.
+        """
+        key = self.key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._values.items()
+            ]
+        samples = []
+        for key, counts, total in values:
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        {**labels, "le": format_value(bound)},
+                        count,
+                    )
+                )
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, counts[-1]))
+        return samples
+
+
+def register(collector):
+    """
+    This function adds a collector, a function returning the metrics kept
+    elsewhere as a list of (name, kind, help, [(labels, value)]), the name
+    without the prefix.
+    """
+    _collectors.append(collector)
+    return collector
+
+
+def render() -> str:
+    """
+    This function returns every metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    for collector in _collectors:
+        try:
+            collected = collector()
+        except Exception:
+            logging.error("Error while collecting the metrics", exc_info=True)
+            continue
+        for name, kind, help, samples in collected:
+            lines.append(f"# HELP {PREFIX}{name} {help}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for labels, value in samples:
+                if value is not None:
+                    lines.append(
+                        f"{PREFIX}{name}{format_labels(labels)} {format_value(value)}"
+                    )
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "stage_seconds", "Time spent in each stage of the pipeline.", ("stage",)
+)
+FIELD_SECONDS = Histogram(
+    "field_seconds", "Time spent generating each field.", ("field",)
+)
+CALL_SECONDS = Histogram(
+    "api_call_seconds",
+    "Time spent in the calls to each model of an API, retries included.",
+    ("api", "model"),
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens_total",
+    "Tokens sent to (prompt) and received from (completion) each model.",
+    ("model", "direction"),
+)
+HTTP_RESPONSES = Counter(
+    "http_responses_total",
+    "Responses of the APIs by status code, each retry included.",
+    ("api", "status"),
+)
+
+
+@contextmanager
+def tracing(enabled: bool = True, started: float = None):
+    """
+    This function collects the spans of the code it wraps, and yields their
+    list, or None when it is not enabled. The spans start from started, a
+    time.monotonic(), or from now.
+    """
+    trace = Trace(started) if enabled else None
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+class Trace(list):
+    """
+    The spans of a request, as dicts with their name, their start from the
+    start of the trace and their duration, in seconds.
+    """
+
+    def __init__(self, started: float = None):
+        super().__init__()
+        self.started = time.monotonic() if started is None else started
+
+    def add(self, name: str, started: float, seconds: float, **attributes):
+        """
+        This function adds a span to the trace.
+        """
+        self.append(
+            {
+                "span": name,
+                "start": round(started - self.started, 4),
+                "seconds": round(seconds, 4),
+                **attributes,
+            }
+        )
+
+
+def add_span(name: str, started: float, seconds: float, **attributes):
+    """
+    This function adds a span to the trace of the current request, if it is
+    traced. started is a time.monotonic().
+    """
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, started, seconds, **attributes)
+
+
+@contextmanager
+def timed(histogram: Histogram, span: str, **labels):
+    """
+    This function measures the code it wraps, in the histogram and in the
+    trace of the current request.
+    """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - started
+        histogram.observe(seconds, **labels)
+        add_span(span, started, seconds, **labels)
+
+
+def stage(name: str):
+    """
+    This function measures a stage of the pipeline.
+    """
+    return timed(STAGE_SECONDS, name, stage=name)
+
+
+def observe_stage(name: str, started: float):
+    """
+    This function records a stage of the pipeline which started at started,
+    a time.monotonic(), and ends now.
+    """
+    seconds = time.monotonic() - started
+    STAGE_SECONDS.observe(seconds, stage=name)
+    add_span(name, started, seconds, stage=name)
@@ -0,0 +1,149 @@
+"""
+Library to choose the models generating the fields.
+
+The models are set in config.json, for all the destinations and for each of
+them, by default and per field. A field can be given a chain of models, from
+the preferred one to the fastest one: the next model of the chain is used
+when a model is throttled or keeps failing, or, with a latency objective,
+while the recent calls to a model are slower than it.
+"""
+
+import logging
+import threading
+import time
+
+from lib.tokens import FIELD_TOKEN_BUDGET
+
+# How much the last call weighs in the average latency of a model
+LATENCY_WEIGHT = 0.3
+# Number of seconds after which the latency of a model is measured again
+LATENCY_TTL = 300
+# Number of seconds a throttled model is avoided
+THROTTLE_COOLDOWN = 60
+
+
+def as_chain(models) -> list:
+    """
+    This function returns a chain of models from a model name or a list.
+    """
+    if not models:
+        return []
+    return [models] if isinstance(models, str) else list(models)
+
+
+class LatencyTracker:
+    """
+    The moving average of the latency of each model, with the models
+    throttled recently.
+    """
+
+    def __init__(self):
+        self._latencies = {}
+        self._throttled = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float):
+        """
+        This function records the latency of a call to a model.
+        """
+        now = time.monotonic()
+        with self._lock:
+            average, updated = self._latencies.get(model, (None, 0))
+            if average is None or now - updated > LATENCY_TTL:
+                average = seconds
+            else:
+                average += LATENCY_WEIGHT * (seconds - average)
+            self._latencies[model] = (average, now)
+
+    def throttle(self, model: str, seconds: float = None):
+        """
+        This function records that a model was throttled, to avoid it for a
+        while.
+        """
+        with self._lock:
+            self._throttled[model] = time.monotonic() + (seconds or THROTTLE_COOLDOWN)
+
+    def latency(self, model: str):
+        """
+        This function returns the recent average latency of a model, or None
+        when it is unknown.
+        """
+        with self._lock:
+            average, updated = self._latencies.get(model, (None, 0))
+        return average if time.monotonic() - updated <= LATENCY_TTL else None
+
+    def healthy(self, model: str, slo: float = None) -> bool:
+        """
+        This function checks that a model is not throttled and, with a latency
+        objective, not slower than it.
+        """
+        with self._lock:
+            throttled = self._throttled.get(model, 0) > time.monotonic()
+        if throttled:
+            return False
+        latency = self.latency(model)
+        return slo is None or latency is None or latency <= slo
+
+    def stats(self) -> dict:
+        """
+        This function returns the average latency of each model, for
+        monitoring.
+        """
+        return {model: self.latency(model) for model in list(self._latencies)}
+
+
+tracker = LatencyTracker()
+
+
+class ModelRoutes:
+    """
+    The models of the fields of a destination.
+
+    Args:
+        defaults (dict, optional): The "models" setting of config.json.
+        overrides (dict, optional): The "models" setting of the destination.
+
+    Both settings take a "default" chain, a chain per field in "fields", an
+    optional latency objective in seconds in "slo_seconds", and the number of
+    tokens of the text sent to each field in "budgets" ("default" for the
+    fields not listed).
+    """
+
+    def __init__(self, defaults: dict = None, overrides: dict = None):
+        defaults, overrides = defaults or {}, overrides or {}
+        self.default = as_chain(overrides.get("default")) or as_chain(
+            defaults.get("default")
+        )
+        self.fields = {
+            field: as_chain(models)
+            for settings in (defaults, overrides)
+            for field, models in settings.get("fields", {}).items()
+        }
+        self.slo = overrides.get("slo_seconds", defaults.get("slo_seconds"))
+        self.budgets = {
+            **defaults.get("budgets", {}),
+            **overrides.get("budgets", {}),
+        }
+
+    def budget(self, field: str) -> int:
+        """
+        This function returns the number of tokens of the text sent to a
+        field, 0 to send it whole.
+        """
+        return self.budgets.get(field, self.budgets.get("default", FIELD_TOKEN_BUDGET))
+
+    def chain(self, field: str, model: str) -> list:
+        """
+        This function returns the models to try for a field, in order. model
+        is the one of its prompt, used when none is set.
+        """
+        chain = self.fields.get(field) or self.default or [model]
+        healthy = [m for m in chain if tracker.healthy(m, self.slo)]
+        if len(healthy) < len(chain):
+            logging.debug("Avoiding %s for %s", set(chain) - set(healthy), field)
+        # The slow or throttled models are only tried last
+        return healthy + [m for m in chain if m not in healthy]
+
+
+# The models of the prompts, when config.json sets none
+DEFAULT_ROUTES = ModelRoutes()
@@ -9,23 +9,399 @@ https://medium.com/@pratikdeshmukhlobhi2004/notion-api-with-python-916024cb9138
 # from typing import Dict
 # from dataclasses import dataclass, asdict
 
+import asyncio
 import json
 import logging
 import os
+import threading
+import time
 from typing import Optional
 from dotenv import load_dotenv
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+
+from lib.metrics import register
+from lib.ratelimit import RequestScheduler
 
 load_dotenv()
 notion_token: Optional[str] = os.environ.get("NOTION_API_KEY")
 
-# Set loggin config
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    filename=os.environ.get("LOG_PATH"),
-    filemode="w",
-)
+NOTION_API_URL = os.environ.get("NOTION_API_URL", "https://api.notion.com/v1")
+# The version of the API the payloads are written for: the content of the
+# blocks is under "rich_text" since 2022-02-22
+NOTION_VERSION = "2022-06-28"
+# Number of connections kept alive to the Notion API
+NOTION_POOL_SIZE = int(os.environ.get("NOTION_POOL_SIZE", "10"))
+NOTION_CONNECT_TIMEOUT = float(os.environ.get("NOTION_CONNECT_TIMEOUT", "5"))
+NOTION_READ_TIMEOUT = float(os.environ.get("NOTION_READ_TIMEOUT", "10"))
+# Notion allows about 3 requests per second per integration
+NOTION_RATE = float(os.environ.get("NOTION_RATE", "3"))
+NOTION_BURST = int(os.environ.get("NOTION_BURST", "3"))
+NOTION_MAX_RETRIES = int(os.environ.get("NOTION_MAX_RETRIES", "5"))
+# Notion refuses a text object over 2000 characters, and more than 100 of
+# them in a rich text
+MAX_TEXT_LENGTH = 2000
+MAX_TEXT_OBJECTS = 100
+# Notion appends at most 100 blocks to a page per request
+MAX_BLOCK_CHILDREN = 100
+
+
+def is_idempotent(method: str, path: str) -> bool:
+    """
+    This function tells whether a request to the Notion API can be sent twice
+    without effect: creating a page or appending blocks does it twice.
+    """
+    if method == "POST":
+        return path != "/pages"
+    return not (method == "PATCH" and path.endswith("/children"))
+
+
+class NotionClient:
+    """
+    A client of the Notion API reusing its connections across requests and
+    threads, instead of opening a new one for each call. Every request goes
+    through a scheduler keeping the client under the rate limit of Notion.
+
+    Args:
+        token (str): The Notion integration token.
+        base_url (str, optional): The URL of the Notion API.
+        pool_size (int, optional): The number of connections kept alive.
+        connect_timeout (float, optional): The timeout to connect, in seconds.
+        read_timeout (float, optional): The timeout to read a response, in
+            seconds.
+        rate (float, optional): The number of requests per second.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        base_url: str = NOTION_API_URL,
+        pool_size: int = NOTION_POOL_SIZE,
+        connect_timeout: float = NOTION_CONNECT_TIMEOUT,
+        read_timeout: float = NOTION_READ_TIMEOUT,
+        rate: float = NOTION_RATE,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.headers = {
+            "Notion-Version": NOTION_VERSION,
+            "Authorization": "Bearer " + token,
+            "Content-Type": "application/json",
+        }
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.scheduler = RequestScheduler(
+            "notion",
+            rate=rate,
+            burst=NOTION_BURST,
+            workers=pool_size,
+            max_retries=NOTION_MAX_RETRIES,
+            retry_exceptions=(
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                httpx.TransportError,
+            ),
+            connect_exceptions=(
+                requests.exceptions.ConnectTimeout,
+                httpx.ConnectError,
+                httpx.ConnectTimeout,
+            ),
+        )
+        # The asynchronous client is bound to the event loop it was created in
+        self._async_loop = None
+        self._async_client = None
+        self._async_lock = threading.Lock()
+
+    def submit(self, method: str, path: str, payload=None):
+        """
+        This function queues a request to the Notion API and returns the
+        future of its response. The future can be awaited with
+        asyncio.wrap_future.
+        """
+        data = json.dumps(payload) if payload is not None else None
+        return self.scheduler.submit(
+            lambda: self.session.request(
+                method, self.base_url + path, data=data, timeout=self.timeout
+            ),
+            is_idempotent(method, path),
+        )
+
+    def request(self, method: str, path: str, payload=None) -> requests.Response:
+        """
+        This function sends a request to the Notion API on a pooled connection
+        and waits for its response.
+        """
+        return self.submit(method, path, payload).result()
+
+    def async_client(self) -> httpx.AsyncClient:
+        """
+        This function returns the asynchronous client of the running event
+        loop, creating it on first use. The client of another event loop is
+        closed.
+        """
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            if self._async_client is None or self._async_loop is not loop:
+                if self._async_client is not None:
+                    self.discard_async_client()
+                self._async_loop = loop
+                self._async_client = httpx.AsyncClient(
+                    headers=self.headers,
+                    timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                    limits=httpx.Limits(
+                        max_connections=self.pool_size,
+                        max_keepalive_connections=self.pool_size,
+                    ),
+                )
+            return self._async_client
+
+    def discard_async_client(self):
+        """
+        This function closes the asynchronous client in its event loop, with
+        the lock held. The connections of an event loop already closed can no
+        longer be closed, they are dropped with it.
+        """
+        client, loop = self._async_client, self._async_loop
+        self._async_client, self._async_loop = None, None
+        if loop.is_closed():
+            logging.debug("The event loop of the Notion client is closed")
+        else:
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+    async def aclose(self):
+        """
+        This function closes the connections of the asynchronous client of the
+        running event loop, before the loop stops.
+        """
+        with self._async_lock:
+            client = self._async_client
+            if client is None or self._async_loop is not asyncio.get_running_loop():
+                return
+            self._async_client, self._async_loop = None, None
+        await client.aclose()
+
+    async def arequest(self, method: str, path: str, payload=None) -> httpx.Response:
+        """
+        This function is the asynchronous version of request.
+        """
+        content = json.dumps(payload) if payload is not None else None
+        return await self.scheduler.arun(
+            lambda: self.async_client().request(
+                method, self.base_url + path, content=content
+            ),
+            is_idempotent(method, path),
+        )
+
+    def close(self):
+        """
+        This function closes the connections of the synchronous client.
+        """
+        self.session.close()
+
+
+_client: Optional[NotionClient] = None
+_client_lock = threading.Lock()
+# The number of requests per second of the process
+_rate = NOTION_RATE
+
+
+def get_client() -> NotionClient:
+    """
+    This function returns the client shared by the whole process.
+    """
+    global _client
+    if notion_token is None:
+        logging.error("NOTION_API_KEY environment variable is not set.")
+        raise ValueError("NOTION_API_KEY environment variable is not set.")
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = NotionClient(notion_token, rate=_rate)
+    return _client
+
+
+async def aclose_client():
+    """
+    This function closes the connections the shared client opened in the
+    running event loop, if any.
+    """
+    if _client is not None:
+        await _client.aclose()
+
+
+def share_rate(workers: int):
+    """
+    This function gives the process its share of the rate limit of Notion,
+    when workers processes send requests with the same integration.
+    """
+    global _rate
+    with _client_lock:
+        _rate = NOTION_RATE / max(1, workers)
+        if _client is not None:
+            _client.scheduler.bucket.rate = _rate
+
+
+def prewarm_notion() -> bool:
+    """
+    This function opens a connection of the pool of the client of Notion,
+    with a request reading the integration, and returns whether it succeeded.
+    """
+    try:
+        get_client().request("GET", "/users/me").raise_for_status()
+    except (ValueError, requests.exceptions.RequestException):
+        logging.warning("The connection to Notion could not be opened", exc_info=True)
+        return False
+    return True
+
+
+async def aprewarm_notion() -> bool:
+    """
+    This function is the asynchronous version of prewarm_notion.
+    """
+    try:
+        response = await get_client().arequest("GET", "/users/me")
+        response.raise_for_status()
+    except (ValueError, httpx.HTTPError):
+        logging.warning("The connection to Notion could not be opened", exc_info=True)
+        return False
+    return True
+
+
+def notion_stats():
+    """
+    This function returns the metrics of the requests to Notion, for
+    monitoring.
+    """
+    return _client.scheduler.stats() if _client is not None else None
+
+
+@register
+def collect_metrics() -> list:
+    """
+    This function returns the queue of the requests to Notion, for the
+    metrics.
+    """
+    stats = notion_stats()
+    if stats is None:
+        return []
+    return [
+        (
+            "notion_queue_depth",
+            "gauge",
+            "Requests waiting to be sent.",
+            [({}, stats["queue_depth"])],
+        ),
+        (
+            "notion_retries_total",
+            "counter",
+            "Requests sent again.",
+            [({}, stats["retries"])],
+        ),
+        (
+            "notion_wait_seconds_total",
+            "counter",
+            "Time spent by the requests waiting to be sent.",
+            [({}, stats["wait_seconds_total"])],
+        ),
+    ]
+
+
+def split_text(text: str, size: int = MAX_TEXT_LENGTH) -> list:
+    """
+    This function cuts a text into pieces of at most size characters, at the
+    last space of each piece when there is one.
+    """
+    pieces = []
+    while len(text) > size:
+        cut = text.rfind(" ", size // 2, size) + 1 or size
+        pieces.append(text[:cut])
+        text = text[cut:]
+    if text or not pieces:
+        pieces.append(text)
+    return pieces
+
+
+def text_objects(text: str) -> list:
+    """
+    This function returns the rich text of a text, made of as many text
+    objects as needed to stay under the limits of Notion.
+    """
+    pieces = split_text(str(text))
+    if len(pieces) > MAX_TEXT_OBJECTS:
+        logging.warning("The text is too long for Notion, it is truncated")
+        pieces = pieces[:MAX_TEXT_OBJECTS]
+    return [{"type": "text", "text": {"content": piece}} for piece in pieces]
+
+
+def paragraph_blocks(text: str) -> list:
+    """
+    This function returns the paragraph blocks of a text, one for each of its
+    paragraphs.
+    """
+    return [
+        {
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {"rich_text": text_objects(paragraph.strip())},
+        }
+        for paragraph in text.split("\n\n")
+        if paragraph.strip()
+    ]
+
+
+def heading_block(text: str) -> dict:
+    """
+    This function returns a heading block.
+    """
+    return {
+        "object": "block",
+        "type": "heading_2",
+        "heading_2": {"rich_text": text_objects(text)},
+    }
+
+
+def stream_paragraphs(tokens, interval: float = 1.0):
+    """
+    This function groups the tokens of a streamed text into its complete
+    paragraphs, yielded at most every interval seconds so that they can be
+    appended to a page while the rest is generated. The last paragraph is
+    yielded at the end of the stream.
+    """
+    buffer = ""
+    # The first paragraph is yielded as soon as it is complete
+    last = float("-inf")
+    for token in tokens:
+        buffer += token
+        end = buffer.rfind("\n\n")
+        if end != -1 and time.monotonic() - last >= interval:
+            yield buffer[:end]
+            buffer = buffer[end + 2 :]
+            last = time.monotonic()
+    if buffer.strip():
+        yield buffer
+
+
+async def astream_paragraphs(tokens, interval: float = 1.0):
+    """
+    This function is the asynchronous version of stream_paragraphs.
+    """
+    buffer = ""
+    # The first paragraph is yielded as soon as it is complete
+    last = float("-inf")
+    async for token in tokens:
+        buffer += token
+        end = buffer.rfind("\n\n")
+        if end != -1 and time.monotonic() - last >= interval:
+            yield buffer[:end]
+            buffer = buffer[end + 2 :]
+            last = time.monotonic()
+    if buffer.strip():
+        yield buffer
 
 
 def format_row(payload, db: str):
@@ -41,9 +417,7 @@ def format_row(payload, db: str):
     properties = row["properties"]
     for item in payload:
         if payload[item]["type"] == "title":
-            properties[item] = {
-                "title": [{"text": {"content": payload[item]["value"]}}]
-            }
+            properties[item] = {"title": text_objects(payload[item]["value"])}
         elif payload[item]["type"] == "select":
             properties[item] = {"select": {"name": payload[item]["value"]}}
         elif payload[item]["type"] == "number":
@@ -59,11 +433,7 @@ def format_row(payload, db: str):
             comments.append(
                 {"type": "text", "text": {"content": payload[item]["value"]}}
             )
-            properties[item] = {
-                "rich_text": [
-                    {"type": "text", "text": {"content": payload[item]["value"]}}
-                ]
-            }
+            properties[item] = {"rich_text": text_objects(payload[item]["value"])}
     return row
 
 
@@ -77,26 +447,31 @@ def create_new_row(db: str, payload):
         }
     create_new_row(database_id, payload)
     """
-    if notion_token is None:
-        logging.error("NOTION_API_KEY environment variable is not set.")
-        raise ValueError("NOTION_API_KEY environment variable is not set.")
+    client = get_client()
     try:
-        headers = {
-            "Notion-Version": "2021-05-13",
-            "Authorization": "Bearer " + notion_token,
-            "Content-Type": "application/json",
-        }
-        url = "https://api.notion.com/v1/pages"
         payload = format_row(payload, db)
-        response = requests.request(
-            "POST", url, headers=headers, data=json.dumps(payload), timeout=10
-        )
-        logging.info(response.json())
-        print(response.json())
+        response = client.request("POST", "/pages", payload)
+        logging.debug("The answer of Notion is: %s", response.text)
+        response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except requests.exceptions.RequestException:
+        logging.error("Error while inserting row in notion.", exc_info=True)
+        return None
+
+
+async def acreate_new_row(db: str, payload):
+    """
+    This function is the asynchronous version of create_new_row.
+    """
+    client = get_client()
+    try:
+        payload = format_row(payload, db)
+        response = await client.arequest("POST", "/pages", payload)
+        logging.debug("The answer of Notion is: %s", response.text)
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError:
         logging.error("Error while inserting row in notion.", exc_info=True)
-        print("Error while inserting row in notion.", e)
         return None
 
 
@@ -105,23 +480,36 @@ def get_page_by_id(page_id: str):
     This function fetches a page by its ID.
     example: get_page_by_id("59eff577-418d-4ece-bb83-1ee2e3aa51ce")
     """
-    if notion_token is None:
-        logging.error("NOTION_API_KEY environment variable is not set.")
-        raise ValueError("NOTION_API_KEY environment variable is not set.")
+    client = get_client()
     try:
-        headers = {
-            "Notion-Version": "2021-05-13",
-            "Authorization": "Bearer " + notion_token,
-            "Content-Type": "application/json",
-        }
-        url = "https://api.notion.com/v1/pages/" + page_id
-        response = requests.request("GET", url, headers=headers, timeout=10)
-        logging.info(response.json())
-        print(response.json())
+        response = client.request("GET", "/pages/" + page_id)
+        logging.debug("The answer of Notion is: %s", response.text)
+        response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except requests.exceptions.RequestException:
         logging.error("Error while fetching page.", exc_info=True)
-        print("Error while fetching page:", e)
+        return None
+
+
+def query_database(db: str, filter: dict, page_size: int = 100):
+    """
+    This function returns the pages of a database matching a filter, or None
+    when the query failed.
+    example:
+    query_database(database_id, {"property": "Name", "title": {"equals": "Idea"}})
+    """
+    client = get_client()
+    try:
+        response = client.request(
+            "POST",
+            f"/databases/{db}/query",
+            {"filter": filter, "page_size": page_size},
+        )
+        logging.debug("The answer of Notion is: %s", response.text)
+        response.raise_for_status()
+        return response.json().get("results", [])
+    except requests.exceptions.RequestException:
+        logging.error("Error while querying the database.", exc_info=True)
         return None
 
 
@@ -135,27 +523,16 @@ def update_notion_row(db, page_id, payload):
         }
     update_notion_row(database_id, page_id, payload)
     """
-    if notion_token is None:
-        logging.error("NOTION_API_KEY environment variable is not set.")
-        raise ValueError("NOTION_API_KEY environment variable is not set.")
+    client = get_client()
     try:
-        headers = {
-            "Notion-Version": "2021-05-13",
-            "Authorization": "Bearer " + notion_token,
-            "Content-Type": "application/json",
-        }
-        url = "https://api.notion.com/v1/pages/" + page_id
         payload = format_row(payload, db)
         del payload["parent"]
-        response = requests.request(
-            "PATCH", url, headers=headers, data=json.dumps(payload), timeout=10
-        )
-        logging.info(response.json())
-        print(response.json())
+        response = client.request("PATCH", "/pages/" + page_id, payload)
+        logging.debug("The answer of Notion is: %s", response.text)
+        response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except requests.exceptions.RequestException:
         logging.error("Error while updating row in notion.", exc_info=True)
-        print("Error while updating row in notion.", e)
         return None
 
 
@@ -165,21 +542,12 @@ def delete_row_by_id(page_id):
     example:
     delete_row_by_id("59eff577-418d-4ece-bb83-1ee2e3aa51ce")
     """
-    if notion_token is None:
-        logging.error("NOTION_API_KEY environment variable is not set.")
-        raise ValueError("NOTION_API_KEY environment variable is not set.")
+    client = get_client()
     try:
-        headers = {
-            "Notion-Version": "2021-05-13",
-            "Authorization": "Bearer " + notion_token,
-            "Content-Type": "application/json",
-        }
-        url = "https://api.notion.com/v1/blocks/" + page_id
-        response = requests.request("DELETE", url, headers=headers, timeout=10)
-        logging.info(response.json())
-        print(response.json())
+        response = client.request("DELETE", "/blocks/" + page_id)
+        logging.debug("The answer of Notion is: %s", response.text)
+        response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except requests.exceptions.RequestException:
         logging.error("Error while DELETING page...", exc_info=True)
-        print("Error while DELETING page...", e)
         return None
@@ -0,0 +1,477 @@
+"""
+Library to deliver the generated pages to Notion.
+
+A generated page is first written to a local SQLite outbox, synced to disk,
+so that the tokens spent to generate it are never lost. A flusher thread then
+sends the pending pages to Notion in batches, trying again with a growing
+delay while Notion is slow, down or refuses the token. The pages left in the
+outbox when the process stops are sent after the restart.
+"""
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, wait
+from contextlib import closing
+
+from dotenv import load_dotenv
+
+from lib.metrics import STAGE_SECONDS, register
+from lib.notion import MAX_BLOCK_CHILDREN, format_row, get_client
+from lib.ratelimit import backoff_delay
+
+load_dotenv()
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+OUTBOX_DB = os.environ.get("OUTBOX_DB", SCRIPT_DIR + "/outbox.sqlite3")
+# Number of pages sent at the same time by the flusher
+OUTBOX_BATCH = int(os.environ.get("OUTBOX_BATCH", "10"))
+# Number of times a page is sent before it is left aside as dead
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "20"))
+# The longest delay between two attempts, in seconds
+OUTBOX_MAX_DELAY = float(os.environ.get("OUTBOX_MAX_DELAY", "3600"))
+# Number of seconds a flusher owns the pages it sends
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", "300"))
+# Number of days the delivered pages are kept
+OUTBOX_RETENTION_DAYS = float(os.environ.get("OUTBOX_RETENTION_DAYS", "7"))
+# Number of seconds an idle flusher waits before looking for due pages
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "5"))
+# The request errors of Notion worth sending the page again for
+RETRY_4XX = {408, 409, 429}
+
+# The columns added after the first version of the outbox table
+COLUMNS = {"kind": "TEXT NOT NULL DEFAULT 'page'", "parent_id": "INTEGER"}
+
+_schema_lock = threading.Lock()
+_schema_ready = set()
+_wakeup = threading.Event()
+_flusher_lock = threading.Lock()
+_flusher = None
+
+
+def connect() -> sqlite3.Connection:
+    """
+    This function opens a connection to the outbox, creating its schema on
+    first use.
+    """
+    conn = sqlite3.connect(OUTBOX_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # A page is on disk once it is appended, even after a power loss
+    conn.execute("PRAGMA synchronous=FULL")
+    with _schema_lock:
+        if OUTBOX_DB not in _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT,
+                    kind TEXT NOT NULL DEFAULT 'page',
+                    parent_id INTEGER,
+                    db TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    page_id TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+                """
+            )
+            migrate(conn)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_parent ON outbox (parent_id, id)"
+            )
+            _schema_ready.add(OUTBOX_DB)
+    return conn
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    This function adds the columns missing from an outbox table created by an
+    older version.
+    """
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(outbox)")}
+    for column, definition in COLUMNS.items():
+        if column not in columns:
+            conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} {definition}")
+
+
+def append(db: str, payload: dict, job_id: str = None) -> int:
+    """
+    This function adds a page to the outbox and returns its id. The payload
+    is the one of create_new_row.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        entry_id = conn.execute(
+            "INSERT INTO outbox (job_id, db, payload, status, next_attempt, created,"
+            " updated) VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+            (job_id, db, json.dumps(payload, ensure_ascii=False), now, now, now),
+        ).lastrowid
+    logging.debug("The page %s is in the outbox", entry_id)
+    _wakeup.set()
+    return entry_id
+
+
+def append_blocks(parent_id: int, blocks: list) -> int:
+    """
+    This function adds blocks to append to a page of the outbox, once it is
+    created, and returns the id of the last entry. The blocks are cut into
+    entries of MAX_BLOCK_CHILDREN blocks, the most Notion appends at once,
+    and the blocks of a page are appended in the order they were added.
+    """
+    now = time.time()
+    chunks = [
+        blocks[i : i + MAX_BLOCK_CHILDREN]
+        for i in range(0, len(blocks), MAX_BLOCK_CHILDREN)
+    ] or [blocks]
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for chunk in chunks:
+            entry_id = conn.execute(
+                "INSERT INTO outbox (kind, parent_id, db, payload, status,"
+                " next_attempt, created, updated)"
+                " VALUES ('blocks', ?, '', ?, 'pending', ?, ?, ?)",
+                (parent_id, json.dumps(chunk, ensure_ascii=False), now, now, now),
+            ).lastrowid
+        conn.execute("COMMIT")
+    _wakeup.set()
+    return entry_id
+
+
+def claim_batch(size: int = OUTBOX_BATCH) -> list:
+    """
+    This function takes the pages due to be sent, or whose lease expired, and
+    returns them. Blocks are only taken once their page is created, and one
+    at a time for each page, to keep their order. A dead block is passed over,
+    the blocks after it are not held back by it.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT entry.*, parent.page_id AS parent_page_id FROM outbox entry"
+                " LEFT JOIN outbox parent ON parent.id = entry.parent_id"
+                " WHERE entry.status IN ('pending', 'sending')"
+                " AND entry.next_attempt <= ? AND (entry.parent_id IS NULL"
+                " OR (parent.status = 'delivered' AND entry.id = (SELECT MIN(id)"
+                " FROM outbox WHERE parent_id = entry.parent_id"
+                " AND status IN ('pending', 'sending'))))"
+                " ORDER BY entry.next_attempt LIMIT ?",
+                (now, size),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', attempts = attempts + 1,"
+                " next_attempt = ?, updated = ? WHERE id = ?",
+                [(now + OUTBOX_LEASE, now, row["id"]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+    return [dict(row, attempts=row["attempts"] + 1) for row in rows]
+
+
+def find_sent_page(entry: dict, payload: dict):
+    """
+    This function returns the page an earlier attempt created for an entry,
+    when Notion created it but its answer was lost (a timeout, a 5xx error
+    after the page was written...), or None. The page is looked up by its
+    title among the pages created since the entry was added.
+
+    Raises:
+        requests.exceptions.RequestException: if the lookup failed.
+    """
+    titles = [name for name, item in payload.items() if item["type"] == "title"]
+    if not titles:
+        return None
+    title = str(payload[titles[0]]["value"])
+    # Notion rounds the creation time of a page to the minute
+    since = datetime.datetime.fromtimestamp(
+        entry["created"] - 60, datetime.timezone.utc
+    ).isoformat()
+    query = {
+        "filter": {
+            "and": [
+                {"property": titles[0], "title": {"equals": title}},
+                {"timestamp": "created_time", "created_time": {"on_or_after": since}},
+            ]
+        },
+        "page_size": 1,
+    }
+    response = get_client().request("POST", f"/databases/{entry['db']}/query", query)
+    response.raise_for_status()
+    pages = response.json().get("results", [])
+    if pages:
+        logging.info("The page %s was already created", entry["id"])
+    return pages[0] if pages else None
+
+
+def send_batch(entries: list) -> list:
+    """
+    This function sends pages to Notion at the same time, under its rate
+    limit, and returns for each one the created page or the error, with the
+    status of the response when there is one. A page sent before is only
+    created if an earlier attempt did not (see find_sent_page).
+    """
+    client = get_client()
+    futures = []
+    for entry in entries:
+        payload = json.loads(entry["payload"])
+        try:
+            if entry["kind"] == "blocks":
+                futures.append(
+                    client.submit(
+                        "PATCH",
+                        f"/blocks/{entry['parent_page_id']}/children",
+                        {"children": payload},
+                    )
+                )
+            else:
+                page = find_sent_page(entry, payload) if entry["attempts"] > 1 else None
+                futures.append(
+                    page
+                    if page is not None
+                    else client.submit(
+                        "POST", "/pages", format_row(payload, entry["db"])
+                    )
+                )
+        except Exception as e:
+            futures.append(e)
+    wait([future for future in futures if isinstance(future, Future)])
+    results = []
+    for entry, future in zip(entries, futures):
+        if isinstance(future, dict):
+            results.append((future, None, None))
+            continue
+        try:
+            if isinstance(future, Exception):
+                raise future
+            response = future.result()
+            response.raise_for_status()
+            if entry["kind"] == "blocks":
+                results.append(({"id": entry["parent_page_id"]}, None, None))
+            else:
+                results.append((response.json(), None, None))
+        except Exception as e:
+            response = getattr(e, "response", None)
+            body = response.text if response is not None else ""
+            status = response.status_code if response is not None else None
+            results.append((None, f"{e!r} {body}".strip(), status))
+    return results
+
+
+def is_permanent(status) -> bool:
+    """
+    This function tells whether Notion refused a page for good: a request
+    error other than a timeout (408), a conflict (409) or a throttling (429)
+    fails the same way when it is sent again.
+    """
+    return status is not None and 400 <= status < 500 and status not in RETRY_4XX
+
+
+def record_results(entries: list, results: list):
+    """
+    This function marks the pages sent as delivered, or schedules them to be
+    sent again. A page Notion refused for good (see is_permanent) is left
+    aside as dead at once.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for entry, (page, error, status) in zip(entries, results):
+            if page is not None:
+                conn.execute(
+                    "UPDATE outbox SET status = 'delivered', page_id = ?, error = NULL,"
+                    " updated = ? WHERE id = ?",
+                    (page["id"], now, entry["id"]),
+                )
+            elif is_permanent(status) or entry["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                logging.error(
+                    "The page %s could not be delivered: %s", entry["id"], error
+                )
+                conn.execute(
+                    "UPDATE outbox SET status = 'dead', error = ?, updated = ?"
+                    " WHERE id = ?",
+                    (error, now, entry["id"]),
+                )
+            else:
+                delay = backoff_delay(entry["attempts"], base=5, cap=OUTBOX_MAX_DELAY)
+                logging.warning(
+                    "The page %s is sent again in %.0fs: %s", entry["id"], delay, error
+                )
+                conn.execute(
+                    "UPDATE outbox SET status = 'pending', error = ?, next_attempt = ?,"
+                    " updated = ? WHERE id = ?",
+                    (error, now + delay, now, entry["id"]),
+                )
+        conn.execute("COMMIT")
+
+
+def prune():
+    """
+    This function removes the pages delivered for more than
+    OUTBOX_RETENTION_DAYS days. A page is kept while some of its blocks are
+    not delivered, dead ones included, so that retry_dead can still append
+    them.
+    """
+    with closing(connect()) as conn:
+        conn.execute(
+            "DELETE FROM outbox WHERE status = 'delivered' AND updated < ?"
+            " AND id NOT IN (SELECT parent_id FROM outbox WHERE parent_id IS NOT NULL"
+            " AND status != 'delivered')",
+            (time.time() - OUTBOX_RETENTION_DAYS * 86400,),
+        )
+
+
+def retry_dead() -> int:
+    """
+    This function puts the dead pages back in the outbox, once the cause of
+    their failure is fixed, and returns their number.
+    """
+    now = time.time()
+    with closing(connect()) as conn:
+        count = conn.execute(
+            "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt = ?,"
+            " updated = ? WHERE status = 'dead'",
+            (now, now),
+        ).rowcount
+    _wakeup.set()
+    return count
+
+
+def flush(on_delivered=None) -> int:
+    """
+    This function sends one batch of due pages and returns its size.
+    on_delivered is called with each delivered entry and its page.
+    """
+    entries = claim_batch()
+    if not entries:
+        return 0
+    results = send_batch(entries)
+    record_results(entries, results)
+    now = time.time()
+    for entry, (page, _, _) in zip(entries, results):
+        if page is not None:
+            # From the outbox to Notion, waiting and retries included
+            STAGE_SECONDS.observe(now - entry["created"], stage="notion")
+    if on_delivered is not None:
+        for entry, (page, _, _) in zip(entries, results):
+            if page is not None:
+                try:
+                    on_delivered(entry, page)
+                except Exception:
+                    logging.error(
+                        "Error after delivering %s", entry["id"], exc_info=True
+                    )
+    return len(entries)
+
+
+def run_flusher(stop: threading.Event, on_delivered=None):
+    """
+    This function sends the pages of the outbox until stop is set.
+    """
+    last_prune = 0.0
+    while not stop.is_set():
+        try:
+            if time.monotonic() - last_prune > 3600:
+                prune()
+                last_prune = time.monotonic()
+            if flush(on_delivered):
+                continue
+        except Exception:
+            logging.error("Error while flushing the outbox", exc_info=True)
+        _wakeup.wait(OUTBOX_POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start_flusher(on_delivered=None, stop: threading.Event = None) -> threading.Event:
+    """
+    This function starts the thread sending the pages of the outbox, once per
+    process, and returns the event stopping it.
+    """
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None:
+            stop = stop or threading.Event()
+            thread = threading.Thread(
+                target=run_flusher,
+                args=(stop, on_delivered),
+                name="outbox-flusher",
+                daemon=True,
+            )
+            thread.start()
+            _flusher = (stop, thread)
+    return _flusher[0]
+
+
+def stop_flusher(timeout: float = None):
+    """
+    This function stops the thread sending the pages of the outbox, letting
+    it finish the batch in progress for at most timeout seconds. The pages
+    left are sent by the next flusher.
+    """
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None:
+            return
+        stop, thread = _flusher
+        _flusher = None
+    stop.set()
+    _wakeup.set()
+    thread.join(timeout)
+
+
+def outbox_stats() -> dict:
+    """
+    This function returns the number of pages of the outbox by status, for
+    monitoring.
+    """
+    try:
+        with closing(connect()) as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*), MIN(created) FROM outbox GROUP BY status"
+            ).fetchall()
+    except sqlite3.Error:
+        return None
+    stats = {status: count for status, count, _ in rows}
+    oldest = [
+        created for status, _, created in rows if status in ("pending", "sending")
+    ]
+    stats["oldest_pending_seconds"] = time.time() - min(oldest) if oldest else 0
+    return stats
+
+
+@register
+def collect_metrics() -> list:
+    """
+    This function returns the number of pages of the outbox by status, for
+    the metrics.
+    """
+    stats = outbox_stats() or {}
+    oldest = stats.pop("oldest_pending_seconds", None)
+    return [
+        (
+            "outbox_entries",
+            "gauge",
+            "Entries of the outbox by status.",
+            [({"status": status}, count) for status, count in stats.items()],
+        ),
+        (
+            "outbox_oldest_pending_seconds",
+            "gauge",
+            "Age of the oldest entry waiting to be sent.",
+            [({}, oldest)],
+        ),
+    ]
@@ -0,0 +1,650 @@
+"""
+Library to pace the calls to the external APIs.
+
+A token bucket spreads the calls to stay under a rate, and a scheduler queues
+the requests in front of an API: it waits for the bucket, retries the
+throttled or failed requests with a jittered exponential backoff, and honors
+the Retry-After header sent by the API.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from lib.metrics import CALL_SECONDS, HTTP_RESPONSES, add_span
+
+# The statuses worth sending the request again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30) -> float:
+    """
+    This function returns the delay before the given retry (starting at 1),
+    growing exponentially with a random jitter so that the clients waiting
+    together do not retry together.
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def retry_after(headers) -> Optional[float]:
+    """
+    This function returns the number of seconds asked by a Retry-After header,
+    or None when there is none.
+    """
+    value = headers.get("Retry-After") if headers is not None else None
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def response_status(response=None, error: Exception = None) -> str:
+    """
+    This function returns the status of a response, or of the error raised
+    instead, for the metrics.
+    """
+    if response is not None:
+        return str(response.status_code)
+    status = getattr(error, "status_code", None)
+    return str(status) if status is not None else type(error).__name__
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket: tokens are added at a constant rate up to a
+    capacity, and each call takes some of them.
+
+    Args:
+        rate (float): The number of tokens added per second.
+        capacity (float): The maximum number of tokens, i.e. the burst size.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        This function takes tokens from the bucket, possibly in advance, and
+        returns the number of seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        This function waits until tokens are available and returns the time
+        waited.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens: float = 1) -> float:
+        """
+        This function is the asynchronous version of acquire.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """
+        This function stops handing out tokens for a while, when the API asks
+        to slow down.
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    """
+    A queue of requests to an API, sent under a rate limit and retried when
+    the API throttles them or fails.
+
+    The requests are functions returning a response with a status_code and
+    headers (requests or httpx responses). The last response is returned
+    when the retries are exhausted, so the caller decides what to do with it.
+
+    Args:
+        name (str): The name of the API, for the logs.
+        rate (float): The number of requests per second.
+        burst (int): The number of requests that can be sent at once.
+        workers (int): The number of requests in flight at the same time.
+        max_retries (int): The number of times a request is sent again.
+        retry_exceptions (tuple): The exceptions worth sending the request
+            again.
+        connect_exceptions (tuple): The exceptions raised before the request
+            reached the API, the only ones, with a throttling, worth sending
+            a request which is not idempotent again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        workers: int,
+        max_retries: int,
+        retry_exceptions: tuple = (),
+        connect_exceptions: tuple = (),
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_exceptions = retry_exceptions
+        self.connect_exceptions = connect_exceptions
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+        self._dispatcher = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "failures": 0,
+            "in_flight": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def count(self, name: str, value: float = 1):
+        """
+        This function increments a counter of the scheduler.
+        """
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def record_wait(self, seconds: float):
+        """
+        This function records the time a request waited before being sent.
+        """
+        with self._stats_lock:
+            self._stats["wait_seconds_total"] += seconds
+            self._stats["wait_seconds_max"] = max(
+                self._stats["wait_seconds_max"], seconds
+            )
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the scheduler, for monitoring.
+        """
+        with self._cond:
+            queue_depth = len(self._heap)
+        with self._stats_lock:
+            return {"queue_depth": queue_depth, **self._stats}
+
+    def retry_delay(
+        self, attempt: int, response=None, error=None, idempotent: bool = True
+    ) -> Optional[float]:
+        """
+        This function returns the delay before sending a request again, or
+        None when it should not be sent again. A request which is not
+        idempotent (creating a page...) is only sent again when it surely did
+        not reach the API: a failure to connect, or a throttling.
+        """
+        if attempt > self.max_retries:
+            return None
+        if error is not None:
+            retryable = self.retry_exceptions if idempotent else self.connect_exceptions
+            if not isinstance(error, retryable):
+                return None
+            return backoff_delay(attempt)
+        if response.status_code not in (RETRY_STATUSES if idempotent else {429}):
+            return None
+        delay = retry_after(response.headers)
+        if response.status_code == 429:
+            self.count("throttled")
+            delay = delay if delay is not None else backoff_delay(attempt)
+            # Every request waits, not only this one
+            self.bucket.pause(delay)
+        return delay if delay is not None else backoff_delay(attempt)
+
+    def start(self):
+        """
+        This function starts the dispatcher thread, once.
+        """
+        with self._cond:
+            if self._dispatcher is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix=self.name
+                )
+                self._dispatcher = threading.Thread(
+                    target=self.dispatch, name=f"{self.name}-scheduler", daemon=True
+                )
+                self._dispatcher.start()
+
+    def submit(self, send, idempotent: bool = True) -> Future:
+        """
+        This function queues a request and returns the future of its response.
+        """
+        self.start()
+        future = Future()
+        self.push(time.monotonic(), (send, future, 1, time.monotonic(), idempotent))
+        return future
+
+    def push(self, not_before: float, item: tuple):
+        """
+        This function adds a request to the queue, to be sent after not_before.
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (not_before, next(self._counter), item))
+            self._cond.notify()
+
+    def dispatch(self):
+        """
+        This function sends the queued requests when they are due, under the
+        rate limit.
+        """
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = (
+                        self._heap[0][0] - time.monotonic() if self._heap else None
+                    )
+                    self._cond.wait(timeout)
+                _, _, item = heapq.heappop(self._heap)
+            self.bucket.acquire()
+            if item[2] == 1:
+                self.record_wait(time.monotonic() - item[3])
+            self._executor.submit(self.execute, item)
+
+    def execute(self, item: tuple):
+        """
+        This function sends a request and resolves its future, or queues it
+        again when it must be retried.
+        """
+        send, future, attempt, queued, idempotent = item
+        self.count("requests")
+        self.count("in_flight")
+        response, error = None, None
+        try:
+            response = send()
+        except Exception as e:
+            error = e
+        finally:
+            self.count("in_flight", -1)
+        HTTP_RESPONSES.inc(api=self.name, status=response_status(response, error))
+        delay = self.retry_delay(attempt, response, error, idempotent)
+        if delay is not None:
+            self.count("retries")
+            logging.warning(
+                "Retrying %s request in %.1fs (%s/%s)",
+                self.name,
+                delay,
+                attempt,
+                self.max_retries,
+            )
+            self.push(
+                time.monotonic() + delay,
+                (send, future, attempt + 1, queued, idempotent),
+            )
+        elif error is not None:
+            self.count("failures")
+            future.set_exception(error)
+        else:
+            if response.status_code >= 400:
+                self.count("failures")
+            future.set_result(response)
+
+    async def arun(self, asend, idempotent: bool = True):
+        """
+        This function sends a request from an event loop, under the same rate
+        limit and retries as the queued ones. asend is a function returning
+        the coroutine of the request.
+        """
+        started = time.monotonic()
+        attempt = 1
+        while True:
+            await self.bucket.aacquire()
+            if attempt == 1:
+                self.record_wait(time.monotonic() - started)
+            self.count("requests")
+            response, error = None, None
+            try:
+                response = await asend()
+            except Exception as e:
+                error = e
+            HTTP_RESPONSES.inc(api=self.name, status=response_status(response, error))
+            delay = self.retry_delay(attempt, response, error, idempotent)
+            if delay is None:
+                if error is not None:
+                    self.count("failures")
+                    raise error
+                if response.status_code >= 400:
+                    self.count("failures")
+                return response
+            self.count("retries")
+            logging.warning(
+                "Retrying %s request in %.1fs (%s/%s)",
+                self.name,
+                delay,
+                attempt,
+                self.max_retries,
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class AdaptiveLimiter:
+    """
+    A limit on the number of calls in flight which adapts to the API: it
+    grows slowly while the calls succeed and is halved when the API
+    throttles them (additive increase, multiplicative decrease).
+
+    Args:
+        initial (int): The limit to start with.
+        maximum (int): The highest limit.
+        minimum (int, optional): The lowest limit.
+    """
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1):
+        self.minimum = minimum
+        self.maximum = max(maximum, initial)
+        self.limit = float(initial)
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        """
+        This function takes a slot if one is free and tells whether it did.
+        """
+        with self._cond:
+            if self.active < int(self.limit):
+                self.active += 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        This function waits for a free slot and takes it.
+        """
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    async def aacquire(self, poll: float = 0.05):
+        """
+        This function is the asynchronous version of acquire.
+        """
+        while not self.try_acquire():
+            await asyncio.sleep(poll)
+
+    def release(self):
+        """
+        This function frees a slot.
+        """
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def increase(self):
+        """
+        This function grows the limit by one slot every limit successes.
+        """
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def decrease(self):
+        """
+        This function halves the limit.
+        """
+        with self._cond:
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+class Governor:
+    """
+    The guard of the calls to an API serving several models: for each model,
+    it limits the calls in flight (adaptively) and the tokens sent per
+    minute, and retries the failed calls with a jittered exponential backoff.
+
+    Args:
+        name (str): The name of the API, for the logs.
+        concurrency (int): The initial number of calls in flight per model.
+        max_concurrency (int): The highest number of calls in flight per model.
+        tokens_per_minute (dict): The budget of tokens per minute of each
+            model, the models missing from it are not limited.
+        max_retries (int): The number of times a call is made again.
+        classify: A function taking an exception and returning whether the
+            call is worth making again, whether the API throttled it, and
+            the delay asked by the API (or None).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        max_concurrency: int,
+        tokens_per_minute: dict,
+        max_retries: int,
+        classify,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.classify = classify
+        self._models = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def model(self, model: str):
+        """
+        This function returns the limiter and the token bucket of a model.
+        """
+        with self._lock:
+            if model not in self._models:
+                tpm = self.tokens_per_minute.get(model)
+                self._models[model] = (
+                    AdaptiveLimiter(self.concurrency, self.max_concurrency),
+                    TokenBucket(tpm / 60, tpm) if tpm else None,
+                )
+                self._stats[model] = {
+                    "calls": 0,
+                    "retries": 0,
+                    "throttled": 0,
+                    "failures": 0,
+                }
+            return self._models[model]
+
+    def set_budgets(self, tokens_per_minute: dict):
+        """
+        This function changes the budgets of tokens per minute of the models,
+        including the models already used.
+        """
+        with self._lock:
+            self.tokens_per_minute = tokens_per_minute
+            for model, (limiter, _) in self._models.items():
+                tpm = tokens_per_minute.get(model)
+                self._models[model] = (
+                    limiter,
+                    TokenBucket(tpm / 60, tpm) if tpm else None,
+                )
+
+    def count(self, model: str, name: str):
+        """
+        This function increments a counter of a model.
+        """
+        with self._lock:
+            self._stats[model][name] += 1
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of each model, for monitoring.
+        """
+        with self._lock:
+            return {
+                model: {
+                    **self._stats[model],
+                    "concurrency_limit": int(limiter.limit),
+                    "in_flight": limiter.active,
+                }
+                for model, (limiter, _) in self._models.items()
+            }
+
+    def observe(self, model: str, started: float, attempts: int):
+        """
+        This function records the duration of a call, retries included.
+        """
+        seconds = time.monotonic() - started
+        CALL_SECONDS.observe(seconds, api=self.name, model=model)
+        add_span(self.name, started, seconds, model=model, attempts=attempts)
+
+    def retry_delay(
+        self, model: str, attempt: int, error: Exception, max_retries: int = None
+    ):
+        """
+        This function returns the delay before making a failed call again, or
+        None when it should not be made again.
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        limiter, bucket = self.model(model)
+        retryable, throttled, delay = self.classify(error)
+        if throttled:
+            self.count(model, "throttled")
+            limiter.decrease()
+            if bucket is not None and delay is not None:
+                bucket.pause(delay)
+        if not retryable or attempt > max_retries:
+            self.count(model, "failures")
+            return None
+        self.count(model, "retries")
+        delay = delay if delay is not None else backoff_delay(attempt)
+        logging.warning(
+            "Retrying %s call to %s in %.1fs (%s/%s)",
+            self.name,
+            model,
+            delay,
+            attempt,
+            max_retries,
+        )
+        return delay
+
+    def call(
+        self,
+        model: str,
+        send,
+        tokens: int = 0,
+        max_retries: int = None,
+        hold: bool = False,
+    ):
+        """
+        This function makes a call to a model and returns its result.
+
+        Args:
+            model (str): The model called.
+            send: A function making the call.
+            tokens (int, optional): The estimated number of tokens of the call.
+            max_retries (int, optional): The number of times the call is made
+                again, instead of the one of the governor.
+            hold (bool, optional): Whether the slot of the call is kept once
+                it succeeded, for a stream read afterwards. The caller frees
+                it with release.
+        """
+        limiter, bucket = self.model(model)
+        attempt = 1
+        started = time.monotonic()
+        while True:
+            if bucket is not None:
+                bucket.acquire(tokens)
+            limiter.acquire()
+            self.count(model, "calls")
+            try:
+                result = send()
+            except BaseException as e:
+                limiter.release()
+                if not isinstance(e, Exception):
+                    raise
+                HTTP_RESPONSES.inc(api=self.name, status=response_status(error=e))
+                delay = self.retry_delay(model, attempt, e, max_retries)
+                if delay is None:
+                    self.observe(model, started, attempt)
+                    raise
+            else:
+                self.succeeded(model, started, attempt, hold)
+                return result
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(
+        self,
+        model: str,
+        asend,
+        tokens: int = 0,
+        max_retries: int = None,
+        hold: bool = False,
+    ):
+        """
+        This function is the asynchronous version of call. asend is a
+        function returning the coroutine of the call.
+        """
+        limiter, bucket = self.model(model)
+        attempt = 1
+        started = time.monotonic()
+        while True:
+            if bucket is not None:
+                await bucket.aacquire(tokens)
+            await limiter.aacquire()
+            self.count(model, "calls")
+            try:
+                result = await asend()
+            except BaseException as e:
+                limiter.release()
+                if not isinstance(e, Exception):
+                    raise
+                HTTP_RESPONSES.inc(api=self.name, status=response_status(error=e))
+                delay = self.retry_delay(model, attempt, e, max_retries)
+                if delay is None:
+                    self.observe(model, started, attempt)
+                    raise
+            else:
+                self.succeeded(model, started, attempt, hold)
+                return result
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def succeeded(self, model: str, started: float, attempts: int, hold: bool):
+        """
+        This function records a successful call and frees its slot, unless it
+        is held.
+        """
+        limiter, _ = self.model(model)
+        HTTP_RESPONSES.inc(api=self.name, status="200")
+        self.observe(model, started, attempts)
+        limiter.increase()
+        if not hold:
+            limiter.release()
+
+    def release(self, model: str):
+        """
+        This function frees the slot of a call made with hold.
+        """
+        self.model(model)[0].release()
@@ -0,0 +1,153 @@
+"""
+Library to route a transcript to its destination.
+
+The keywords of the destinations are compiled once into a trie of words, so
+that a transcript is routed in a single pass over its words, whatever the
+number of destinations and keywords. A keyword can be a phrase of several
+words ("à faire"), and words are compared without case, accents, or the
+punctuation around them.
+
+The index is rebuilt when the config file changes on disk.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from types import MappingProxyType
+
+from lib.models import ModelRoutes
+
+# The punctuation ignored around a word
+PUNCTUATION = ".,!?;:\"'()[]«»…-–—"
+# The marker of the destination at the end of a keyword in the trie
+END = ""
+
+
+def normalize_word(word: str) -> str:
+    """
+    This function lowers a word and removes its accents and the punctuation
+    around it.
+    """
+    word = unicodedata.normalize("NFKD", word.lower().strip(PUNCTUATION))
+    return "".join(char for char in word if not unicodedata.combining(char))
+
+
+class RoutingIndex:
+    """
+    The keywords of the destinations, compiled into a trie of words.
+
+    Args:
+        config (dict): The content of config.json. The first destination is
+            the default one.
+    """
+
+    def __init__(self, config: dict):
+        self.destinations = tuple(config["destinations"])
+        self.default = self.destinations[0]
+        self.models = config.get("models", {})
+        trie = {}
+        for destination in self.destinations:
+            for keyword in destination["keywords"]:
+                words = [normalize_word(word) for word in keyword.split()]
+                words = [word for word in words if word]
+                if not words:
+                    continue
+                node = trie
+                for word in words:
+                    node = node.setdefault(word, {})
+                # The first destination declaring a keyword keeps it
+                node.setdefault(END, destination)
+        self.trie = freeze(trie)
+
+    def match(self, words: list, start: int):
+        """
+        This function returns the destination of the longest keyword starting
+        at a word, with the index of its last word, or (None, None). The
+        words made only of punctuation ("!", "-") are skipped.
+        """
+        node = self.trie
+        found = (None, None)
+        for i in range(start, len(words)):
+            word, raw, _ = words[i]
+            if word:
+                node = node.get(word)
+                if node is None:
+                    break
+                if END in node:
+                    found = (node[END], i)
+            elif i == start:
+                break
+            # A keyword does not go over the end of a sentence
+            if "." in raw:
+                break
+        return found
+
+    def route(self, text: str):
+        """
+        This function finds the first keyword of the first sentence of a text
+        and returns its destination with the rest of the text, the idea. The
+        default destination receives the whole text when no keyword is found.
+        """
+        words = [
+            (normalize_word(match.group()), match.group(), match.end())
+            for match in re.finditer(r"\S+", text)
+        ]
+        for start, (_, raw, _) in enumerate(words):
+            destination, end = self.match(words, start)
+            if destination is not None:
+                # The rest of the text from the keyword is the idea
+                idea = text[words[end][2] :].lstrip(" \t\n" + PUNCTUATION)
+                logging.debug("The destination is: %s", destination["name"])
+                logging.debug("The idea is: %s", idea)
+                return destination, idea
+            # If a point is found, then we stop the loop because
+            # the keyword is not found
+            if "." in raw:
+                break
+        logging.warning("No destination found, using default")
+        return self.default, text
+
+    def model_routes(self, destination: dict) -> ModelRoutes:
+        """
+        This function returns the models of the fields of a destination.
+        """
+        return ModelRoutes(self.models, destination.get("models"))
+
+
+def freeze(trie: dict):
+    """
+    This function makes a trie read-only.
+    """
+    return MappingProxyType(
+        {key: value if key == END else freeze(value) for key, value in trie.items()}
+    )
+
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def get_routing_index(config_file: str) -> RoutingIndex:
+    """
+    This function returns the routing index of a config file, building it
+    again when the file changed since the last call.
+
+    Raises:
+        FileNotFoundError: if the config file does not exist.
+    """
+    stat = os.stat(config_file)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _indexes.get(config_file)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _lock:
+        cached = _indexes.get(config_file)
+        if cached is None or cached[0] != version:
+            with open(config_file, encoding="utf-8") as f:
+                index = RoutingIndex(json.load(f))
+            logging.info("The config %s is loaded", config_file)
+            _indexes[config_file] = cached = (version, index)
+    return cached[1]
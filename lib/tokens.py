@@ -0,0 +1,80 @@
+"""
+Library to count the tokens of the texts sent to the models, and to fit a
+text into a budget of tokens.
+
+The tokens are counted with tiktoken. When it is missing or its encodings
+cannot be loaded (they are downloaded on first use), they are estimated at
+about four characters per token, with a warning: the estimate is far off for
+the languages other than English.
+"""
+
+import functools
+import logging
+import os
+
+from dotenv import load_dotenv
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+load_dotenv()
+
+# Number of tokens of the transcript sent to a field when its destination sets
+# no budget, 0 to send it whole
+FIELD_TOKEN_BUDGET = int(os.environ.get("FIELD_TOKEN_BUDGET", "0"))
+# The encoding of the models tiktoken does not know
+DEFAULT_ENCODING = "cl100k_base"
+# Appended to a truncated text
+TRUNCATION_MARK = " […]"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = None):
+    """
+    This function returns the tiktoken encoding of a model, or None when
+    tiktoken is not available.
+    """
+    if tiktoken is None:
+        logging.warning("The tokens are estimated, tiktoken is not installed")
+        return None
+    try:
+        if model is not None:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                pass
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception:
+        # The encodings are downloaded on first use
+        logging.warning("The tokens are estimated, tiktoken failed", exc_info=True)
+        return None
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """
+    This function returns the number of tokens of a text for a model.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate(text: str, budget: int, model: str = None):
+    """
+    This function cuts a text to at most budget tokens, keeping its start,
+    and returns it with the number of tokens removed.
+    """
+    count = count_tokens(text, model)
+    if not budget or count <= budget:
+        return text, 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        cut = text[: budget * 4]
+        # The text is cut after its last whole word
+        cut = cut[: cut.rfind(" ")] if " " in cut else cut
+    else:
+        cut = encoding.decode(encoding.encode(text, disallowed_special=())[:budget])
+    return cut.rstrip() + TRUNCATION_MARK, count - count_tokens(cut, model)
@@ -0,0 +1,128 @@
+"""
+Library to receive the uploaded audio files.
+
+The body of an upload is written in chunks to a temporary file of the uploads
+folder while its SHA-256 is computed, then the file is renamed after its hash.
+An upload is never held in memory, is written only once, and the same audio
+sent twice ends up in the same file.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from dotenv import load_dotenv
+from werkzeug.exceptions import RequestEntityTooLarge
+
+load_dotenv()
+
+# The maximum size of an upload, checked before and while it is read
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", "100")) * 1024 * 1024
+# The size of the chunks read from a raw request body
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# The content types of a raw audio body, sent without a multipart form
+RAW_MIMETYPES = {"audio/mp4", "audio/m4a", "audio/x-m4a", "application/octet-stream"}
+
+
+class HashingFile:
+    """
+    A temporary file of the uploads folder hashing what is written to it.
+
+    Args:
+        directory (str): The uploads folder.
+        max_bytes (int): The maximum size of the file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = MAX_UPLOAD_BYTES):
+        fd, self.path = tempfile.mkstemp(
+            dir=directory, prefix=".upload-", suffix=".part"
+        )
+        self.file = os.fdopen(fd, "w+b")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+
+    def write(self, data: bytes) -> int:
+        """
+        This function appends a chunk to the file and to its hash.
+
+        Raises:
+            RequestEntityTooLarge: if the file grows over its maximum size.
+        """
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def commit(self, extension: str):
+        """
+        This function moves the file to its final path, named after its hash,
+        and returns the path with the hash.
+        """
+        self.file.close()
+        audio_hash = self.digest.hexdigest()
+        filepath = os.path.join(self.directory, f"{audio_hash}.{extension}")
+        os.replace(self.path, filepath)
+        self.committed = True
+        logging.debug("Received %s bytes in %s", self.size, filepath)
+        return filepath, audio_hash
+
+    def discard(self):
+        """
+        This function removes the temporary file, unless it was committed.
+        """
+        self.file.close()
+        if not self.committed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def file_stream_factory(directory: str, opened: list):
+    """
+    This function returns a stream factory for the form parser of Werkzeug,
+    writing each uploaded file to a HashingFile added to opened.
+    """
+
+    def factory(total_content_length, content_type, filename, content_length=None):
+        stream = HashingFile(directory)
+        opened.append(stream)
+        return stream
+
+    return factory
+
+
+def receive_stream(read, directory: str, extension: str):
+    """
+    This function writes a raw request body, read in chunks by read, to the
+    uploads folder and returns its path with its hash.
+    """
+    stream = HashingFile(directory)
+    try:
+        for chunk in iter(lambda: read(UPLOAD_CHUNK_SIZE), b""):
+            stream.write(chunk)
+        return stream.commit(extension)
+    finally:
+        stream.discard()
+
+
+async def areceive_stream(chunks, directory: str, extension: str):
+    """
+    This function is the asynchronous version of receive_stream, for a body
+    given as an asynchronous iterator of chunks.
+    """
+    stream = HashingFile(directory)
+    try:
+        async for chunk in chunks:
+            stream.write(chunk)
+        return stream.commit(extension)
+    finally:
+        stream.discard()
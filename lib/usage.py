@@ -0,0 +1,148 @@
+"""
+Library to keep the ledger of the tokens spent.
+
+Each completion adds a row to a local SQLite ledger, with its model, its
+tokens and the destination and field it was made for. The destination and
+the field are set around the code making the completions, in a context
+variable, so that the calls to OpenAI do not need to know them.
+"""
+
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+USAGE_DB = os.environ.get("USAGE_DB", SCRIPT_DIR + "/usage.sqlite3")
+# Whether the tokens spent are written to the ledger
+USAGE_LEDGER = os.environ.get("USAGE_LEDGER", "true").lower() == "true"
+# Number of days the rows of the ledger are kept
+USAGE_RETENTION_DAYS = float(os.environ.get("USAGE_RETENTION_DAYS", "365"))
+
+# The columns a report can be grouped by
+GROUPS = ("destination", "field", "model", "day")
+
+_labels = contextvars.ContextVar("usage_labels", default={})
+_schema_lock = threading.Lock()
+_schema_ready = set()
+_pruned = 0.0
+
+
+@contextmanager
+def labelled(**labels):
+    """
+    This function sets the destination, the field, or the number of tokens
+    removed from the text (truncated), of the completions made by the code it
+    wraps.
+    """
+    token = _labels.set({**_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def connect() -> sqlite3.Connection:
+    """
+    This function opens a connection to the ledger, creating its schema on
+    first use.
+    """
+    conn = sqlite3.connect(USAGE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if USAGE_DB not in _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created REAL NOT NULL,
+                    destination TEXT,
+                    field TEXT,
+                    model TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    truncated_tokens INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS usage_created ON usage (created)")
+            _schema_ready.add(USAGE_DB)
+    return conn
+
+
+def spend(model: str, prompt_tokens: int, completion_tokens: int):
+    """
+    This function adds the tokens spent by a completion to the ledger. A
+    failure is only logged, the ledger never fails a memo.
+    """
+    global _pruned
+    if not USAGE_LEDGER:
+        return
+    labels = _labels.get()
+    now = time.time()
+    try:
+        with closing(connect()) as conn:
+            conn.execute(
+                "INSERT INTO usage (created, destination, field, model, prompt_tokens,"
+                " completion_tokens, truncated_tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    now,
+                    labels.get("destination"),
+                    labels.get("field"),
+                    model,
+                    prompt_tokens,
+                    completion_tokens,
+                    labels.get("truncated", 0),
+                ),
+            )
+            if now - _pruned > 86400:
+                _pruned = now
+                conn.execute(
+                    "DELETE FROM usage WHERE created < ?",
+                    (now - USAGE_RETENTION_DAYS * 86400,),
+                )
+    except sqlite3.Error:
+        logging.warning("The usage of %s could not be recorded", model, exc_info=True)
+
+
+def report(group_by=("destination", "field", "model"), since: float = None) -> list:
+    """
+    This function returns the tokens spent by group, the most expensive
+    first, with their share of all the tokens spent.
+
+    Args:
+        group_by (tuple): The columns of GROUPS to group the completions by.
+        since (float, optional): The timestamp of the first completion.
+    """
+    unknown = set(group_by) - set(GROUPS)
+    if unknown:
+        raise ValueError(f"Unknown groups: {', '.join(sorted(unknown))}")
+    columns = [
+        "date(created, 'unixepoch', 'localtime') AS day" if g == "day" else g
+        for g in group_by
+    ]
+    query = (
+        f"SELECT {', '.join(columns + [''])}COUNT(*) AS calls,"
+        " COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,"
+        " COALESCE(SUM(completion_tokens), 0) AS completion_tokens,"
+        " COALESCE(SUM(truncated_tokens), 0) AS truncated_tokens"
+        " FROM usage WHERE created >= ?"
+    )
+    if group_by:
+        query += f" GROUP BY {', '.join(group_by)}"
+    query += " ORDER BY SUM(prompt_tokens + completion_tokens) DESC"
+    with closing(connect()) as conn:
+        rows = [dict(row) for row in conn.execute(query, (since or 0,))]
+    total = sum(row["prompt_tokens"] + row["completion_tokens"] for row in rows)
+    for row in rows:
+        row["total_tokens"] = row["prompt_tokens"] + row["completion_tokens"]
+        row["share"] = row["total_tokens"] / total if total else 0.0
+    return rows
@@ -1,61 +1,133 @@
 """
 Create the content to send into the Notion database
 """
-import datetime
-import json
+import asyncio
 import logging
-import pytz
 import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Request, g, request, jsonify, url_for
 from werkzeug.utils import secure_filename
 
-from lib.notion import create_new_row
+from lib.notion import (
+    aprewarm_notion,
+    astream_paragraphs,
+    get_client,
+    heading_block,
+    notion_stats,
+    paragraph_blocks,
+    prewarm_notion,
+    stream_paragraphs,
+)
+from lib.batch import (
+    ARCHIVE_EXTENSIONS,
+    ARCHIVE_MIMETYPES,
+    BATCH_MAX_FILES,
+    enqueue_batch,
+    extension_of,
+    extract_archive,
+    manifest,
+    process_batch,
+)
+from lib.fields import (
+    agenerate_fields,
+    afield_text,
+    astream_field,
+    field_text,
+    generate_fields,
+    get_field,
+    split_streamed,
+    stream_field,
+)
 from lib.gpt import (
-    generate_concept,
-    generate_draft,
-    generate_events,
-    generate_excerpt,
-    generate_followup,
-    generate_further_reading,
-    generate_goals,
-    generate_improvements,
-    generate_interpretation,
-    generate_keywords,
-    generate_mood,
-    generate_name,
-    generate_preparation,
-    generate_recommandations,
-    generate_results,
-    generate_target_audience,
-    generate_tasks,
-    generate_title,
+    aprewarm_openai,
+    atranscribe,
+    cache_stats,
+    get_openai_client,
+    openai_stats,
+    prewarm_openai,
     transcribe,
 )
+from lib.log import bind, log_context, new_request_id, setup_logging, unbind
+from lib.jobs import enqueue, get_job, process_job, set_page_id, start_workers
+from lib.metrics import observe_stage, render, stage, tracing
+from lib.models import ModelRoutes
+from lib.outbox import (
+    append,
+    append_blocks,
+    outbox_stats,
+    start_flusher,
+    stop_flusher,
+)
+from lib.routing import get_routing_index
+from lib.usage import labelled
+from lib.upload import (
+    MAX_UPLOAD_BYTES,
+    RAW_MIMETYPES,
+    file_stream_factory,
+    receive_stream,
+)
 
 load_dotenv()
 
-# Set loggin config
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    filename=os.environ.get("LOG_PATH"),
-    filemode="w",
-)
+# The logs are written by a background thread, see lib/log.py
+setup_logging()
 
 # Get the script directory
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 # Set default settings for the app
-UPLOAD_FOLDER = SCRIPT_DIR + "/uploads"
-CONFIG_FILE = SCRIPT_DIR + "/config.json"
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", SCRIPT_DIR + "/uploads")
+CONFIG_FILE = os.environ.get("CONFIG_FILE", SCRIPT_DIR + "/config.json")
 ALLOWED_EXTENSIONS = {"m4a"}
 PORT = os.environ.get("PORT")
+# Number of threads processing the queued uploads inside the app, 0 when the
+# queue is drained by worker.py in a separate process
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# Whether the connections to OpenAI and Notion are opened at startup, before
+# the first memo
+PREWARM = os.environ.get("PREWARM", "false").lower() == "true"
+
+
+class UploadRequest(Request):
+    """
+    A request writing its uploaded files straight to the uploads folder,
+    hashed on the fly
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.uploads = []
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        return file_stream_factory(app.config["UPLOAD_FOLDER"], self.uploads)(
+            total_content_length, content_type, filename, content_length
+        )
+
+    def close(self):
+        super().close()
+        # The files which were not accepted are removed
+        for upload in self.uploads:
+            upload.discard()
+
 
 app = Flask(__name__)
-app.config["DEBUG"] = True
+app.request_class = UploadRequest
+# The debug mode of Flask, never for a server reachable by others
+app.config["DEBUG"] = os.environ.get("DEBUG", "false").lower() == "true"
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+_workers_lock = threading.Lock()
+_workers = None
+# The state of the connections of the process: cold, warm or failed
+_connections = {"openai": "cold", "notion": "cold"}
 
 
 def allowed_file(filename):
@@ -67,130 +139,408 @@ def allowed_file(filename):
 
 def load_config(text: str):
     """
-    This function loads the config.json file based on the
+    This function finds the destination of the text in the config.json file
+    and returns it with the idea, the text following the keyword
     """
-    # Load the JSON config file in a Python dictionary
     try:
-        with open(CONFIG_FILE, encoding="utf-8") as f:
-            user_config = json.load(f)
+        index = get_routing_index(CONFIG_FILE)
     except FileNotFoundError:
-        logging.error("The config.json is not found", exc_info=True)
-        user_config = None
-    # Select only one item in the dictionnary, the one that matches the text
-    # inside the keywords value
-    if user_config is not None:
-        for word in text.split():
-            # Remove any punctuations and lower the word
-            normalized_word = word.lower().strip(".,!?")
-            word_length = len(normalized_word)
-            logging.debug("The word is: %s", normalized_word)
-            for destination in user_config["destinations"]:
-                logging.debug("The destination is: %s", destination)
-                if normalized_word in destination["keywords"]:
-                    logging.debug("The destination is: %s", destination)
-                    # The rest of the text from the current word is the idea
-                    idea: str = "".join(
-                        text[text.index(normalized_word) + word_length + 1 :]
-                    )
-                    logging.debug("The idea is: %s", idea)
-                    # Return the destination and the idea
-                    return destination, idea
-            # If a point is found, then we stop the loop because
-            # the keyword is not found
-            if "." in word:
-                break
-        # Fallback to the first item in the config file
-        logging.warning("No destination found, using default", exc_info=True)
-        return user_config["destinations"][0], text
-    else:
         logging.error("No config file found, using default", exc_info=True)
-        raise FileNotFoundError
+        raise
+    return index.route(text)
 
 
-def generate_content(text: str, db: str, fields: list, lang: str):
+def model_routes(destination: dict) -> ModelRoutes:
     """
-    This function generates the content for the Notion database
+    This function returns the models of the fields of a destination, set in
+    the config.json file
     """
+    return get_routing_index(CONFIG_FILE).model_routes(destination)
 
-    # Define the current date in iso8601 format
-    # Set the timezone to Paris
-
-    timezone = pytz.timezone(os.environ.get("TIME_ZONE", "UTC"))
-    # Get the current time in Paris
-    date = datetime.datetime.now(timezone).isoformat()
 
-    # Define an empty payload
+def build_payload(fields: list, values: dict) -> dict:
+    """
+    This function builds the payload of the configured fields from their
+    generated values
+    """
+    # Only the configured fields are sent to Notion
     payload = {}
-
     for field in fields:
-        if field == "Concept":
-            concept = generate_concept(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": concept}
-        elif field == "Date":
-            payload[field] = {"type": "date", "value": {"start": date}}
-        elif field == "Draft":
-            draft = generate_draft(text, target, keywords, language=lang)
-            payload[field] = {"type": "rich_text", "value": draft}
-        elif field == "Events":
-            events = generate_events(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": events}
-        elif field == "Excerpt":
-            excerpt = generate_excerpt(text, keywords, language=lang)
-            payload[field] = {"type": "rich_text", "value": excerpt}
-        elif field == "Followup":
-            followup = generate_followup(tasks, language=lang)
-            payload[field] = {"type": "rich_text", "value": followup}
-        elif field == "Reading":
-            further_reading = generate_further_reading(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": further_reading}
-        elif field == "Goals":
-            goals = generate_goals(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": goals}
-        elif field == "Improvements":
-            improvements = generate_improvements(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": improvements}
-        elif field == "Interpretation":
-            interpretation = generate_interpretation(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": interpretation}
-        elif field == "Keywords":
-            keywords = generate_keywords(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": keywords}
-        elif field == "Input":
-            payload[field] = {"type": "rich_text", "value": text}
-        elif field == "Mood":
-            mood = generate_mood(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": mood}
-        elif field == "Name":
-            name = generate_name(text, language=lang)
-            payload[field] = {"type": "title", "value": name}
-        elif field == "Preparation":
-            preparation = generate_preparation(tasks, language=lang)
-            payload[field] = {"type": "rich_text", "value": preparation}
-        elif field == "Recommendations":
-            recommandations = generate_recommandations(mood, events, language=lang)
-            payload[field] = {"type": "rich_text", "value": recommandations}
-        elif field == "Results":
-            result = generate_results(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": result}
-        elif field == "Target":
-            target = generate_target_audience(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": target}
-        elif field == "Tasks":
-            tasks = generate_tasks(text, language=lang)
-            payload[field] = {"type": "rich_text", "value": tasks}
-        elif field == "Title":
-            title = generate_title(text, language=lang)
-            payload[field] = {"type": "title", "value": title}
-        elif field == "Weather":
-            # Todo: call the weather API
-            # https://api.openweathermap.org/data/3.0/onecall
-            # /day_summary?lat={lat}
-            # &lon={lon}&date={date}&tz={tz}&appid={API key}
-            payload[field] = {"type": "rich_text", "value": "No implementation yet"}
-        else:
-            payload[field] = {"type": "rich_text", "value": text}
+        payload[field] = {"type": get_field(field).type, "value": values[field]}
     logging.debug("The payload is: %s", payload)
-    create_new_row(db, payload)
+    return payload
+
+
+def no_progress(stage: str, status: str):
+    """
+    This function ignores the progress of the pipeline
+    """
+
+
+async def ano_progress(stage: str, status: str):
+    """
+    This function is the asynchronous version of no_progress
+    """
+
+
+def generate_content(
+    text: str,
+    db: str,
+    fields: list,
+    lang: str,
+    progress=no_progress,
+    combined: bool = None,
+    job_id: str = None,
+    stream: list = None,
+    routes: ModelRoutes = None,
+    digest: list = None,
+):
+    """
+    This function generates the content for the Notion database and puts it
+    in the outbox, to be sent to Notion in the background. It returns the id
+    of the page in the outbox.
+    The streamed fields are generated last and appended to the body of the
+    page while they are generated. The fields of digest are built from the
+    digest of the text
+    """
+    streamed, before = split_streamed(fields, stream or [])
+
+    # Generate every field, and the fields they depend on, in parallel
+    progress("generate", "running")
+    with stage("generate"):
+        values = generate_fields(
+            text, before, lang, combined=combined, routes=routes, digest=digest
+        )
+    progress("notion", "queued")
+    with stage("outbox"):
+        entry_id = append(
+            db, build_payload([f for f in fields if f not in streamed], values), job_id
+        )
+    ensure_flusher()
+    for name in streamed:
+        append_blocks(entry_id, [heading_block(name)])
+        try:
+            with stage("stream"):
+                source = field_text(name, text, lang, values, digest)
+                tokens = stream_field(name, source, lang, values, routes)
+                for paragraphs in stream_paragraphs(tokens):
+                    append_blocks(entry_id, paragraph_blocks(paragraphs))
+        except Exception:
+            logging.error("Error while streaming the field %s", name, exc_info=True)
+    progress("generate", "done")
+    return entry_id
+
+
+async def agenerate_content(
+    text: str,
+    db: str,
+    fields: list,
+    lang: str,
+    progress=ano_progress,
+    combined: bool = None,
+    job_id: str = None,
+    stream: list = None,
+    routes: ModelRoutes = None,
+    digest: list = None,
+):
+    """
+    This function is the asynchronous version of generate_content, with a
+    progress coroutine function
+    """
+    streamed, before = split_streamed(fields, stream or [])
+    await progress("generate", "running")
+    with stage("generate"):
+        values = await agenerate_fields(
+            text, before, lang, combined=combined, routes=routes, digest=digest
+        )
+    with stage("outbox"):
+        entry_id = await asyncio.to_thread(
+            append,
+            db,
+            build_payload([f for f in fields if f not in streamed], values),
+            job_id,
+        )
+    await progress("notion", "queued")
+    ensure_flusher()
+    for name in streamed:
+        await asyncio.to_thread(append_blocks, entry_id, [heading_block(name)])
+        try:
+            with stage("stream"):
+                source = await afield_text(name, text, lang, values, digest)
+                async for paragraphs in astream_paragraphs(
+                    astream_field(name, source, lang, values, routes)
+                ):
+                    await asyncio.to_thread(
+                        append_blocks, entry_id, paragraph_blocks(paragraphs)
+                    )
+        except Exception:
+            logging.error("Error while streaming the field %s", name, exc_info=True)
+    await progress("generate", "done")
+    return entry_id
+
+
+def page_delivered(entry: dict, page: dict):
+    """
+    This function records the Notion page created for a job
+    """
+    if entry["job_id"] is not None:
+        set_page_id(entry["job_id"], page["id"])
+
+
+def ensure_flusher():
+    """
+    This function starts the thread sending the outbox to Notion, once
+    """
+    start_flusher(page_delivered)
+
+
+def route_idea(transcript: str):
+    """
+    This function finds the destination of a transcript and the idea in it
+    """
+    destination, idea = load_config(transcript)
+    logging.info(
+        "The destination is %s (database %s)", destination["name"], destination["db_id"]
+    )
+    return destination, idea
+
+
+def success(destination: dict, entry_id: int) -> dict:
+    """
+    This function returns the response of a processed file
+    """
+    return {
+        "message": "Success",
+        "destination": destination["name"],
+        "outbox_id": entry_id,
+    }
+
+
+def process_file(
+    filepath: str, progress=no_progress, audio_hash: str = None, job_id: str = None
+):
+    """
+    This function sends an uploaded audio file through the whole pipeline and
+    returns the JSON response with its status code. The progress function is
+    called with each stage of the pipeline and its status
+    """
+    # Trasncribe the audio file
+    progress("transcribe", "running")
+    with stage("transcribe"):
+        idea = transcribe(filepath, audio_hash=audio_hash)
+    progress("transcribe", "done")
+
+    # Load the config file
+    progress("route", "running")
+    with stage("route"):
+        destination, idea = route_idea(idea)
+    progress("route", "done")
+
+    if idea is not None:
+        # Call your main function with the idea from the request
+        with labelled(destination=destination["name"]):
+            entry_id = generate_content(
+                idea,
+                destination["db_id"],
+                destination["fields"],
+                destination["language"],
+                progress,
+                destination.get("combined"),
+                job_id,
+                destination.get("stream"),
+                model_routes(destination),
+                destination.get("digest"),
+            )
+        logging.debug("The content is generated")
+        return success(destination, entry_id), 200
+    logging.error("No idea provided", exc_info=True)
+    return {"message": "No idea provided"}, 400
+
+
+async def aprocess_file(
+    filepath: str, progress=ano_progress, audio_hash: str = None, job_id: str = None
+):
+    """
+    This function is the asynchronous version of process_file, with a
+    progress coroutine function
+    """
+    await progress("transcribe", "running")
+    with stage("transcribe"):
+        idea = await atranscribe(filepath, audio_hash=audio_hash)
+    await progress("transcribe", "done")
+
+    await progress("route", "running")
+    with stage("route"):
+        destination, idea = route_idea(idea)
+    await progress("route", "done")
+
+    if idea is not None:
+        with labelled(destination=destination["name"]):
+            entry_id = await agenerate_content(
+                idea,
+                destination["db_id"],
+                destination["fields"],
+                destination["language"],
+                progress,
+                destination.get("combined"),
+                job_id,
+                destination.get("stream"),
+                model_routes(destination),
+                destination.get("digest"),
+            )
+        logging.debug("The content is generated")
+        return success(destination, entry_id), 200
+    logging.error("No idea provided", exc_info=True)
+    return {"message": "No idea provided"}, 400
+
+
+def run_job(job: dict, progress):
+    """
+    This function processes a job of the queue
+    """
+    with log_context(job_id=job["id"]):
+        return process_file(job["filepath"], progress, job["audio_hash"], job["id"])
+
+
+def ensure_workers():
+    """
+    This function starts the threads processing the queue, once
+    """
+    global _workers
+    with _workers_lock:
+        if _workers is None and JOB_WORKERS > 0:
+            _workers = start_workers(run_job, JOB_WORKERS)
+
+
+def stop_workers():
+    """
+    This function asks the threads processing the queue to take no new job,
+    the jobs in progress go on. A server stopping calls it first, then waits
+    for them with stop_background
+    """
+    with _workers_lock:
+        if _workers is not None:
+            _workers[0].set()
+
+
+def stop_background(timeout: float = None):
+    """
+    This function stops the threads processing the queue and sending the
+    outbox, letting the jobs in progress finish for at most timeout seconds.
+    A job still running is taken again once its lease expires
+    """
+    global _workers
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with _workers_lock:
+        workers, _workers = _workers, None
+    if workers is not None:
+        stop, threads = workers
+        stop.set()
+        for thread in threads:
+            thread.join(None if deadline is None else deadline - time.monotonic())
+    stop_flusher(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+def warm_up():
+    """
+    This function loads the config and creates the clients of OpenAI and
+    Notion before the first memo, without connecting them. A server
+    preloading the app calls it before starting its workers, so that they all
+    share them
+    """
+    try:
+        get_routing_index(CONFIG_FILE)
+    except FileNotFoundError:
+        logging.error("No config file found", exc_info=True)
+    get_openai_client()
+    try:
+        get_client()
+    except ValueError:
+        logging.error("The Notion client could not be created", exc_info=True)
+
+
+def prewarm():
+    """
+    This function opens the connections to OpenAI and Notion at the same
+    time, so that the first memo does not wait for them. A server forking
+    its workers calls it in each of them, the connections can not be shared
+    """
+    started = time.monotonic()
+    with ThreadPoolExecutor(2, thread_name_prefix="prewarm") as executor:
+        openai = executor.submit(prewarm_openai)
+        notion = executor.submit(prewarm_notion)
+        _connections["openai"] = "warm" if openai.result() else "failed"
+        _connections["notion"] = "warm" if notion.result() else "failed"
+    logging.info(
+        "Connections prewarmed in %.3fs: %s", time.monotonic() - started, _connections
+    )
+
+
+async def aprewarm():
+    """
+    This function is the asynchronous version of prewarm, for the
+    asynchronous clients
+    """
+    started = time.monotonic()
+    openai, notion = await asyncio.gather(aprewarm_openai(), aprewarm_notion())
+    _connections["openai"] = "warm" if openai else "failed"
+    _connections["notion"] = "warm" if notion else "failed"
+    logging.info(
+        "Connections prewarmed in %.3fs: %s", time.monotonic() - started, _connections
+    )
+
+
+def readiness():
+    """
+    This function returns whether the process is ready to receive memos: its
+    config can be loaded and, when PREWARM is set, its connections were
+    opened, with the state of each one. A failed connection does not keep
+    the process out, the memos open it again
+    """
+    try:
+        get_routing_index(CONFIG_FILE)
+        config = True
+    except (OSError, ValueError):
+        logging.error("The config can not be loaded", exc_info=True)
+        config = False
+    ready = config and not (PREWARM and "cold" in _connections.values())
+    return {"ready": ready, "config": config, "connections": dict(_connections)}
+
+
+@app.before_request
+def start_timer():
+    """
+    This function records when the request started, to measure the upload
+    """
+    g.started = time.monotonic()
+
+
+@app.before_request
+def start_request_log():
+    """
+    This function adds the id of the request, given in its X-Request-Id
+    header or new, to its logs
+    """
+    g.request_id = request.headers.get("X-Request-Id") or new_request_id()
+    g.log_token = bind(request_id=g.request_id)
+
+
+@app.after_request
+def add_request_id(response):
+    """
+    This function gives the id of the request in its response
+    """
+    response.headers["X-Request-Id"] = g.request_id
+    return response
+
+
+@app.teardown_request
+def end_request_log(exception):
+    """
+    This function removes the id of the request from the logs
+    """
+    if "log_token" in g:
+        unbind(g.log_token)
 
 
 @app.route("/", methods=["POST"])
@@ -199,6 +549,14 @@ def generate():
     This function generates the content for the Notion database
     """
 
+    # The audio can also be sent as the raw body of the request
+    if request.mimetype in RAW_MIMETYPES:
+        filepath, audio_hash = receive_stream(
+            request.stream.read, app.config["UPLOAD_FOLDER"], "m4a"
+        )
+        logging.debug("The file path is: %s", filepath)
+        return accept_upload(filepath, audio_hash)
+
     # check if the post request has the file part
     if "file" not in request.files:
         logging.error("No file in the POST request", exc_info=True)
@@ -209,9 +567,10 @@ def generate():
 
     if file is not None and allowed_file(file.filename):
         if file.filename is not None:
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+            # The file is already written, it only gets its final name
+            # A name such as ".m4a" loses its dot once made safe
+            extension = extension_of(secure_filename(file.filename)) or "m4a"
+            filepath, audio_hash = file.stream.commit(extension)
             logging.debug("The file path is: %s", filepath)
         else:
             logging.error("The file name is invalid", exc_info=True)
@@ -220,26 +579,142 @@ def generate():
         logging.error("The file is invalid", exc_info=True)
         return jsonify({"message": "Invalid file"}), 400
 
-    # Trasncribe the audio file
-    idea = transcribe(filepath)
+    return accept_upload(filepath, audio_hash)
 
-    # Load the config file
-    destination, idea = load_config(idea)
-    logging.debug("The destination is: %s", destination)
-    print(f"Doing:{destination['name']}")
-    database_id = destination["db_id"]
-    logging.debug("The database id is: %s", database_id)
-    print(f"Db:{database_id}")
 
-    if idea is not None:
-        # Call your main function with the idea from the request
-        generate_content(
-            idea, database_id, destination["fields"], destination["language"]
+def accept_upload(filepath: str, audio_hash: str):
+    """
+    This function processes a received audio file, or queues it. An upload
+    already received, with the same Idempotency-Key header or the same audio,
+    is answered with the job of the first one
+    """
+    # Older shortcuts can still wait for the whole pipeline
+    wait = bool(request.args.get("wait"))
+    # With ?trace=1, the response of ?wait=1 gives the spans of the pipeline
+    with tracing(wait and bool(request.args.get("trace")), g.started) as trace:
+        observe_stage("upload", g.started)
+        job_id, created = enqueue(
+            filepath,
+            audio_hash,
+            request.headers.get("Idempotency-Key"),
+            "running" if wait else "queued",
         )
-        logging.debug("The content is generated")
-        return jsonify({"message": "Success", "destination": destination["name"]}), 200
-    logging.error("No idea provided", exc_info=True)
-    return jsonify({"message": "No idea provided"}), 400
+        if not created:
+            return replay(get_job(job_id))
+
+        if wait:
+            # The client gets the error, the job is not processed again
+            body, status = process_job(run_job, get_job(job_id), requeue=False)
+            if trace is not None:
+                body = {**body, "trace": trace}
+            return jsonify(body), status
+
+    ensure_workers()
+    return accepted(job_id)
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    """
+    This function receives many voice memos at once, as "file" parts or zip
+    archives of memos, or as a zip archive in the body, and queues them. It
+    returns the manifest of their jobs or, with ?wait=1, of their results once
+    they are all processed, BATCH_WORKERS at a time
+    """
+    folder = app.config["UPLOAD_FOLDER"]
+    uploads, rejected = [], []
+    try:
+        if request.mimetype in ARCHIVE_MIMETYPES:
+            archive, _ = receive_stream(request.stream.read, folder, "zip")
+            uploads = extract_archive(archive, folder, ALLOWED_EXTENSIONS)
+        for file in request.files.getlist("file"):
+            name = secure_filename(file.filename or "")
+            if extension_of(name) in ARCHIVE_EXTENSIONS:
+                archive, _ = file.stream.commit("zip")
+                uploads += extract_archive(archive, folder, ALLOWED_EXTENSIONS)
+            elif allowed_file(name):
+                uploads.append((file.filename, *file.stream.commit(extension_of(name))))
+            else:
+                rejected.append((file.filename, "Invalid file"))
+    except (ValueError, zipfile.BadZipFile) as e:
+        logging.error("The batch is invalid", exc_info=True)
+        return jsonify({"message": f"Invalid archive: {e}"}), 400
+    if not uploads:
+        logging.error("No file in the batch")
+        return (
+            jsonify({"message": "File missing", "files": manifest([], rejected)}),
+            400,
+        )
+    if len(uploads) > BATCH_MAX_FILES:
+        return jsonify({"message": f"More than {BATCH_MAX_FILES} files"}), 400
+
+    observe_stage("upload", g.started)
+    wait = bool(request.args.get("wait"))
+    jobs = enqueue_batch(uploads, request.headers.get("Idempotency-Key"))
+    if wait:
+        process_batch([job for _, job, created in jobs if created], run_job)
+    else:
+        ensure_workers()
+    files = manifest(jobs, rejected)
+    for entry in files:
+        if "job_id" in entry:
+            entry["status_url"] = url_for("job_status", job_id=entry["job_id"])
+    if wait:
+        return jsonify({"message": "Success", "files": files}), 200
+    return jsonify({"message": "Accepted", "files": files}), 202
+
+
+def accepted(job_id: str):
+    """
+    This function returns the response of a queued upload
+    """
+    return (
+        jsonify(
+            {
+                "message": "Accepted",
+                "job_id": job_id,
+                "status_url": url_for("job_status", job_id=job_id),
+            }
+        ),
+        202,
+    )
+
+
+def replay(job: dict):
+    """
+    This function answers a duplicate upload with the result of the first
+    one, or with its job while it is processed
+    """
+    if job["result"] is not None:
+        body = {**job["result"]["body"], "page_id": job["page_id"]}
+        response = jsonify(body), job["result"]["status_code"]
+    else:
+        response = accepted(job["id"])
+    return response + ({"Idempotent-Replayed": "true"},)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    This function returns the progress of a queued upload
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    return (
+        jsonify(
+            {
+                "job_id": job["id"],
+                "status": job["status"],
+                "stage": job["stage"],
+                "stages": job["stages"],
+                "attempts": job["attempts"],
+                "result": job["result"],
+                "error": job["error"],
+            }
+        ),
+        200,
+    )
 
 
 @app.route("/hello", methods=["GET"])
@@ -250,7 +725,54 @@ def hello():
     return jsonify({"message": "Success"}), 200
 
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """
+    This function is used to check if the app can process memos, unlike
+    /hello which only checks that it is running
+    """
+    body = readiness()
+    return jsonify(body), 200 if body["ready"] else 503
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """
+    This function returns the counters of the caches and of the calls to
+    OpenAI and Notion, for monitoring
+    """
+    return (
+        jsonify(
+            {
+                **cache_stats(),
+                "openai": openai_stats(),
+                "notion": notion_stats(),
+                "outbox": outbox_stats(),
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    This function returns the metrics of the pipeline, in the Prometheus text
+    format
+    """
+    return render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
 if __name__ == "__main__":
     if PORT is None:
         PORT = 5000
+    warm_up()
+    if PREWARM:
+        prewarm()
+    # The jobs and the pages left by a previous run are processed right away,
+    # by the process serving the app (not the one watching the code with
+    # DEBUG)
+    if not app.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        ensure_flusher()
+        ensure_workers()
     app.run(host="0.0.0.0", port=PORT)
@@ -0,0 +1,59 @@
+"""
+Show where the tokens go, from the ledger of the completions.
+
+By default, the tokens of the last 30 days by destination, field and model:
+    python report.py --days 7 --by field
+"""
+import argparse
+import json
+import time
+
+from lib.usage import GROUPS, report
+
+
+def main():
+    """
+    This function prints the tokens spent by group, the most expensive first
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--days", type=float, default=30, help="number of days reported, 0 for all"
+    )
+    parser.add_argument(
+        "--by",
+        default="destination,field,model",
+        help=f"columns to group by, among: {', '.join(GROUPS)}",
+    )
+    parser.add_argument("--json", action="store_true", help="print the rows in JSON")
+    args = parser.parse_args()
+
+    group_by = tuple(group for group in args.by.split(",") if group)
+    since = time.time() - args.days * 86400 if args.days else None
+    rows = report(group_by, since)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    columns = list(group_by) + [
+        "calls",
+        "prompt_tokens",
+        "completion_tokens",
+        "total_tokens",
+        "share",
+        "per_call",
+        "truncated_tokens",
+    ]
+    lines = [columns]
+    for row in rows:
+        row["per_call"] = row["total_tokens"] // row["calls"] if row["calls"] else 0
+        row["share"] = f"{row['share']:.1%}"
+        lines.append(
+            [str(row[column] if row[column] is not None else "-") for column in columns]
+        )
+    widths = [max(len(line[i]) for line in lines) for i in range(len(columns))]
+    for line in lines:
+        print("  ".join(value.ljust(width) for value, width in zip(line, widths)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""
+Fixtures shared by the tests: each test gets its own scratch databases.
+"""
+
+import pytest
+
+from lib import jobs, outbox
+
+
+@pytest.fixture
+def jobs_db(tmp_path, monkeypatch):
+    """
+    This fixture points the queue to a new database.
+    """
+    monkeypatch.setattr(jobs, "JOBS_DB", str(tmp_path / "jobs.sqlite3"))
+    return jobs.JOBS_DB
+
+
+@pytest.fixture
+def outbox_db(tmp_path, monkeypatch):
+    """
+    This fixture points the outbox to a new database.
+    """
+    monkeypatch.setattr(outbox, "OUTBOX_DB", str(tmp_path / "outbox.sqlite3"))
+    return outbox.OUTBOX_DB
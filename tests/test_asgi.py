@@ -0,0 +1,32 @@
+import asyncio
+
+import asgi
+from lib import jobs
+
+
+def get(path: str):
+    async def main():
+        response = await asgi.app.test_client().get(path)
+        return response.status_code, await response.get_json()
+
+    return asyncio.run(main())
+
+
+def test_the_progress_of_a_job(jobs_db):
+    job_id, _ = jobs.enqueue("memo.m4a", "hash")
+    status, body = get(f"/jobs/{job_id}")
+    assert status == 200
+    assert (body["job_id"], body["status"]) == (job_id, "queued")
+    jobs.finish_job(job_id, {"message": "Success"}, 200)
+    assert get(f"/jobs/{job_id}")[1]["status"] == "done"
+
+
+def test_an_unknown_job(jobs_db):
+    assert get("/jobs/unknown")[0] == 404
+
+
+def test_the_stats(outbox_db):
+    status, body = get("/stats")
+    assert status == 200
+    assert body["outbox"]["oldest_pending_seconds"] == 0
+    assert "openai" in body and "notion" in body
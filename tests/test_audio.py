@@ -0,0 +1,34 @@
+from lib import audio
+from lib.audio import merge_transcripts, plan_segments
+
+
+def test_a_short_recording_is_one_segment():
+    assert plan_segments(100, []) == [(0.0, 100)]
+    # A segment is not cut for less than SILENCE_WINDOW seconds more
+    assert plan_segments(320, []) == [(0.0, 320)]
+
+
+def test_segments_are_cut_in_the_closest_silence(monkeypatch):
+    monkeypatch.setattr(audio, "SEGMENT_SECONDS", 300)
+    monkeypatch.setattr(audio, "SILENCE_WINDOW", 30)
+    monkeypatch.setattr(audio, "SEGMENT_OVERLAP", 2)
+    silences = [(250, 252), (310, 312), (320, 330)]
+    assert plan_segments(600, silences) == [(0.0, 311.0), (309.0, 600)]
+
+
+def test_segments_are_cut_at_the_target_without_silence(monkeypatch):
+    monkeypatch.setattr(audio, "SEGMENT_SECONDS", 300)
+    monkeypatch.setattr(audio, "SILENCE_WINDOW", 30)
+    monkeypatch.setattr(audio, "SEGMENT_OVERLAP", 2)
+    assert plan_segments(900, []) == [(0.0, 300.0), (298.0, 600.0), (598.0, 900)]
+
+
+def test_merge_transcripts_removes_the_overlap():
+    texts = ["We went to the market.", "The market, then home.", "Home at last"]
+    assert merge_transcripts(texts) == "We went to the market. then home. at last"
+
+
+def test_merge_transcripts_without_overlap():
+    assert merge_transcripts(["one two", "three four"]) == "one two three four"
+    assert merge_transcripts(["one", ""]) == "one"
+    assert merge_transcripts([]) == ""
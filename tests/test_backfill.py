@@ -0,0 +1,61 @@
+import json
+
+import backfill
+
+
+def test_only_the_gpt_fields_by_default():
+    assert backfill.wanted_field("Name", [])
+    assert not backfill.wanted_field("Date", [])
+    assert not backfill.wanted_field("Input", [])
+
+
+def test_the_fields_asked_for():
+    assert backfill.wanted_field("Date", ["Date", "Name"])
+    assert not backfill.wanted_field("Mood", ["Date", "Name"])
+
+
+DESTINATION = {"db_id": "db", "fields": ["Name", "Input"]}
+
+
+def test_the_page_of_the_job(monkeypatch):
+    monkeypatch.setattr(backfill, "find_page_id", lambda path, audio_hash: "page")
+    monkeypatch.setattr(backfill, "query_database", None)
+    assert backfill.find_page(DESTINATION, "idea", "memo.txt", "memo.m4a") == "page"
+
+
+def test_the_page_of_a_memo_older_than_the_jobs(monkeypatch):
+    queries = []
+
+    def query_database(db, filter, page_size=100):
+        queries.append((db, filter))
+        return pages
+
+    monkeypatch.setattr(backfill, "find_page_id", lambda path, audio_hash: None)
+    monkeypatch.setattr(backfill, "query_database", query_database)
+    pages = [{"id": "page"}]
+    assert backfill.find_page(DESTINATION, "idea", "memo.txt", "memo.m4a") == "page"
+    assert queries == [
+        ("db", {"property": "Input", "rich_text": {"starts_with": "idea"}})
+    ]
+    # Several pages, or none, are not the page of the memo
+    pages = [{"id": "page"}, {"id": "other"}]
+    assert backfill.find_page(DESTINATION, "idea", "memo.txt", "memo.m4a") is None
+    pages = []
+    assert backfill.find_page(DESTINATION, "idea", "memo.txt", "memo.m4a") is None
+    # Without Input, the pages cannot be told apart
+    destination = {"db_id": "db", "fields": ["Name"]}
+    assert backfill.find_page(destination, "idea", "memo.txt", "memo.m4a") is None
+    assert len(queries) == 3
+
+
+def test_the_memos_without_page_are_handled_again(tmp_path):
+    checkpoint = tmp_path / "backfill.checkpoint"
+    entries = [
+        {"transcript": "a.txt", "key": "k", "status": "done"},
+        {"transcript": "b.txt", "key": "k", "status": "skipped", "reason": "no idea"},
+        {"transcript": "c.txt", "key": "k", "status": "skipped", "reason": "no page"},
+        {"transcript": "d.txt", "key": "k", "status": "failed"},
+        {"transcript": "e.txt", "key": "other", "status": "done"},
+    ]
+    checkpoint.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    assert backfill.read_checkpoint(str(checkpoint), "k") == {"a.txt", "b.txt"}
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import threading
+import zipfile
+
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from lib import batch, jobs
+
+
+def uploads(count: int) -> list:
+    return [(f"memo-{i}.m4a", f"/tmp/memo-{i}.m4a", f"hash-{i}") for i in range(count)]
+
+
+def test_batch_memos_wait_in_the_queue(jobs_db):
+    enqueued = batch.enqueue_batch(uploads(3))
+    assert [job["status"] for _, job, _ in enqueued] == ["queued"] * 3
+    assert all(job["lease_until"] is None for _, job, _ in enqueued)
+
+
+def test_start_job_takes_a_job_once(jobs_db):
+    ((_, job, _),) = batch.enqueue_batch(uploads(1))
+    started = jobs.start_job(job["id"])
+    assert started["status"] == "running"
+    assert started["attempts"] == 1
+    assert started["lease_until"] is not None
+    # Neither the batch nor a worker of the queue can take it again
+    assert jobs.start_job(job["id"]) is None
+    assert jobs.claim_job() is None
+
+
+def test_process_batch_processes_each_memo_once(jobs_db):
+    calls = []
+    lock = threading.Lock()
+
+    def handler(job, progress):
+        with lock:
+            calls.append(job["id"])
+        progress("transcribe", "done")
+        return {"message": "Success"}, 200
+
+    enqueued = batch.enqueue_batch(uploads(6))
+    batch.process_batch([job for _, job, _ in enqueued], handler, workers=2)
+    assert sorted(calls) == sorted(job["id"] for _, job, _ in enqueued)
+    assert [entry["status"] for entry in batch.manifest(enqueued)] == ["done"] * 6
+
+
+def test_process_batch_waits_for_a_memo_taken_by_a_worker(jobs_db, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0.01)
+    ((_, job, _),) = batch.enqueue_batch(uploads(1))
+    taken = jobs.claim_job()
+    assert taken["id"] == job["id"]
+    finisher = threading.Timer(
+        0.05, jobs.finish_job, (job["id"], {"message": "Success"}, 200)
+    )
+    finisher.start()
+    calls = []
+    batch.process_batch([job], lambda job, progress: calls.append(job), workers=1)
+    assert calls == []
+    assert jobs.get_job(job["id"])["status"] == "done"
+
+
+def test_aprocess_batch_processes_each_memo_once(jobs_db):
+    calls = []
+
+    async def handler(job):
+        calls.append(job["id"])
+        await asyncio.to_thread(jobs.finish_job, job["id"], {"message": "Success"}, 200)
+
+    enqueued = batch.enqueue_batch(uploads(4))
+    asyncio.run(batch.aprocess_batch([job for _, job, _ in enqueued], handler, 2))
+    assert sorted(calls) == sorted(job["id"] for _, job, _ in enqueued)
+    assert [entry["status"] for entry in batch.manifest(enqueued)] == ["done"] * 4
+
+
+def archive(tmp_path, members: dict) -> str:
+    path = str(tmp_path / "memos.zip")
+    with zipfile.ZipFile(path, "w") as f:
+        for name, data in members.items():
+            f.writestr(name, data)
+    return path
+
+
+def test_the_memos_of_an_archive_are_extracted(tmp_path):
+    members = {"a.m4a": b"audio a", "b.m4a": b"audio b", "copy.m4a": b"audio a"}
+    extracted = batch.extract_archive(
+        archive(tmp_path, members), str(tmp_path), {"m4a"}
+    )
+    assert [name for name, _, _ in extracted] == list(members)
+    assert extracted[0][1] == extracted[2][1]
+    paths = {os.path.basename(path) for _, path, _ in extracted}
+    assert sorted(os.listdir(tmp_path)) == sorted(paths)
+    assert len(paths) == 2
+
+
+def test_a_failed_archive_leaves_no_memo(tmp_path, monkeypatch):
+    receive_stream = batch.receive_stream
+    calls = []
+
+    def fail_second(read, directory, extension):
+        calls.append(extension)
+        if len(calls) > 1:
+            raise RequestEntityTooLarge()
+        return receive_stream(read, directory, extension)
+
+    monkeypatch.setattr(batch, "receive_stream", fail_second)
+    path = archive(tmp_path, {"a.m4a": b"audio a", "b.m4a": b"audio b"})
+    with pytest.raises(RequestEntityTooLarge):
+        batch.extract_archive(path, str(tmp_path), {"m4a"})
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,91 @@
+import hashlib
+
+import pytest
+
+from lib.cache import MemoryCache, SQLiteCache, create_cache, hash_file, hash_key
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    """
+    This fixture returns a function creating a store of each backend.
+    """
+
+    def make(**limits):
+        return create_cache(request.param, str(tmp_path / "cache.sqlite3"), **limits)
+
+    return make
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path / "memo.m4a"
+    path.write_bytes(b"audio" * 1000)
+    assert (
+        hash_file(str(path), chunk_size=7)
+        == hashlib.sha256(b"audio" * 1000).hexdigest()
+    )
+
+
+def test_hash_key_is_stable():
+    assert hash_key("model", [{"a": 1, "b": 2}]) == hash_key(
+        "model", [{"b": 2, "a": 1}]
+    )
+    assert hash_key("model", "text") != hash_key("model", "other text")
+
+
+def test_get_and_set(make_cache):
+    cache = make_cache()
+    assert cache.get("key") is None
+    cache.set("key", "value")
+    cache.set("key", "new value")
+    assert cache.get("key") == "new value"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    cache.delete("key")
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entries_are_evicted(make_cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("lib.cache.time.time", lambda: now[0])
+    cache = make_cache(max_entries=2)
+    for key in ("a", "b"):
+        cache.set(key, key)
+        now[0] += 1
+    assert cache.get("a") == "a"
+    now[0] += 1
+    cache.set("c", "c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.get("c") == "c"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_over_the_size_are_evicted(make_cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("lib.cache.time.time", lambda: now[0])
+    cache = make_cache(max_bytes=10)
+    cache.set("a", "x" * 6)
+    now[0] += 1
+    cache.set("b", "é" * 3)
+    assert cache.get("a") is None
+    assert cache.get("b") == "é" * 3
+    assert cache.stats()["bytes"] == 6
+
+
+def test_expired_entries_are_not_returned(make_cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("lib.cache.time.time", lambda: now[0])
+    cache = make_cache(ttl=60)
+    cache.set("key", "value")
+    now[0] += 30
+    assert cache.get("key") == "value"
+    now[0] += 31
+    assert cache.get("key") is None
+
+
+def test_create_cache():
+    assert isinstance(create_cache("memory", ""), MemoryCache)
+    assert isinstance(create_cache("sqlite", "cache.sqlite3"), SQLiteCache)
+    assert create_cache("off", "") is None
+    assert create_cache("other", "") is None
@@ -0,0 +1,197 @@
+import asyncio
+
+import pytest
+
+from lib import fields, gpt
+from lib.gpt import COMBINED_MODEL
+
+DIGEST = {"summary": "SUMMARY", "clean": "CLEAN", "entities": ["Paris"]}
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    """
+    This fixture replaces the calls to GPT and returns the text each field
+    was built from.
+    """
+    texts = {}
+
+    def generate_field(name, text, language, values, routes=None, use_cache=True):
+        texts[name] = text
+        return name.lower()
+
+    async def agenerate_field(
+        name, text, language, values, routes=None, use_cache=True
+    ):
+        return generate_field(name, text, language, values, routes)
+
+    async def agenerate_digest(text, language, use_cache=True):
+        return DIGEST
+
+    monkeypatch.setattr(fields, "generate_field", generate_field)
+    monkeypatch.setattr(fields, "agenerate_field", agenerate_field)
+    monkeypatch.setattr(fields, "generate_digest", lambda *args: DIGEST)
+    monkeypatch.setattr(fields, "agenerate_digest", agenerate_digest)
+    return texts
+
+
+def test_digest_text():
+    assert fields.digest_text("TEXT", None, "summary") == "TEXT"
+    assert fields.digest_text("TEXT", DIGEST, None) == "TEXT"
+    assert fields.digest_text("TEXT", DIGEST, "clean") == "CLEAN"
+    assert fields.digest_text("TEXT", DIGEST, "summary") == (
+        "SUMMARY\n\nKey entities: Paris"
+    )
+
+
+def test_digest_views():
+    assert fields.digest_views(None) == {}
+    assert fields.digest_views(["Name"]) == {"Name": "summary"}
+    assert fields.digest_views({"Draft": "clean", "Mood": "other"}) == {
+        "Draft": "clean",
+        "Mood": "summary",
+    }
+
+
+def test_only_the_fields_of_the_digest_use_it(sources):
+    values = fields.generate_fields(
+        "FULL TRANSCRIPT", ["Keywords", "Excerpt"], "en", digest=["Keywords"]
+    )
+    assert sources["Keywords"].startswith("SUMMARY")
+    assert sources["Excerpt"] == "FULL TRANSCRIPT"
+    assert values[fields.DIGEST] == DIGEST
+
+
+def test_only_the_fields_of_the_digest_use_it_async(sources):
+    values = asyncio.run(
+        fields.agenerate_fields(
+            "FULL TRANSCRIPT", ["Keywords", "Excerpt"], "en", digest=["Keywords"]
+        )
+    )
+    assert sources["Keywords"].startswith("SUMMARY")
+    assert sources["Excerpt"] == "FULL TRANSCRIPT"
+    assert values[fields.DIGEST] == DIGEST
+
+
+def test_no_digest_without_a_field_using_it(sources):
+    values = fields.generate_fields("FULL TRANSCRIPT", ["Keywords"], "en")
+    assert fields.DIGEST not in values
+    assert sources["Keywords"] == "FULL TRANSCRIPT"
+
+
+@pytest.fixture
+def cached(monkeypatch):
+    """
+    This fixture replaces the cache of the completions and returns the
+    (system message, user message, model) looked up in it.
+    """
+    lookups = []
+
+    def get_cached_completion(system_msg, user_msg, model):
+        lookups.append((system_msg, user_msg, model))
+        return "cached" if model == "cached-model" else None
+
+    monkeypatch.setattr(fields, "get_cached_completion", get_cached_completion)
+    return lookups
+
+
+def test_prepare_combined_uses_the_routes(cached):
+    routes = fields.ModelRoutes({"default": "routed-model"})
+    values, prompts = fields.prepare_combined(
+        ["Mood", "Events", "Goals"], "TEXT", "en", routes
+    )
+    assert values == {}
+    assert list(prompts) == ["Mood", "Events", "Goals"]
+    assert {model for _, _, model in cached} == {"routed-model", COMBINED_MODEL}
+    assert all(prompt[0].model == "routed-model" for prompt in prompts.values())
+
+
+def test_prepare_combined_returns_the_cached_fields(cached):
+    routes = fields.ModelRoutes({"fields": {"Mood": "cached-model"}})
+    values, prompts = fields.prepare_combined(
+        ["Mood", "Events", "Goals"], "TEXT", "en", routes
+    )
+    assert values == {"Mood": "cached"}
+    assert list(prompts) == ["Events", "Goals"]
+
+
+def test_prepare_combined_leaves_out_the_digest_and_the_budgets(cached):
+    text = " ".join(["word"] * 200)
+    routes = fields.ModelRoutes({"budgets": {"Events": 10}})
+    values, prompts = fields.prepare_combined(
+        ["Mood", "Events", "Goals", "Name"], text, "en", routes, {"Goals": "summary"}
+    )
+    assert list(prompts) == ["Mood", "Name"]
+    # A single field left is not combined
+    values, prompts = fields.prepare_combined(["Mood", "Events"], text, "en", routes)
+    assert prompts == {}
+
+
+def test_resolve_fields_puts_the_required_fields_first():
+    order = fields.resolve_fields(["Draft", "Recommendations", "Keywords"])
+    assert sorted(order) == sorted(
+        ["Draft", "Target", "Keywords", "Recommendations", "Mood", "Events"]
+    )
+    for name in order:
+        for required in fields.get_field(name).requires:
+            assert order.index(required) < order.index(name)
+
+
+def test_resolve_fields_keeps_each_field_once():
+    assert fields.resolve_fields(["Excerpt", "Keywords", "Excerpt"]) == [
+        "Keywords",
+        "Excerpt",
+    ]
+
+
+def test_resolve_fields_rejects_a_cycle(monkeypatch):
+    monkeypatch.setitem(fields.FIELDS, "A", fields.gpt_field("rich_text", ("B",), None))
+    monkeypatch.setitem(fields.FIELDS, "B", fields.gpt_field("rich_text", ("A",), None))
+    with pytest.raises(ValueError, match="A -> B -> A"):
+        fields.resolve_fields(["A"])
+
+
+def test_the_cache_can_be_bypassed(monkeypatch):
+    calls = []
+
+    def completion(system_msg, user_msg, model, use_cache=True, max_retries=None):
+        calls.append(use_cache)
+        return "value"
+
+    def digest_completion(text, language, use_cache=True):
+        calls.append(use_cache)
+        return DIGEST
+
+    monkeypatch.setattr(gpt, "completion", completion)
+    monkeypatch.setattr(fields, "digest_completion", digest_completion)
+    monkeypatch.setattr(fields, "get_cached_completion", lambda *args: "cached")
+    values = fields.generate_fields(
+        "TEXT",
+        ["Mood", "Events", "Keywords"],
+        "en",
+        combined=False,
+        digest=["Keywords"],
+        use_cache=False,
+    )
+    assert values["Mood"] == "value"
+    assert calls == [False] * 4
+    # The combined completion does not take the cached fields either
+    values, prompts = fields.prepare_combined(
+        ["Mood", "Events"], "TEXT", "en", use_cache=False
+    )
+    assert (values, list(prompts)) == ({}, ["Mood", "Events"])
+
+
+def test_the_combined_fields_are_cached_under_the_combined_model(monkeypatch):
+    cache = {}
+    monkeypatch.setattr(
+        fields, "set_cached_completion", lambda *args: cache.update({args[:3]: args[3]})
+    )
+    monkeypatch.setattr(fields, "get_cached_completion", lambda *key: cache.get(key))
+    routes = fields.ModelRoutes({"default": "routed-model"})
+    _, prompts = fields.prepare_combined(["Mood", "Events"], "TEXT", "en", routes)
+    fields.store_combined(prompts, {"Mood": "happy"})
+    assert {model for _, _, model in cache} == {COMBINED_MODEL}
+    # The field is not generated again by the next combined completion
+    values, _ = fields.prepare_combined(["Mood", "Events"], "TEXT", "en", routes)
+    assert values == {"Mood": "happy"}
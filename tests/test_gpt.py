@@ -0,0 +1,37 @@
+import json
+
+from lib.gpt import parse_combined_content, parse_digest
+
+
+def test_parse_combined_content_keeps_the_valid_fields():
+    content = json.dumps(
+        {
+            "Mood": 'calm "and" happy',
+            "Tasks": ["buy bread", "call Anna"],
+            "Events": "",
+            "Goals": 3,
+            "Other": "not asked",
+        }
+    )
+    assert parse_combined_content(content, ["Mood", "Tasks", "Events", "Goals"]) == {
+        "Mood": "calm and happy",
+        "Tasks": "buy bread\ncall Anna",
+    }
+
+
+def test_parse_combined_content_refuses_what_is_not_an_object():
+    assert parse_combined_content("not json", ["Mood"]) == {}
+    assert parse_combined_content('["Mood"]', ["Mood"]) == {}
+    assert parse_combined_content(None, ["Mood"]) == {}
+
+
+def test_parse_digest():
+    content = json.dumps({"clean": " text ", "summary": "summary", "entities": [1]})
+    assert parse_digest(content) == {
+        "clean": "text",
+        "summary": "summary",
+        "entities": ["1"],
+    }
+    assert parse_digest(json.dumps({"clean": "text", "summary": ""})) is None
+    assert parse_digest(json.dumps({"clean": "text"})) is None
+    assert parse_digest("not json") is None
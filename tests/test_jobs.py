@@ -0,0 +1,27 @@
+from lib import jobs
+
+
+def test_the_same_idempotency_key_gives_the_same_job(jobs_db):
+    job_id, created = jobs.enqueue("a.m4a", "hash-a", "key")
+    assert created
+    assert jobs.enqueue("b.m4a", "hash-b", "key") == (job_id, False)
+    assert jobs.enqueue("c.m4a", "hash-c", "other key")[1]
+
+
+def test_the_same_audio_gives_the_same_job(jobs_db, monkeypatch):
+    monkeypatch.setattr(jobs, "DEDUP_UPLOADS", True)
+    job_id, created = jobs.enqueue("a.m4a", "hash")
+    assert created
+    assert jobs.enqueue("b.m4a", "hash") == (job_id, False)
+    assert jobs.enqueue("c.m4a", "other hash")[1]
+    monkeypatch.setattr(jobs, "DEDUP_UPLOADS", False)
+    assert jobs.enqueue("d.m4a", "hash")[1]
+
+
+def test_a_failed_job_is_not_a_duplicate(jobs_db, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 0)
+    job_id, _ = jobs.enqueue("a.m4a", "hash", "key")
+    jobs.retry_job(job_id, "error")
+    new_id, created = jobs.enqueue("a.m4a", "hash", "key")
+    assert created
+    assert new_id != job_id
@@ -0,0 +1,32 @@
+import json
+import logging
+
+from lib.log import Formatter, QueueHandler
+
+
+class Queue(list):
+    def put_nowait(self, record):
+        self.append(record)
+
+
+def test_the_message_is_built_when_logged():
+    handler = QueueHandler(Queue())
+    values = ["first"]
+    record = logging.LogRecord("gpt", logging.INFO, __file__, 1, "%s", (values,), None)
+    handler.emit(record)
+    values.append("second")
+    queued = handler.queue[0]
+    assert queued.msg == "['first']"
+    assert queued.args is None
+    assert record.args == (values,)
+
+
+def test_formatter_writes_the_context():
+    record = logging.LogRecord(
+        "gpt", logging.INFO, __file__, 1, "hello %s", ("you",), None
+    )
+    record.context = {"job_id": "job"}
+    data = json.loads(Formatter().format(record))
+    assert data["message"] == "hello you"
+    assert data["module"] == "gpt"
+    assert data["job_id"] == "job"
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+
+from lib import notion
+from lib.notion import NotionClient, split_text, text_objects
+
+
+async def get_async_client(client: NotionClient):
+    return client.async_client()
+
+
+def test_async_client_of_another_loop_is_closed():
+    client = NotionClient("token")
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        first = asyncio.run_coroutine_threadsafe(
+            get_async_client(client), loop
+        ).result()
+        second = asyncio.run(get_async_client(client))
+        assert second is not first
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result()
+        assert first.is_closed
+        assert not second.is_closed
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_async_client_is_kept_in_its_loop():
+    client = NotionClient("token")
+
+    async def main():
+        first = client.async_client()
+        assert client.async_client() is first
+        await client.aclose()
+        assert first.is_closed
+        assert client.async_client() is not first
+        await client.aclose()
+
+    asyncio.run(main())
+
+
+def test_async_client_of_a_closed_loop_is_dropped():
+    client = NotionClient("token")
+    first = asyncio.run(get_async_client(client))
+    assert asyncio.run(get_async_client(client)) is not first
+
+
+def test_split_text_cuts_at_the_last_space():
+    assert split_text("aaa bbb ccc", 8) == ["aaa bbb ", "ccc"]
+    assert "".join(split_text("word " * 1000, 2000)) == "word " * 1000
+    assert all(len(piece) <= 2000 for piece in split_text("word " * 1000))
+
+
+def test_split_text_cuts_a_long_word():
+    assert split_text("a" * 10, 4) == ["aaaa", "aaaa", "aa"]
+    assert split_text("") == [""]
+
+
+def test_text_objects_are_limited(monkeypatch):
+    monkeypatch.setattr(notion, "MAX_TEXT_OBJECTS", 2)
+    objects = text_objects("a" * 5000)
+    assert [len(o["text"]["content"]) for o in objects] == [2000, 2000]
+
+
+def test_creating_requests_are_not_idempotent():
+    assert not notion.is_idempotent("POST", "/pages")
+    assert not notion.is_idempotent("PATCH", "/blocks/page/children")
+    assert notion.is_idempotent("POST", "/databases/db/query")
+    assert notion.is_idempotent("PATCH", "/pages/page")
+    assert notion.is_idempotent("GET", "/users/me")
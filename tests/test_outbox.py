@@ -0,0 +1,205 @@
+import json
+from concurrent.futures import Future
+from contextlib import closing
+
+import pytest
+import requests
+
+from lib import outbox
+from lib.notion import NOTION_VERSION, heading_block, paragraph_blocks
+
+
+def deliver(entries: list):
+    outbox.record_results(entries, [({"id": "page"}, None, None) for _ in entries])
+
+
+def kill(entries: list):
+    with closing(outbox.connect()) as conn:
+        conn.executemany(
+            "UPDATE outbox SET status = 'dead' WHERE id = ?",
+            [(entry["id"],) for entry in entries],
+        )
+
+
+def claimed_ids() -> list:
+    return [entry["id"] for entry in outbox.claim_batch()]
+
+
+def test_blocks_wait_for_their_page(outbox_db):
+    page = outbox.append("db", {"Name": "memo"})
+    outbox.append_blocks(page, [])
+    assert claimed_ids() == [page]
+
+
+def test_blocks_are_sent_one_at_a_time_in_order(outbox_db):
+    page = outbox.append("db", {"Name": "memo"})
+    first = outbox.append_blocks(page, [])
+    second = outbox.append_blocks(page, [])
+    deliver(outbox.claim_batch())
+    entries = outbox.claim_batch()
+    assert [entry["id"] for entry in entries] == [first]
+    deliver(entries)
+    assert claimed_ids() == [second]
+
+
+def test_a_dead_block_does_not_hold_back_the_next_ones(outbox_db):
+    page = outbox.append("db", {"Name": "memo"})
+    first = outbox.append_blocks(page, [])
+    second = outbox.append_blocks(page, [])
+    deliver(outbox.claim_batch())
+    kill(outbox.claim_batch())
+    entries = outbox.claim_batch()
+    assert [entry["id"] for entry in entries] == [second]
+    assert entries[0]["parent_page_id"] == "page"
+    deliver(entries)
+    assert outbox.retry_dead() == 1
+    assert claimed_ids() == [first]
+
+
+class Response:
+    def __init__(self, status_code: int = 200, body: dict = None):
+        self.status_code = status_code
+        self.body = body or {"id": "page"}
+        self.text = json.dumps(self.body)
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            error = requests.HTTPError(f"{self.status_code} Error")
+            error.response = self
+            raise error
+
+
+class Client:
+    """
+    A client of Notion recording the requests it is given.
+    """
+
+    def __init__(self, response=None):
+        self.requests = []
+        self.response = response or Response()
+        # The responses of some paths, instead of response
+        self.responses = {}
+
+    def submit(self, method, path, payload=None):
+        self.requests.append((method, path, payload))
+        response = self.responses.get(path, self.response)
+        future = Future()
+        if isinstance(response, Exception):
+            future.set_exception(response)
+        else:
+            future.set_result(response)
+        return future
+
+    def request(self, method, path, payload=None):
+        return self.submit(method, path, payload).result()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = Client()
+    monkeypatch.setattr(outbox, "get_client", lambda: client)
+    return client
+
+
+def test_blocks_are_sent_as_children_with_rich_text(outbox_db, client):
+    page = outbox.append("db", {"Name": {"type": "title", "value": "memo"}})
+    outbox.append_blocks(
+        page, [heading_block("Draft")] + paragraph_blocks("First.\n\nSecond.")
+    )
+    deliver(outbox.claim_batch())
+    outbox.send_batch(outbox.claim_batch())
+    method, path, payload = client.requests[0]
+    assert (method, path) == ("PATCH", "/blocks/page/children")
+    heading, first, second = payload["children"]
+    assert heading["heading_2"]["rich_text"][0]["text"]["content"] == "Draft"
+    assert first["paragraph"]["rich_text"][0]["text"]["content"] == "First."
+    assert second["type"] == "paragraph"
+    # The blocks are written for a version of the API taking rich_text
+    assert NOTION_VERSION >= "2022-02-22"
+
+
+def test_blocks_are_cut_at_the_limit_of_notion(outbox_db):
+    page = outbox.append("db", {})
+    blocks = paragraph_blocks("\n\n".join(str(i) for i in range(250)))
+    outbox.append_blocks(page, blocks)
+    with closing(outbox.connect()) as conn:
+        payloads = [
+            json.loads(row["payload"])
+            for row in conn.execute(
+                "SELECT payload FROM outbox WHERE kind = 'blocks' ORDER BY id"
+            )
+        ]
+    assert [len(payload) for payload in payloads] == [100, 100, 50]
+    assert sum(payloads, []) == blocks
+
+
+def status_after(client, response) -> str:
+    outbox.append("db", {"Name": {"type": "title", "value": "memo"}})
+    client.response = response
+    entries = outbox.claim_batch()
+    outbox.record_results(entries, outbox.send_batch(entries))
+    with closing(outbox.connect()) as conn:
+        return conn.execute("SELECT status FROM outbox").fetchone()["status"]
+
+
+@pytest.mark.parametrize("status", [400, 401, 403, 404])
+def test_a_page_refused_for_good_is_dead_at_once(outbox_db, client, status):
+    assert status_after(client, Response(status)) == "dead"
+
+
+@pytest.mark.parametrize("status", [408, 409, 429, 500, 502, 503])
+def test_a_page_throttled_or_failing_is_sent_again(outbox_db, client, status):
+    assert status_after(client, Response(status)) == "pending"
+
+
+def test_a_page_not_answered_is_sent_again(outbox_db, client):
+    error = requests.exceptions.ConnectionError("connection refused")
+    assert status_after(client, error) == "pending"
+
+
+def test_a_delivered_page_gets_its_id(outbox_db, client):
+    assert status_after(client, Response(200, {"id": "new-page"})) == "delivered"
+
+
+def send_again(client) -> list:
+    """
+    This function sends a page whose first attempt timed out, and returns
+    the paths of the requests sent the second time.
+    """
+    outbox.append("db", {"Name": {"type": "title", "value": "memo"}})
+    client.response = requests.exceptions.ReadTimeout("read timeout")
+    entries = outbox.claim_batch()
+    outbox.record_results(entries, outbox.send_batch(entries))
+    with closing(outbox.connect()) as conn:
+        conn.execute("UPDATE outbox SET next_attempt = 0")
+    client.requests.clear()
+    client.response = Response(200, {"id": "new-page"})
+    entries = outbox.claim_batch()
+    outbox.record_results(entries, outbox.send_batch(entries))
+    return [path for _, path, _ in client.requests]
+
+
+def test_a_page_already_created_is_not_created_again(outbox_db, client):
+    client.responses["/databases/db/query"] = Response(
+        200, {"results": [{"id": "created-page"}]}
+    )
+    assert send_again(client) == ["/databases/db/query"]
+    with closing(outbox.connect()) as conn:
+        row = conn.execute("SELECT status, page_id FROM outbox").fetchone()
+    assert (row["status"], row["page_id"]) == ("delivered", "created-page")
+    method, _, payload = [r for r in client.requests if r[1].endswith("/query")][0]
+    assert payload["filter"]["and"][0] == {
+        "property": "Name",
+        "title": {"equals": "memo"},
+    }
+
+
+def test_a_page_not_created_is_sent_again(outbox_db, client):
+    client.responses["/databases/db/query"] = Response(200, {"results": []})
+    assert send_again(client) == ["/databases/db/query", "/pages"]
+    with closing(outbox.connect()) as conn:
+        row = conn.execute("SELECT status, page_id FROM outbox").fetchone()
+    assert (row["status"], row["page_id"]) == ("delivered", "new-page")
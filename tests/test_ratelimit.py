@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from lib import gpt, notion
+from lib.ratelimit import Governor, RequestScheduler, TokenBucket
+
+
+def governor(budgets: dict) -> Governor:
+    return Governor("test", 2, 4, budgets, 0, lambda error: (False, False, None))
+
+
+def test_token_bucket_waits_once_empty():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=100, capacity=5)
+    bucket.pause(0.5)
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
+
+
+def test_set_budgets_changes_the_models_already_used():
+    limits = governor({"a": 600})
+    _, bucket = limits.model("a")
+    assert bucket.capacity == 600
+    limits.set_budgets({"a": 300, "b": 60})
+    assert limits.model("a")[1].capacity == 300
+    assert limits.model("a")[1].rate == 5
+    assert limits.model("b")[1].capacity == 60
+    limits.set_budgets({})
+    assert limits.model("a")[1] is None
+
+
+def test_share_budgets(monkeypatch):
+    limits = governor({})
+    monkeypatch.setattr(gpt, "governor", limits)
+    monkeypatch.setattr(gpt, "OPENAI_TPM", {"gpt-4": 90000})
+    gpt.share_budgets(3)
+    assert limits.tokens_per_minute == {"gpt-4": 30000}
+
+
+def test_share_rate(monkeypatch):
+    monkeypatch.setattr(notion, "NOTION_RATE", 3.0)
+    monkeypatch.setattr(notion, "_client", None)
+    monkeypatch.setattr(notion, "_rate", notion._rate)
+    monkeypatch.setattr(notion, "notion_token", "token")
+    notion.share_rate(4)
+    client = notion.get_client()
+    assert client.scheduler.bucket.rate == 0.75
+    notion.share_rate(2)
+    assert client.scheduler.bucket.rate == 1.5
+
+
+def test_call_holds_the_slot_until_released():
+    limits = governor({})
+    limiter, _ = limits.model("a")
+    assert limits.call("a", lambda: "stream", hold=True) == "stream"
+    assert limiter.active == 1
+    limits.release("a")
+    assert limiter.active == 0
+    assert limits.call("a", lambda: "result") == "result"
+    assert limiter.active == 0
+
+
+def test_call_frees_the_slot_of_a_failed_call():
+    limits = governor({})
+    limiter, _ = limits.model("a")
+
+    def fail():
+        raise ValueError("error")
+
+    with pytest.raises(ValueError):
+        limits.call("a", fail, hold=True)
+    assert limiter.active == 0
+
+
+def test_stream_completion_holds_the_slot_while_read(monkeypatch):
+    limits = governor({})
+    monkeypatch.setattr(gpt, "governor", limits)
+    monkeypatch.setattr(gpt, "finish_stream", lambda *args: None)
+    limiter, _ = limits.model("gpt-4")
+    active = []
+
+    def chunks():
+        for text in ("Hello", " world"):
+            active.append(limiter.active)
+            yield text
+
+    monkeypatch.setattr(gpt, "chat", lambda *args, **kwargs: chunks)
+    monkeypatch.setattr(gpt, "stream_delta", lambda chunk: chunk)
+    monkeypatch.setattr(gpt, "check_api_key", lambda: None)
+    parts = list(gpt.stream_completion("system", "user", "gpt-4", use_cache=False))
+    assert "".join(parts) == "Hello world"
+    assert active == [1, 1]
+    assert limiter.active == 0
+
+
+def test_a_request_not_idempotent_is_retried_only_before_reaching_the_api():
+    scheduler = RequestScheduler(
+        "test",
+        rate=10,
+        burst=1,
+        workers=1,
+        max_retries=3,
+        retry_exceptions=(requests.exceptions.ConnectionError, requests.Timeout),
+        connect_exceptions=(requests.exceptions.ConnectTimeout,),
+    )
+    read_timeout = requests.exceptions.ReadTimeout()
+    connect_timeout = requests.exceptions.ConnectTimeout()
+    assert scheduler.retry_delay(1, error=read_timeout) is not None
+    assert scheduler.retry_delay(1, error=read_timeout, idempotent=False) is None
+    assert scheduler.retry_delay(1, error=connect_timeout, idempotent=False)
+    failed = SimpleNamespace(status_code=502, headers={})
+    throttled = SimpleNamespace(status_code=429, headers={"Retry-After": "0"})
+    assert scheduler.retry_delay(1, failed) is not None
+    assert scheduler.retry_delay(1, failed, idempotent=False) is None
+    assert scheduler.retry_delay(1, throttled, idempotent=False) == 0
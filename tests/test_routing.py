@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from lib.routing import RoutingIndex, get_routing_index, normalize_word
+
+CONFIG = {
+    "destinations": [
+        {"name": "Inbox", "keywords": []},
+        {"name": "Ideas", "keywords": ["idée", "idea"]},
+        {"name": "Tasks", "keywords": ["tâche", "à faire", "todo"]},
+        {"name": "Journal", "keywords": ["journal", "note"]},
+        {"name": "Notes", "keywords": ["note", "à noter"]},
+    ]
+}
+
+
+def old_route(config: dict, text: str):
+    """
+    The routing of the first version: the first word of the first sentence
+    which is a keyword, the destinations being tried in order.
+    """
+    for word in text.split():
+        normalized_word = word.lower().strip(".,!?")
+        for destination in config["destinations"]:
+            if normalized_word in destination["keywords"]:
+                return destination
+        if "." in word:
+            break
+    return config["destinations"][0]
+
+
+@pytest.fixture
+def index():
+    return RoutingIndex(CONFIG)
+
+
+def route(index, text):
+    destination, idea = index.route(text)
+    return destination["name"], idea
+
+
+def test_normalize_word():
+    assert normalize_word("Idée!") == "idee"
+    assert normalize_word("«TÂCHE»") == "tache"
+    assert normalize_word("-") == ""
+    assert normalize_word("e-mail,") == "e-mail"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "idea build an app",
+        "Note, buy some bread",
+        "I had an idea today",
+        "todo call the bank. idea later",
+        "Nothing to route. idea",
+        "note idea todo",
+        "journal",
+        "",
+    ],
+)
+def test_same_destination_as_the_first_version(index, text):
+    assert index.route(text)[0]["name"] == old_route(CONFIG, text)["name"]
+
+
+def test_first_destination_declaring_a_keyword_keeps_it(index):
+    assert route(index, "note the date") == ("Journal", "the date")
+
+
+def test_multi_word_keywords(index):
+    assert route(index, "À faire : appeler Paul") == ("Tasks", "appeler Paul")
+    # The longest keyword wins over a shorter one sharing its first word
+    assert route(index, "à noter le code") == ("Notes", "le code")
+    # A lone first word of a phrase is not a keyword
+    assert route(index, "à demain") == ("Inbox", "à demain")
+
+
+def test_accents_and_case(index):
+    assert route(index, "IDEE une app") == ("Ideas", "une app")
+    assert route(index, "Tache: payer") == ("Tasks", "payer")
+
+
+def test_punctuation(index):
+    assert route(index, "Idée ! name une app") == ("Ideas", "name une app")
+    assert route(index, "Idée - name") == ("Ideas", "name")
+    assert route(index, "« Idée » une app") == ("Ideas", "une app")
+    assert route(index, "! idée x") == ("Ideas", "x")
+    assert route(index, "à - faire ranger") == ("Tasks", "ranger")
+
+
+def test_keyword_after_the_first_sentence_is_ignored(index):
+    assert route(index, "Bonjour. idée x") == ("Inbox", "Bonjour. idée x")
+    # A phrase does not go over the end of a sentence
+    assert route(index, "à. faire x")[0] == "Inbox"
+
+
+def test_index_is_rebuilt_when_the_config_changes(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(CONFIG), encoding="utf-8")
+    first = get_routing_index(str(path))
+    assert get_routing_index(str(path)) is first
+    config = {"destinations": CONFIG["destinations"] + [{"name": "X", "keywords": []}]}
+    path.write_text(json.dumps(config), encoding="utf-8")
+    assert len(get_routing_index(str(path)).destinations) == 6
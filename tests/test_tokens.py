@@ -0,0 +1,44 @@
+import pytest
+
+from lib import tokens
+from lib.tokens import TRUNCATION_MARK, count_tokens, truncate
+
+
+@pytest.fixture
+def estimated(monkeypatch):
+    """
+    This fixture counts the tokens without tiktoken, about four characters
+    per token.
+    """
+    monkeypatch.setattr(tokens, "get_encoding", lambda model=None: None)
+
+
+def test_a_text_within_the_budget_is_kept(estimated):
+    assert truncate("short text", 100) == ("short text", 0)
+    assert truncate("long " * 100, 0) == ("long " * 100, 0)
+
+
+def test_a_text_over_the_budget_is_cut_after_a_word(estimated):
+    text = "word " * 100
+    short, removed = truncate(text, 10)
+    assert short == "word " * 7 + "word" + TRUNCATION_MARK
+    assert removed == count_tokens(text) - count_tokens("word " * 7 + "word")
+
+
+def test_truncate_with_tiktoken():
+    if tokens.get_encoding() is None:
+        pytest.skip("The encodings of tiktoken are not available")
+    short, removed = truncate("hello " * 100, 10)
+    assert short.endswith(TRUNCATION_MARK)
+    assert count_tokens(short[: -len(TRUNCATION_MARK)]) <= 10
+    assert removed > 0
+
+
+def test_the_estimate_is_logged(monkeypatch, caplog):
+    monkeypatch.setattr(tokens, "tiktoken", None)
+    tokens.get_encoding.cache_clear()
+    try:
+        assert count_tokens("a" * 40, "model without tiktoken") == 11
+    finally:
+        tokens.get_encoding.cache_clear()
+    assert "tiktoken is not installed" in caplog.text
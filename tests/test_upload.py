@@ -0,0 +1,81 @@
+import io
+import os
+
+import pytest
+
+import main
+from lib import jobs
+
+
+@pytest.fixture
+def client(jobs_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "JOB_WORKERS", 0)
+    monkeypatch.setitem(main.app.config, "UPLOAD_FOLDER", str(tmp_path))
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize("name", ["memo.m4a", "Memo.M4A", ".m4a", "../.m4a"])
+def test_upload_names(client, tmp_path, name):
+    response = client.post(
+        "/",
+        data={"file": (io.BytesIO(b"audio " + name.encode()), name)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 202
+    files = os.listdir(tmp_path)
+    assert len([f for f in files if f.endswith(".m4a")]) == 1
+
+
+def test_upload_refused(client):
+    response = client.post(
+        "/",
+        data={"file": (io.BytesIO(b"text"), "notes.txt")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 400
+
+
+def upload(client, audio: bytes, key: str = None):
+    headers = {"Idempotency-Key": key} if key is not None else {}
+    return client.post("/", data=audio, content_type="audio/mp4", headers=headers)
+
+
+def test_a_duplicate_in_progress_gets_its_job(client):
+    first = upload(client, b"audio", "key")
+    assert first.status_code == 202
+    second = upload(client, b"other audio", "key")
+    assert second.status_code == 202
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.json["job_id"] == first.json["job_id"]
+    # Without a key, the same audio is the same upload
+    assert upload(client, b"audio").json["job_id"] == first.json["job_id"]
+
+
+def test_a_finished_duplicate_gets_the_stored_result(client):
+    job_id = upload(client, b"audio", "key").json["job_id"]
+    jobs.finish_job(job_id, {"message": "Success", "destination": "Idea"}, 200)
+    jobs.set_page_id(job_id, "page")
+    response = upload(client, b"audio", "key")
+    assert response.status_code == 200
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert response.json == {
+        "message": "Success",
+        "destination": "Idea",
+        "page_id": "page",
+    }
+
+
+def test_a_failed_wait_is_not_processed_again(client, monkeypatch):
+    def process_file(*args):
+        raise RuntimeError("Notion is down")
+
+    monkeypatch.setattr(main, "process_file", process_file)
+    response = client.post("/?wait=1", data=b"audio", content_type="audio/mp4")
+    assert response.status_code == 500
+    assert response.json == {"message": "Error"}
+    # No worker takes the job again
+    assert jobs.claim_job() is None
+    # The client sending the upload again gets a new job
+    response = client.post("/", data=b"audio", content_type="audio/mp4")
+    assert response.status_code == 202
+    assert "Idempotent-Replayed" not in response.headers
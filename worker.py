@@ -0,0 +1,47 @@
+"""
+Process the queued uploads, and send the outbox to Notion, in a separate
+process.
+
+Set JOB_WORKERS=0 for the app so that only this process drains the queue:
+    python worker.py --concurrency 4
+"""
+import argparse
+import logging
+import os
+import signal
+
+from lib.jobs import start_workers
+from main import ensure_flusher, run_job
+
+
+def main():
+    """
+    This function drains the job queue until the process is stopped
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.environ.get("WORKER_CONCURRENCY", "2")),
+        help="number of jobs processed at the same time",
+    )
+    args = parser.parse_args()
+
+    stop, threads = start_workers(run_job, args.concurrency)
+    # The pages left in the outbox by a previous run are sent too
+    ensure_flusher()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    logging.info("Processing the queue with %s workers", args.concurrency)
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        stop.set()
+
+    # Let the jobs in progress finish
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()